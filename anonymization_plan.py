@@ -0,0 +1,213 @@
+import hashlib
+import hmac
+import threading
+from functools import partial
+
+from pydicom.dataelem import DataElement_from_raw, RawDataElement
+from pydicom.multival import MultiValue
+from pydicom.tag import Tag
+from dicomanonymizer import simpledicomanonymizer
+from dicomanonymizer.simpledicomanonymizer import initialize_actions, keep
+
+# anonymization_plan.py
+#
+# Purpose:
+#   dicomanonymizer's rule table, compiled once per process instead of on
+#   every anonymize_dataset() call.
+#
+#   anonymize_dataset() rebuilds its ~600-entry rule dict for each file, looks
+#   every rule tag up in the dataset, and walks the whole dataset once per
+#   repeating-group rule plus once more to remove private tags. Here the
+#   rules are split once into single-tag and repeating-group rules, and the
+#   single-tag rules that can apply are cached per dataset "shape"
+#   (SOPClassUID + the set of top-level tags). Applying the plan runs
+#   those actions and one dataset walk that handles the repeating-group rules
+#   and private tag removal together.
+#
+#   The actions themselves are dicomanonymizer's, run in the same rule order,
+#   so the output matches anonymize_dataset(). The one difference is that the
+#   single walk happens where the first repeating-group rule sits in the table.
+#
+#   UIDs: dicomanonymizer replaces each UID with a random one and remembers
+#   the pair in a module-level dict, so two worker processes (or two runs)
+#   give the same study different new StudyInstanceUIDs. apply() takes a
+#   uid_key instead; the replacement is then derived from HMAC-SHA256(key,
+#   old UID) (keyed_uid), the same in every process that has the key and
+#   not reversible without it. Without a key dicomanonymizer's random
+#   replacement is used as before.
+#
+#   dicomanonymizer's actions that can create UIDs look get_UID up in their
+#   module, so the plan runs its own copies of them (_UID_ACTIONS) that are
+#   handed the replacement function for the apply() in progress. Nothing is
+#   patched in dicomanonymizer, and apply() runs in parallel on several
+#   threads: only the random fallback (dicomanonymizer's unlocked dict) is
+#   locked. Two threads may compile the same shape at once; both results
+#   are equal, so either may stay cached.
+
+MAX_CACHED_SHAPES = 1024
+
+_random_uid_lock = threading.Lock()
+
+
+def keyed_uid(old_uid, key):
+    """Replacement for old_uid under key: '2.25.' + the first 128 bits of HMAC-SHA256 as a decimal."""
+    digest = hmac.new(key.encode(), str(old_uid).encode(), hashlib.sha256).digest()
+    return f"2.25.{int.from_bytes(digest[:16], 'big')}"
+
+
+def _random_uid(old_uid):
+    """dicomanonymizer's random replacement, remembered per old UID for the process."""
+    with _random_uid_lock:
+        return simpledicomanonymizer.get_UID(old_uid)
+
+
+def _replace_element_uid(element, new_uid):
+    if isinstance(element.value, MultiValue):
+        for k, v in enumerate(element.value):
+            element.value[k] = new_uid(v)
+    else:
+        element.value = new_uid(element.value)
+
+
+def _replace_element(element, new_uid):
+    if element.VR == "UI":
+        _replace_element_uid(element, new_uid)
+    elif element.VR == "SQ":
+        for sub_dataset in element.value:
+            for sub_element in sub_dataset.elements():
+                if isinstance(sub_element, RawDataElement):
+                    sub_element = DataElement_from_raw(sub_element)
+                    _replace_element(sub_element, new_uid)
+                    sub_dataset.add(sub_element)
+                else:
+                    _replace_element(sub_element, new_uid)
+    else:
+        # No UIDs below other VRs
+        simpledicomanonymizer.replace_element(element)
+
+
+def _replace(dataset, tag, new_uid):
+    element = dataset.get(tag)
+    if element is not None:
+        _replace_element(element, new_uid)
+
+
+def _replace_uid(dataset, tag, new_uid):
+    element = dataset.get(tag)
+    if element is not None:
+        _replace_element_uid(element, new_uid)
+
+
+def _delete_or_empty_or_replace_uid(dataset, tag, new_uid):
+    element = dataset.get(tag)
+    if element is not None:
+        if element.VR == "UI":
+            _replace_element_uid(element, new_uid)
+        else:
+            simpledicomanonymizer.empty_element(element)
+
+
+# dicomanonymizer actions that can create UIDs -> copies taking the UID function.
+# Its X/D, X/Z/D and Z/D actions all replace (D), like replace().
+_UID_ACTIONS = {
+    simpledicomanonymizer.replace: _replace,
+    simpledicomanonymizer.delete_or_replace: _replace,
+    simpledicomanonymizer.delete_or_empty_or_replace: _replace,
+    simpledicomanonymizer.empty_or_replace: _replace,
+    simpledicomanonymizer.replace_UID: _replace_uid,
+    simpledicomanonymizer.delete_or_empty_or_replace_UID: _delete_or_empty_or_replace_uid,
+}
+
+
+def _plan_action(action):
+    """(action, takes_uid): the plan's copy of a UID-creating action, other actions unchanged."""
+    uid_action = _UID_ACTIONS.get(action)
+    if uid_action is None:
+        return action, False
+    return uid_action, True
+
+
+class AnonymizationPlan:
+    """Compiled dicomanonymizer rules with a per-shape cache of applicable actions."""
+
+    def __init__(self, keep_tags=(), delete_private_tags=True, base_rules_gen=initialize_actions):
+        rules = base_rules_gen()
+        rules.update({tag: keep for tag in keep_tags})
+        self.delete_private_tags = delete_private_tags
+
+        self._single = []  # (tag tuple, Tag, action, takes_uid) in rule order
+        self._ranges = []  # (group, element, group_mask, element_mask, action, takes_uid)
+        self._walk_at = None
+        for tag, action in rules.items():
+            if len(tag) > 2:
+                if self._walk_at is None:
+                    self._walk_at = len(self._single)
+                self._ranges.append((*tag, *_plan_action(action)))
+            else:
+                if Tag(tag).is_private:
+                    raise ValueError(f"Rules for private tags are not supported: {tag}")
+                self._single.append((tag, Tag(tag), *_plan_action(action)))
+        if self._walk_at is None:
+            self._walk_at = len(self._single)
+        self._shapes = {}
+
+    def _shape_actions(self, ds):
+        """Return (actions before the walk, actions after the walk, newly compiled) for ds's shape."""
+        present = frozenset(ds.keys())
+        key = (getattr(ds, 'SOPClassUID', None), present)
+        cached = self._shapes.get(key)
+        if cached is not None:
+            return cached[0], cached[1], False
+
+        # File meta rules are always kept; their action checks ds.file_meta itself
+        applicable = [
+            (i, tag, action, takes_uid)
+            for i, (tag, int_tag, action, takes_uid) in enumerate(self._single)
+            if int_tag in present or tag[0] == 0x0002
+        ]
+        before = [(tag, action, takes_uid) for i, tag, action, takes_uid in applicable if i < self._walk_at]
+        after = [(tag, action, takes_uid) for i, tag, action, takes_uid in applicable if i >= self._walk_at]
+        if len(self._shapes) >= MAX_CACHED_SHAPES:
+            self._shapes.clear()
+        self._shapes[key] = (before, after)
+        return before, after, True
+
+    def _run(self, ds, actions, new_uid):
+        for tag, action, takes_uid in actions:
+            if tag[0] == 0x0002:
+                if not hasattr(ds, 'file_meta'):
+                    continue
+                target = ds.file_meta
+            else:
+                target = ds
+            if takes_uid:
+                action(target, tag, new_uid)
+            else:
+                action(target, tag)
+
+    def _walk_callback(self, new_uid, dataset, element):
+        tag = element.tag
+        if self.delete_private_tags and tag.is_private:
+            del dataset[tag]
+            return
+        for group, elem, group_mask, element_mask, action, takes_uid in self._ranges:
+            if tag.group & group_mask == group & group_mask and tag.element & element_mask == elem & element_mask:
+                if takes_uid:
+                    action(dataset, (tag.group, tag.element), new_uid)
+                else:
+                    action(dataset, (tag.group, tag.element))
+                if tag not in dataset:
+                    return
+
+    def apply(self, ds, uid_key=None):
+        """
+        Anonymize ds in place, replacing UIDs with keyed_uid(uid, uid_key)
+        (random replacements if uid_key is None). Returns True if its shape
+        had to be compiled.
+        """
+        new_uid = _random_uid if uid_key is None else partial(keyed_uid, key=uid_key)
+        before, after, compiled = self._shape_actions(ds)
+        self._run(ds, before, new_uid)
+        ds.walk(partial(self._walk_callback, new_uid))
+        self._run(ds, after, new_uid)
+        return compiled
@@ -0,0 +1,74 @@
+import csv
+import threading
+import time
+from datetime import datetime
+from pathlib import Path
+
+# audit_log.py
+#
+# Purpose:
+#   Shared CSV audit-log writer for deid_tool.py and remove_999_dose_reports.py.
+#
+#   One file handle stays open for the whole run. Rows are written with csv
+#   quoting (paths and error messages may contain commas or newlines) and are
+#   flushed to disk every FLUSH_ROWS rows or FLUSH_INTERVAL seconds, whichever
+#   comes first, plus on close().
+#
+#   With append=True an existing log is extended instead of replaced, which is
+#   how deid_tool.py keeps its output manifest across runs.
+#
+#   write() is thread-safe. Worker processes should not open the log
+#   themselves; they return their rows to the parent process, which writes them.
+
+FLUSH_ROWS = 500
+FLUSH_INTERVAL = 2.0
+
+
+class AuditLogWriter:
+    """Buffered, thread-safe CSV log with a leading Timestamp column."""
+
+    def __init__(self, path, columns, flush_rows=FLUSH_ROWS, flush_interval=FLUSH_INTERVAL, append=False):
+        self.path = Path(path)
+        self.flush_rows = flush_rows
+        self.flush_interval = flush_interval
+        self._lock = threading.Lock()
+        write_header = not (append and self.path.exists() and self.path.stat().st_size > 0)
+        mode = "a" if append else "w"
+        self._file = open(self.path, mode, newline="", encoding="utf-8", buffering=1024 * 1024)
+        self._writer = csv.writer(self._file, lineterminator="\n")
+        if write_header:
+            self._writer.writerow(["Timestamp", *columns])
+            self._file.flush()
+        self._pending = 0
+        self._last_flush = time.monotonic()
+
+    def write(self, values):
+        """Append one row; the timestamp is added here. Values are written as str(value)."""
+        row = [datetime.now().isoformat(), *(str(value) for value in values)]
+        with self._lock:
+            self._writer.writerow(row)
+            self._pending += 1
+            now = time.monotonic()
+            if self._pending >= self.flush_rows or now - self._last_flush >= self.flush_interval:
+                self._flush_locked(now)
+
+    def flush(self):
+        with self._lock:
+            self._flush_locked(time.monotonic())
+
+    def _flush_locked(self, now):
+        self._file.flush()
+        self._pending = 0
+        self._last_flush = now
+
+    def close(self):
+        with self._lock:
+            if not self._file.closed:
+                self._file.flush()
+                self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
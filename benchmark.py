@@ -0,0 +1,263 @@
+import argparse
+import json
+import os
+import platform
+import shutil
+import subprocess
+import sys
+import time
+from datetime import datetime
+from pathlib import Path
+
+from make_test_cohort import generate_cohort
+
+# benchmark.py
+#
+# Purpose:
+#   Time deid_tool.py (pre-scan and processing phases) and
+#   remove_999_dose_reports.py on synthetic cohorts from make_test_cohort.py,
+#   at several cohort sizes and worker counts, and write the results as JSON.
+#
+#   Every run starts from an empty output directory, so header caches and
+#   --resume state from an earlier run never help. Each result is keyed by
+#   (tool, patients, workers); --compare prints the change against an
+#   earlier results file, e.g. one written on the previous version.
+#   --latency-ms runs both tools under latency_shim.py, so cohort and output
+#   behave like network storage with that round-trip time.
+
+SCRIPT_DIR = Path(__file__).resolve().parent
+DEID_SCRIPT = SCRIPT_DIR / "deid_tool.py"
+CLEANUP_SCRIPT = SCRIPT_DIR / "remove_999_dose_reports.py"
+LATENCY_SHIM = SCRIPT_DIR / "latency_shim.py"
+
+STDERR_TAIL = 2000
+
+
+def _int_list(value):
+    return [int(part) for part in value.split(",") if part.strip()]
+
+
+def _git_commit():
+    try:
+        result = subprocess.run(
+            ["git", "rev-parse", "HEAD"], cwd=SCRIPT_DIR, capture_output=True, text=True, check=True
+        )
+        return result.stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def _script_cmd(script, latency_ms, roots):
+    """Command prefix running script directly, or under latency_shim.py when latency_ms is set."""
+    if not latency_ms:
+        return [sys.executable, str(script)]
+    cmd = [sys.executable, str(LATENCY_SHIM), "--latency-ms", str(latency_ms)]
+    for root in roots:
+        cmd += ["--root", str(root)]
+    return cmd + [str(script)]
+
+
+def _run(cmd):
+    """Run cmd with output captured. Returns (wall seconds, CompletedProcess)."""
+    t0 = time.perf_counter()
+    result = subprocess.run(cmd, capture_output=True, text=True)
+    return time.perf_counter() - t0, result
+
+
+def _result_row(tool, patients, workers, repeat, files, wall_seconds, proc):
+    row = {
+        "tool": tool,
+        "patients": patients,
+        "workers": workers,
+        "repeat": repeat,
+        "files": files,
+        "wall_seconds": wall_seconds,
+        "files_per_second": files / wall_seconds if wall_seconds > 0 else None,
+        "returncode": proc.returncode,
+    }
+    if proc.returncode != 0:
+        row["stderr"] = proc.stderr[-STDERR_TAIL:]
+    return row
+
+
+def run_deid(cohort, output, workers, metrics_path, io_threads=0, latency_ms=0):
+    cmd = _script_cmd(DEID_SCRIPT, latency_ms, [cohort["input"], output]) + [
+        "--csv", str(cohort["csv"]),
+        "--input", str(cohort["input"]),
+        "--output", str(output),
+        "--workers", str(workers),
+        "--no-progress",
+        "--quiet",
+        "--metrics-out", str(metrics_path),
+        "--io-threads", str(io_threads),
+    ]
+    return _run(cmd)
+
+
+def run_cleanup(cohort, output, workers, latency_ms=0):
+    cmd = _script_cmd(CLEANUP_SCRIPT, latency_ms, [cohort["input"], output]) + [
+        "--input", str(cohort["input"]),
+        "--output", str(output),
+        "--workers", str(workers),
+        "--no-progress",
+    ]
+    return _run(cmd)
+
+
+def _deid_metrics(metrics_path):
+    """Phase timings and counters from a deid --metrics-out file ({} if missing)."""
+    try:
+        with open(metrics_path) as f:
+            data = json.load(f)
+    except (OSError, ValueError):
+        return {}
+    gauges = data.get("gauges", {})
+    return {
+        "prescan_seconds": gauges.get("prescan_seconds"),
+        "processing_seconds": gauges.get("processing_seconds"),
+        "peak_rss_bytes": gauges.get("peak_rss_bytes"),
+        "counters": data.get("counters", {}),
+    }
+
+
+def _fresh_dir(path):
+    if path.exists():
+        shutil.rmtree(path)
+    return path
+
+
+def compare(results, baseline_path):
+    """Print wall time per (tool, patients, workers) against an earlier results file (best of repeats)."""
+    with open(baseline_path) as f:
+        baseline = json.load(f)
+
+    def best(rows):
+        times = {}
+        for row in rows:
+            if row.get("returncode") != 0:
+                continue
+            key = (row["tool"], row["patients"], row["workers"])
+            times[key] = min(times.get(key, float("inf")), row["wall_seconds"])
+        return times
+
+    old, new = best(baseline["results"]), best(results["results"])
+    print(f"\n--- Compared with {baseline_path} ({(baseline.get('git_commit') or 'unknown')[:12]}) ---")
+    print(f"{'Tool':<12}{'Patients':>10}{'Workers':>9}{'Before s':>11}{'After s':>10}{'Speedup':>9}")
+    for key in sorted(new):
+        if key not in old:
+            continue
+        tool, patients, workers = key
+        speedup = old[key] / new[key] if new[key] > 0 else float("inf")
+        print(f"{tool:<12}{patients:>10}{workers:>9}{old[key]:>11.2f}{new[key]:>10.2f}{speedup:>8.2f}x")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark deid_tool.py and remove_999_dose_reports.py on synthetic cohorts")
+    parser.add_argument("--sizes", type=_int_list, default=[5, 20], help="Comma-separated patient counts (default: 5,20)")
+    parser.add_argument("--workers", type=_int_list, default=[1, 4], help="Comma-separated worker counts (default: 1,4)")
+    parser.add_argument("--repeat", type=int, default=1, help="Runs per size and worker count")
+    parser.add_argument("--accessions", type=int, default=2, help="Accessions per patient")
+    parser.add_argument("--series", type=int, default=3, help="Image series per accession")
+    parser.add_argument("--instances", type=int, default=5, help="Files per image series")
+    parser.add_argument("--frames", type=int, default=8, help="Frames per multi-frame file")
+    parser.add_argument("--seed", type=int, default=0, help="Cohort seed")
+    parser.add_argument("--work-dir", default="./benchmark_work", help="Scratch directory for cohorts and outputs")
+    parser.add_argument("--keep", action="store_true", help="Keep the scratch directory afterwards")
+    parser.add_argument("--output", default="./benchmark_results.json", help="Where to write the JSON results")
+    parser.add_argument("--compare", help="Earlier results JSON to compare against")
+    parser.add_argument("--io-threads", type=int, default=0, help="Pass --io-threads to deid_tool.py (default: 0 = off)")
+    parser.add_argument(
+        "--latency-ms", type=float, default=0, help="Simulated storage round trip per file open/close (default: 0 = none)"
+    )
+    parser.add_argument(
+        "--skip", choices=["deid", "cleanup"], action="append", default=[], help="Skip one of the tools (repeatable)"
+    )
+    args = parser.parse_args()
+    if args.repeat < 1 or not args.sizes or not args.workers:
+        parser.error("--repeat must be >= 1 and --sizes/--workers must not be empty")
+    if args.io_threads < 0 or args.latency_ms < 0:
+        parser.error("--io-threads and --latency-ms must be >= 0")
+
+    work_dir = Path(args.work_dir)
+    results = {
+        "created": datetime.now().isoformat(timespec="seconds"),
+        "git_commit": _git_commit(),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "cpu_count": os.cpu_count(),
+        "parameters": {
+            "sizes": args.sizes,
+            "workers": args.workers,
+            "repeat": args.repeat,
+            "accessions": args.accessions,
+            "series": args.series,
+            "instances": args.instances,
+            "frames": args.frames,
+            "seed": args.seed,
+            "io_threads": args.io_threads,
+            "latency_ms": args.latency_ms,
+        },
+        "cohorts": [],
+        "results": [],
+    }
+
+    try:
+        for patients in args.sizes:
+            size_dir = _fresh_dir(work_dir / f"patients_{patients}")
+            cohort = {"input": size_dir / "raw_input", "csv": size_dir / "mapping.csv"}
+            print(f"Generating cohort: {patients} patients ...", flush=True)
+            t0 = time.perf_counter()
+            summary = generate_cohort(
+                cohort["input"],
+                cohort["csv"],
+                patients,
+                accessions=args.accessions,
+                series=args.series,
+                instances=args.instances,
+                frames=args.frames,
+                seed=args.seed,
+            )
+            summary["generate_seconds"] = time.perf_counter() - t0
+            results["cohorts"].append(summary)
+            files = summary["files"]
+
+            for workers in args.workers:
+                for repeat in range(args.repeat):
+                    if "deid" not in args.skip:
+                        output = _fresh_dir(size_dir / "deid_output")
+                        metrics_path = size_dir / "deid_metrics.json"
+                        wall, proc = run_deid(
+                            cohort, output, workers, metrics_path, io_threads=args.io_threads, latency_ms=args.latency_ms
+                        )
+                        row = _result_row("deid_tool", patients, workers, repeat, files, wall, proc)
+                        row.update(_deid_metrics(metrics_path))
+                        results["results"].append(row)
+                        print(
+                            f"  deid_tool   patients={patients:<6} workers={workers:<3} {wall:8.2f} s"
+                            f"  (pre-scan {row.get('prescan_seconds') or 0:.2f} s,"
+                            f" processing {row.get('processing_seconds') or 0:.2f} s)"
+                            + ("" if proc.returncode == 0 else f"  FAILED ({proc.returncode})"),
+                            flush=True,
+                        )
+                    if "cleanup" not in args.skip:
+                        output = _fresh_dir(size_dir / "cleanup_output")
+                        wall, proc = run_cleanup(cohort, output, workers, latency_ms=args.latency_ms)
+                        results["results"].append(_result_row("remove_999", patients, workers, repeat, files, wall, proc))
+                        print(
+                            f"  remove_999  patients={patients:<6} workers={workers:<3} {wall:8.2f} s"
+                            + ("" if proc.returncode == 0 else f"  FAILED ({proc.returncode})"),
+                            flush=True,
+                        )
+    finally:
+        if not args.keep and work_dir.exists():
+            shutil.rmtree(work_dir)
+
+    with open(args.output, "w") as f:
+        json.dump(results, f, indent=2)
+    print(f"\nResults written to: {args.output}")
+    if args.compare:
+        compare(results, args.compare)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,391 @@
+import argparse
+import hashlib
+import logging
+import os
+import signal
+import sys
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+
+from deid_tool import STATE_DIR_NAME, DeidEngine, log_event, run_plan, setup_logging
+from dicom_walk import iter_tree
+
+# deid_listener.py
+#
+# Purpose:
+#   DICOM C-STORE receiver that de-identifies instances as they arrive, so
+#   data no longer has to be exported from PACS to a folder and walked in
+#   batch. Requires pynetdicom (pip install pynetdicom), which is imported
+#   only when a listener or sender is started.
+#
+#   listen  Accepts C-STOREs (and C-ECHO). Each instance is planned on
+#           arrival with the same mapping lookup, date shift and Series 999
+#           handling as deid_tool.py, then handed to a bounded process pool
+#           that runs process_dicom. The C-STORE is answered as soon as the
+#           instance is queued; when --max-pending instances are already
+#           waiting the answer is 0xA700 (out of resources) so the sender
+#           retries later instead of the association stalling. Unmapped or
+#           unreadable instances are refused with 0xC000; Series 999 dose
+#           reports are accepted and dropped, as in batch runs.
+#
+#           Output goes to <output>/<New_ID>/<New_ID_N>/SER<SeriesNumber>/<name>.dcm.
+#           A C-STORE carries no folder or file name, so below the accession
+#           there is one folder per series instead of the input's own
+#           folders, and <name> is derived from a hash of the original SOP
+#           Instance UID, so a re-sent instance replaces its earlier copy.
+#           Accession numbering and the UID key are saved next to the mapping
+#           CSV (or in --state-dir), never in the output tree, and continued
+#           on restart, so every worker and every restart gives a study the
+#           same new UIDs. The numbering is saved (atomically) as soon as an
+#           accession gets a new number, before that C-STORE is answered, so
+#           a crash never loses the number of a folder already written. Every instance
+#           is recorded in the usual log CSV. Received instances, bytes and
+#           rate are reported per association, and the per-series decisions
+#           of an association are dropped when it ends so a long-running
+#           listener does not accumulate them.
+#
+#   send    Local test SCU: sends every DICOM file under a directory over one
+#           association and reports its throughput, e.g. for the cohorts
+#           from make_test_cohort.py.
+
+logger = logging.getLogger("deid_listener")
+
+DEFAULT_PORT = 11112
+DEFAULT_AE_TITLE = "DEID_SCP"
+
+STATUS_SUCCESS = 0x0000
+STATUS_PROCESSING_FAILURE = 0x0110
+STATUS_OUT_OF_RESOURCES = 0xA700
+STATUS_CANNOT_UNDERSTAND = 0xC000
+
+# A requested association may carry at most 128 presentation contexts
+MAX_REQUESTED_CONTEXTS = 128
+
+
+def _import_pynetdicom():
+    try:
+        import pynetdicom
+    except ImportError:
+        raise SystemExit("deid_listener.py needs pynetdicom: pip install pynetdicom")
+    return pynetdicom
+
+
+def _init_worker():
+    # Ctrl-C and SIGTERM go to the listener, which drains the queue before exiting
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+
+
+def _instance_file_name(sop_instance_uid):
+    """Output file name for an instance; stable across re-sends, without the UID itself."""
+    return hashlib.sha256(str(sop_instance_uid).encode()).hexdigest()[:32] + ".dcm"
+
+
+def _series_dir_name(series_number):
+    try:
+        return f"SER{int(series_number):03d}"
+    except (TypeError, ValueError):
+        return "SER_UNKNOWN"
+
+
+def _failure(source, exc):
+    return {'outcome': 'fail', 'log_data': {'file': source, 'mrn': 'ERR', 'id': 'ERR', 'offset': 'ERR', 'status': f"ERROR: {exc}"}}
+
+
+def _rate_line(label, count, nbytes, seconds):
+    seconds = max(seconds, 1e-9)
+    return (
+        f"{label}: {count} instances, {nbytes / 1e6:.1f} MB in {seconds:.2f} s "
+        f"({count / seconds:.1f} instances/s, {nbytes / 1e6 / seconds:.1f} MB/s)"
+    )
+
+
+class AssociationStats:
+    """Instances, bytes and series received on one association."""
+
+    __slots__ = ("peer", "started", "instances", "bytes", "refused", "series")
+
+    def __init__(self, peer):
+        self.peer = peer
+        self.started = time.time()
+        self.instances = 0
+        self.bytes = 0
+        self.refused = 0
+        self.series = set()
+
+
+class DeidListener:
+    """C-STORE SCP that plans each instance on arrival and de-identifies it in a bounded worker pool."""
+
+    def __init__(self, engine, output_root, workers=1, max_pending=64):
+        if workers < 1 or max_pending < 1:
+            raise ValueError("workers and max_pending must be >= 1")
+        self.engine = engine
+        self.output_root = Path(output_root)
+        self.output_root.mkdir(parents=True, exist_ok=True)
+        # Continue accession numbering from earlier runs into this output root
+        self.level2_map = engine.load_state(self.output_root)
+        self._saved_accession_count = len(engine.accession_map)
+        self._save_lock = threading.Lock()
+
+        self.max_pending = max_pending
+        self.executor = ProcessPoolExecutor(max_workers=workers, initializer=_init_worker)
+        self.log = setup_logging(self.output_root)
+        self.stats = {"received": 0, "refused_busy": 0, "success": 0, "fail": 0, "skipped_999_dose_reports": 0}
+        self._pending = 0
+        self._lock = threading.Lock()
+        self._associations = {}
+
+    def handlers(self):
+        evt = _import_pynetdicom().evt
+        return [
+            (evt.EVT_C_STORE, self.on_c_store),
+            (evt.EVT_ESTABLISHED, self.on_established),
+            (evt.EVT_RELEASED, self.on_closed),
+            (evt.EVT_ABORTED, self.on_closed),
+        ]
+
+    def on_established(self, event):
+        requestor = event.assoc.requestor
+        peer = f"{requestor.ae_title}@{requestor.address}:{requestor.port}"
+        with self._lock:
+            self._associations[event.assoc] = AssociationStats(peer)
+
+    def on_closed(self, event):
+        with self._lock:
+            assoc_stats = self._associations.pop(event.assoc, None)
+            if assoc_stats is not None:
+                still_open = set().union(*(other.series for other in self._associations.values()))
+        if assoc_stats is None:
+            return
+        # Series still arriving on another association keep their decisions
+        self.engine.forget_series(assoc_stats.series - still_open)
+        line = _rate_line(f"Association {assoc_stats.peer}", assoc_stats.instances, assoc_stats.bytes, time.time() - assoc_stats.started)
+        if assoc_stats.refused:
+            line += f", {assoc_stats.refused} refused (busy)"
+        logger.info(line)
+        self.save_numbering()
+
+    def on_c_store(self, event):
+        with self._lock:
+            assoc_stats = self._associations.get(event.assoc)
+            if self._pending >= self.max_pending:
+                self.stats["refused_busy"] += 1
+                if assoc_stats is not None:
+                    assoc_stats.refused += 1
+                return STATUS_OUT_OF_RESOURCES
+            self._pending += 1
+            self.stats["received"] += 1
+            if assoc_stats is not None:
+                assoc_stats.instances += 1
+                assoc_stats.bytes += len(event.request.DataSet.getbuffer())
+
+        source = f"{event.assoc.requestor.ae_title}/{event.request.AffectedSOPInstanceUID}"
+        try:
+            ds = event.dataset
+            ds.file_meta = event.file_meta
+            # Received datasets have no preamble; without one the written file lacks the DICM prefix
+            ds.preamble = b"\x00" * 128
+        except Exception as e:
+            self._record(source, None, _failure(source, e))
+            return STATUS_CANNOT_UNDERSTAND
+
+        # Every path below records the instance exactly once, which releases its pending slot
+        try:
+            plan = self.engine.plan_dataset(Path(source), ds)
+            if plan['series_key'] is not None and assoc_stats is not None:
+                with self._lock:
+                    assoc_stats.series.add(plan['series_key'])
+            if len(self.engine.accession_map) != self._saved_accession_count:
+                # A new accession number: on disk before the instance is acknowledged
+                self.save_numbering()
+            if plan['skip_reason']:
+                # Unmapped (refused) or Series 999 (accepted and dropped): nothing to hand to the pool
+                future, result = None, run_plan(plan)
+            else:
+                plan['target_path'] = (
+                    self.output_root / plan['new_id'] / plan['new_accession']
+                    / _series_dir_name(ds.get('SeriesNumber')) / _instance_file_name(ds.SOPInstanceUID)
+                )
+                future = self.executor.submit(run_plan, plan, ds)
+        except Exception as e:
+            # e.g. BrokenProcessPool after a worker died
+            self._record(source, None, _failure(source, e))
+            return STATUS_PROCESSING_FAILURE
+
+        if future is None:
+            self._record(source, plan, result)
+            return STATUS_SUCCESS if result['outcome'] == 'skipped_999_dose_reports' else STATUS_CANNOT_UNDERSTAND
+        future.add_done_callback(lambda f: self._finished(source, plan, f))
+        return STATUS_SUCCESS
+
+    def _finished(self, source, plan, future):
+        try:
+            result = future.result()
+        except Exception as e:
+            result = _failure(source, e)
+        self._record(source, plan, result)
+
+    def _record(self, source, plan, result):
+        """Log one instance's outcome and release its pending slot."""
+        log_data = dict(result['log_data'], file=source)
+        log_event(self.log, log_data)
+        if result['outcome'] == 'fail':
+            logger.warning("  %s: %s", source, log_data['status'])
+        with self._lock:
+            self.stats[result['outcome']] += 1
+            self._pending -= 1
+
+    def save_numbering(self):
+        with self._save_lock:
+            # Taken before saving, so it never counts an accession the file lacks
+            numbered = len(self.engine.accession_map)
+            self.engine.save_state(self.output_root, self.level2_map)
+            self._saved_accession_count = numbered
+
+    def close(self):
+        self.executor.shutdown(wait=True)
+        self.save_numbering()
+        self.log.close()
+
+
+def start_server(listener, host="", port=DEFAULT_PORT, ae_title=DEFAULT_AE_TITLE, max_associations=10):
+    """Start a non-blocking C-STORE/C-ECHO server for listener; stop it with server.shutdown()."""
+    pynetdicom = _import_pynetdicom()
+    from pynetdicom.sop_class import Verification
+
+    ae = pynetdicom.AE(ae_title=ae_title)
+    ae.maximum_associations = max_associations
+    for context in pynetdicom.AllStoragePresentationContexts:
+        ae.add_supported_context(context.abstract_syntax, pynetdicom.ALL_TRANSFER_SYNTAXES)
+    ae.add_supported_context(Verification)
+    return ae.start_server((host, port), block=False, evt_handlers=listener.handlers())
+
+
+def listen(args):
+    engine = DeidEngine(args.csv, state_dir=args.state_dir)
+    listener = DeidListener(engine, args.output, workers=args.workers, max_pending=args.max_pending)
+
+    def stop(signum, frame):
+        raise KeyboardInterrupt
+
+    signal.signal(signal.SIGTERM, stop)
+    start_time = time.time()
+    server = start_server(listener, args.host, args.port, args.ae_title, args.max_associations)
+    logger.info(
+        "Listening as %s on %s:%d (%d workers, up to %d pending)",
+        args.ae_title, args.host or '*', args.port, args.workers, args.max_pending,
+    )
+    logger.info("Output Directory: %s", args.output)
+    logger.info("Log File: %s", listener.log.path)
+    try:
+        while True:
+            time.sleep(1)
+    except KeyboardInterrupt:
+        logger.info("Shutting down; finishing queued instances ...")
+    finally:
+        server.shutdown()
+        listener.close()
+
+    stats = listener.stats
+    logger.info("\n--- Listener Summary ---")
+    logger.info("Uptime:             %.2f seconds", time.time() - start_time)
+    logger.info("Instances Received: %d", stats['received'])
+    logger.info("Refused (busy):     %d", stats['refused_busy'])
+    logger.info("Files Processed:    %d", stats['success'])
+    logger.info("Files Failed:       %d", stats['fail'])
+    logger.info("Files Skipped 999:  %d", stats['skipped_999_dose_reports'])
+    logger.info("------------------------")
+
+
+def send(args):
+    """Send every DICOM file under args.input over one association (local test SCU)."""
+    pynetdicom = _import_pynetdicom()
+    import pydicom
+
+    files = [entry.path for entry in iter_tree(args.input, with_stat=False) if entry.is_dicom]
+    contexts = []
+    for path in files:
+        meta = pydicom.dcmread(path, stop_before_pixels=True, specific_tags=["SOPClassUID"]).file_meta
+        context = (meta.MediaStorageSOPClassUID, meta.TransferSyntaxUID)
+        if context not in contexts:
+            contexts.append(context)
+    if len(contexts) > MAX_REQUESTED_CONTEXTS:
+        raise SystemExit(f"{len(contexts)} SOP class/transfer syntax combinations; one association allows {MAX_REQUESTED_CONTEXTS}")
+
+    ae = pynetdicom.AE(ae_title=args.ae_title)
+    for abstract_syntax, transfer_syntax in contexts:
+        ae.add_requested_context(abstract_syntax, transfer_syntax)
+    assoc = ae.associate(args.host, args.port, ae_title=args.called_ae_title)
+    if not assoc.is_established:
+        raise SystemExit(f"Association with {args.called_ae_title}@{args.host}:{args.port} was not established")
+
+    statuses = {}
+    nbytes = 0
+    start = time.time()
+    try:
+        for path in files:
+            status = assoc.send_c_store(path)
+            code = status.Status if status else None
+            statuses[code] = statuses.get(code, 0) + 1
+            nbytes += os.path.getsize(path)
+    finally:
+        assoc.release()
+    print(_rate_line(f"Sent to {args.called_ae_title}@{args.host}:{args.port}", len(files), nbytes, time.time() - start))
+    for code, count in sorted(statuses.items(), key=lambda item: (item[0] is None, item[0] or 0)):
+        label = "no response" if code is None else f"0x{code:04X}"
+        print(f"  Status {label}: {count}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Receive DICOM over the network and de-identify it on arrival")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    listen_parser = commands.add_parser("listen", help="Run the C-STORE receiver")
+    listen_parser.add_argument("--csv", required=True, help="Path to the patient mapping CSV")
+    listen_parser.add_argument("--output", required=True, help="Target directory for de-identified data")
+    listen_parser.add_argument(
+        "--state-dir",
+        help=f"Folder for the accession numbering and UID key (default: {STATE_DIR_NAME}/<output name>_<hash> next to --csv)",
+    )
+    listen_parser.add_argument("--host", default="", help="Address to listen on (default: all)")
+    listen_parser.add_argument("--port", type=int, default=DEFAULT_PORT, help=f"Port to listen on (default: {DEFAULT_PORT})")
+    listen_parser.add_argument("--ae-title", default=DEFAULT_AE_TITLE, help=f"AE title of the receiver (default: {DEFAULT_AE_TITLE})")
+    listen_parser.add_argument(
+        "--workers",
+        type=int,
+        default=max(1, os.cpu_count() or 1),
+        help="Worker processes that de-identify received instances (default: CPU count)",
+    )
+    listen_parser.add_argument(
+        "--max-pending",
+        type=int,
+        default=64,
+        help="Instances allowed to wait for a worker before C-STOREs are answered 0xA700 (default: 64)",
+    )
+    listen_parser.add_argument("--max-associations", type=int, default=10, help="Concurrent associations (default: 10)")
+
+    send_parser = commands.add_parser("send", help="Send a directory of DICOM files to a receiver (for local testing)")
+    send_parser.add_argument("--input", required=True, help="Directory of DICOM files to send")
+    send_parser.add_argument("--host", default="127.0.0.1", help="Receiver address (default: 127.0.0.1)")
+    send_parser.add_argument("--port", type=int, default=DEFAULT_PORT, help=f"Receiver port (default: {DEFAULT_PORT})")
+    send_parser.add_argument("--ae-title", default="DEID_SCU", help="Calling AE title (default: DEID_SCU)")
+    send_parser.add_argument("--called-ae-title", default=DEFAULT_AE_TITLE, help=f"Receiver AE title (default: {DEFAULT_AE_TITLE})")
+    args = parser.parse_args()
+
+    handler = logging.StreamHandler(sys.stdout)
+    handler.setFormatter(logging.Formatter("%(message)s"))
+    logger.addHandler(handler)
+    logger.setLevel(logging.INFO)
+    logger.propagate = False
+
+    if args.command == "listen":
+        listen(args)
+    else:
+        send(args)
+
+
+if __name__ == "__main__":
+    main()
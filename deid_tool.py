@@ -1,31 +1,194 @@
 import os
 import argparse
-import pandas as pd
-import pydicom
+import csv
+import hashlib
+import io
+import json
+import logging
+import secrets
+import struct
+import sys
+import threading
 import time
+from collections import deque
+from concurrent.futures import Future, ProcessPoolExecutor, ThreadPoolExecutor
 from datetime import datetime, timedelta
 from pathlib import Path
-from dicomanonymizer import anonymize_dataset
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+# pydicom, dicomanonymizer (via anonymization_plan) and pandas are imported
+# where they are first needed, so importing this module and building a
+# DeidEngine stay fast for short runs.
+from audit_log import AuditLogWriter
+from dicom_walk import FileEntry, is_dicom_name, scan_tree
+from header_index import INDEX_NAME, INDEXED_TAGS, HeaderIndex, HeaderRecord
+from run_metrics import RunMetrics
+
+logger = logging.getLogger("deid_tool")
+
+# Console level between INFO and DEBUG for one-line-per-file output (--verbose).
+VERBOSE = 15
+logging.addLevelName(VERBOSE, "VERBOSE")
+
+# Tags the pre-scan needs; everything else (including PixelData) is skipped.
+PRESCAN_TAGS = INDEXED_TAGS
 
 def setup_logging(output_root):
     log_file = Path(output_root) / f"deid_log_{datetime.now().strftime('%Y%m%d_%H%M%S')}.csv"
-    with open(log_file, 'w') as f:
-        f.write("Timestamp,Original_File,MRN,New_ID,Calculated_Offset_Days,Status\n")
-    return log_file
+    return AuditLogWriter(log_file, ["Original_File", "MRN", "New_ID", "Calculated_Offset_Days", "Status"])
+
+def log_event(log, data):
+    log.write([data['file'], data['mrn'], data['id'], data['offset'], data['status']])
+
+SERIES_LOG_COLUMNS = [
+    "Study_UID", "Series_UID", "Series_Number", "MRN", "New_ID", "New_Accession",
+    "Calculated_Offset_Days", "Files", "Succeeded", "Failed", "Skipped_999", "Inconsistent_Files", "Status",
+]
+
+def setup_series_logging(output_root):
+    log_file = Path(output_root) / f"deid_series_log_{datetime.now().strftime('%Y%m%d_%H%M%S')}.csv"
+    return AuditLogWriter(log_file, SERIES_LOG_COLUMNS)
+
+def log_series(series_log, series):
+    """Write one per-series summary row (see _plan_for_instance for the series dict)."""
+    study_uid, series_uid = series['key']
+    values = dict(zip(SERIES_CONSISTENCY_TAGS, series['values']))
+    plan = series['plan'] or {}
+    outcomes = series['outcomes']
+    if series['error']:
+        status = f"ERROR: {series['error']}"
+    elif plan.get('skip_reason'):
+        status = f"SKIPPED: {plan['skip_reason']}"
+    elif series['inconsistent']:
+        status = "INCONSISTENT"
+    elif outcomes['fail']:
+        status = "PARTIAL" if outcomes['success'] else "FAILED"
+    else:
+        status = "SUCCESS"
+    series_log.write([
+        study_uid, series_uid, values['SeriesNumber'], plan.get('mrn'), plan.get('new_id'), plan.get('new_accession'),
+        plan.get('days_offset'), series['files'], outcomes['success'], outcomes['fail'],
+        outcomes['skipped_999_dose_reports'], series['inconsistent'], status,
+    ])
+
+# Resumable runs: the output root keeps a manifest of every input handled
+# (appended across runs). The accession/level-2 numbering and the UID key are
+# kept out of the output tree, in a state folder per output root that by
+# default sits next to the mapping CSV (see default_state_dir).
+MANIFEST_NAME = "deid_manifest.csv"
+NUMBERING_NAME = "deid_numbering.json"
+STATE_DIR_NAME = "deid_state"
+MANIFEST_COLUMNS = ["Input_File", "Size", "Mtime_NS", "SHA256", "Output_File", "Status"]
+# Statuses that mean "nothing left to do" for an unchanged input
+MANIFEST_DONE_STATUSES = {"SUCCESS", "SKIPPED: SERIES_999_DOSE_REPORT"}
+
+def open_manifest(output_root):
+    return AuditLogWriter(Path(output_root) / MANIFEST_NAME, MANIFEST_COLUMNS, append=True)
+
+def load_manifest(output_root):
+    """Return {input path relative to the input root: latest manifest row}."""
+    manifest_path = Path(output_root) / MANIFEST_NAME
+    entries = {}
+    if not manifest_path.exists():
+        return entries
+    with open(manifest_path, newline='', encoding='utf-8') as f:
+        for row in csv.DictReader(f):
+            entries[row['Input_File']] = row
+    return entries
+
+def _file_sha256(path):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+def _is_unchanged(entry, size, mtime_ns, raw_path, output_root, use_hash):
+    """True if a manifest entry shows this input was already handled and has not changed since."""
+    if entry is None or entry['Status'] not in MANIFEST_DONE_STATUSES:
+        return False
+    if entry['Output_File'] and not (Path(output_root) / entry['Output_File']).exists():
+        return False
+    if entry['Size'] == str(size) and entry['Mtime_NS'] == str(mtime_ns):
+        return True
+    # Touched or copied but possibly identical content
+    return bool(use_hash and entry['SHA256'] and entry['SHA256'] == _file_sha256(raw_path))
+
+def default_state_dir(csv_path, output_root):
+    """deid_state/<output folder name>_<hash of its full path> next to the mapping CSV."""
+    output_root = Path(os.path.abspath(output_root))
+    digest = hashlib.sha256(str(output_root).encode()).hexdigest()[:8]
+    return Path(os.path.abspath(csv_path)).parent / STATE_DIR_NAME / f"{output_root.name}_{digest}"
+
+def save_numbering(state_dir, accession_map, patient_accession_count, level2_map, uid_key=None):
+    state_dir = Path(state_dir)
+    state_dir.mkdir(parents=True, exist_ok=True)
+    numbering_path = state_dir / NUMBERING_NAME
+    state = {
+        'accession_map': [[new_id, accession, value] for (new_id, accession), value in accession_map.items()],
+        'patient_accession_count': patient_accession_count,
+        'level2_map': [[top_level, child, idx] for (top_level, child), idx in level2_map.items()],
+        # Secret behind the replacement UIDs: keep it with the mapping CSV, never with the images
+        'uid_key': uid_key,
+    }
+    tmp_path = numbering_path.with_name(numbering_path.name + ".tmp")
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        json.dump(state, f)
+    os.replace(tmp_path, numbering_path)
+
+def load_numbering(state_dir):
+    """
+    Return (accession_map, patient_accession_count, level2_map, uid_key) saved
+    by a previous run; uid_key is None for numbering saved before UIDs were keyed.
+    """
+    numbering_path = Path(state_dir) / NUMBERING_NAME
+    if not numbering_path.exists():
+        return {}, {}, {}, None
+    with open(numbering_path, encoding='utf-8') as f:
+        state = json.load(f)
+    accession_map = {(new_id, accession): value for new_id, accession, value in state['accession_map']}
+    level2_map = {(top_level, child): idx for top_level, child, idx in state['level2_map']}
+    return accession_map, dict(state['patient_accession_count']), level2_map, state.get('uid_key')
+
+def _merge_level2_map(saved, current):
+    """
+    Keep previously assigned level-2 indices; number new children (the
+    (top_level_dir, child_dir) keys of current) after them in sorted order.
+    """
+    merged = dict(saved)
+    next_idx = {}
+    for (top_level, _), idx in saved.items():
+        next_idx[top_level] = max(next_idx.get(top_level, 0), idx)
+    for key in sorted(current):
+        if key not in merged:
+            next_idx[key[0]] = next_idx.get(key[0], 0) + 1
+            merged[key] = next_idx[key[0]]
+    return merged
 
-def log_event(log_path, data):
-    with open(log_path, 'a') as f:
-        f.write(f"{datetime.now().isoformat()},{data['file']},{data['mrn']},{data['id']},{data['offset']},{data['status']}\n")
+class PatientRecord:
+    """Per-patient values resolved once from a mapping CSV row."""
+    __slots__ = ("new_id", "surgery_date", "anchor_date", "notes", "csv_row")
 
-def _get_column_case_insensitive(row, col_name):
+    def __init__(self, new_id, surgery_date, anchor_date, notes, csv_row):
+        self.new_id = new_id
+        self.surgery_date = surgery_date
+        self.anchor_date = anchor_date
+        self.notes = notes
+        self.csv_row = csv_row
+
+def _find_column_case_insensitive(columns, col_name):
     """
-    Get a value from a pandas Series (row), matching column name case-insensitively.
-    Returns the value if found, None otherwise.
+    Find a column name in columns, matching case-insensitively.
+    Returns the actual column name if found, None otherwise.
     """
     col_lower = col_name.lower()
-    for col in row.index:
+    for col in columns:
         if col.lower() == col_lower:
-            return row[col]
+            return col
     return None
 
 def _clean_string(value):
@@ -51,57 +214,234 @@ def _is_999_dose_report(ds):
     series_number = _normalize_value(getattr(ds, "SeriesNumber", None))
     return series_number == "999"
 
-def _match_column(mapping_df, column, value):
-    if value is None or column not in mapping_df.columns:
-        return None
-    mask = mapping_df[column].astype(str).str.strip() == value
-    return mask if mask.any() else None
+def _read_header(path, tags=None):
+    """
+    Read only the DICOM header, stopping before PixelData.
+    If tags is given, only those elements are parsed.
+    Returns (dataset, bytes_read).
+    """
+    import pydicom
+
+    with open(path, 'rb') as f:
+        ds = pydicom.dcmread(f, stop_before_pixels=True, specific_tags=tags)
+        return ds, f.tell()
+
+# Cells read as missing, as pandas.read_csv does by default
+MAPPING_NA_VALUES = {
+    '', '#N/A', '#N/A N/A', '#NA', '-1.#IND', '-1.#QNAN', '-NaN', '-nan', '1.#IND', '1.#QNAN',
+    '<NA>', 'N/A', 'NA', 'NULL', 'NaN', 'None', 'n/a', 'nan', 'null',
+}
+# Date formats tried after ISO 8601; anything else is handed to pandas
+MAPPING_DATE_FORMATS = ['%m/%d/%Y', '%Y/%m/%d', '%m/%d/%y', '%m-%d-%Y']
+
+class MappingTable:
+    """Mapping CSV contents: stripped column names and rows of str cells (None when missing)."""
+    __slots__ = ("columns", "rows")
+
+    def __init__(self, columns, rows):
+        self.columns = columns
+        self.rows = rows
+
+    def column(self, name):
+        idx = self.columns.index(name)
+        return [row[idx] for row in self.rows]
+
+def _unique_columns(names):
+    """Strip column names and suffix duplicates with .1, .2, ... like pandas."""
+    seen = {}
+    columns = []
+    for name in names:
+        name = name.strip()
+        if name in seen:
+            seen[name] += 1
+            name = f"{name}.{seen[name]}"
+        else:
+            seen[name] = 0
+        columns.append(name)
+    return columns
+
+def load_mapping(source):
+    """
+    Load the mapping as a MappingTable. source is a CSV path (read with the
+    csv module; cells stay strings, so IDs keep leading zeros) or an already
+    loaded pandas DataFrame.
+    """
+    if hasattr(source, 'columns') and hasattr(source, 'itertuples'):
+        import pandas as pd
+
+        rows = [
+            [None if pd.isnull(value) else str(value) for value in row]
+            for row in source.itertuples(index=False, name=None)
+        ]
+        return MappingTable(_unique_columns(str(col) for col in source.columns), rows)
 
-def _find_mapping_row(mapping_df, mrn_value, accession_value):
-    columns = list(mapping_df.columns)
+    with open(source, newline='', encoding='utf-8-sig') as f:
+        reader = csv.reader(f)
+        header = next(reader, None)
+        if header is None:
+            raise ValueError(f"Mapping CSV {source} is empty")
+        columns = _unique_columns(header)
+        rows = []
+        for row in reader:
+            if not row:
+                # Blank lines are skipped and do not count as CSV rows
+                continue
+            row = row[:len(columns)] + [''] * (len(columns) - len(row))
+            rows.append([None if cell in MAPPING_NA_VALUES else cell for cell in row])
+    return MappingTable(columns, rows)
+
+def _parse_mapping_date(value):
+    value = value.strip()
+    try:
+        return datetime.fromisoformat(value)
+    except ValueError:
+        pass
+    for fmt in MAPPING_DATE_FORMATS:
+        try:
+            return datetime.strptime(value, fmt)
+        except ValueError:
+            continue
+    # Unusual formats ("Jan 10 2025", ...)
+    import pandas as pd
+
+    return pd.to_datetime(value).to_pydatetime()
+
+def _compile_patient_records(mapping):
+    """
+    Resolve New_Patient_ID, Surgery_Date, Anchor_Date and Notes for every CSV row.
+    Returns a list of PatientRecord aligned with the MappingTable rows.
+    Missing columns, empty IDs and unparseable dates raise ValueError here,
+    naming the CSV row (1-based, header is row 1), instead of failing per file.
+    """
+    columns = mapping.columns
+    new_id_col = _find_column_case_insensitive(columns, 'New_Patient_ID')
+    if new_id_col is None:
+        raise ValueError(f"Column 'New_Patient_ID' not found in CSV. Available columns: {columns}")
+    surgery_col = _find_column_case_insensitive(columns, 'Surgery_Date')
+    if surgery_col is None:
+        raise ValueError(f"Column 'Surgery_Date' not found in CSV. Available columns: {columns}")
+    anchor_col = _find_column_case_insensitive(columns, 'Anchor_Date')
+    notes_col = _find_column_case_insensitive(columns, 'Notes')
+
+    records = []
+    for pos, values in enumerate(mapping.rows):
+        row = dict(zip(columns, values))
+        csv_row = pos + 2
+        new_id = _clean_string(row[new_id_col])
+        if not new_id:
+            raise ValueError(f"CSV row {csv_row}: New_Patient_ID is empty")
+
+        surgery_val = row[surgery_col]
+        if surgery_val is None:
+            raise ValueError(f"CSV row {csv_row}: Surgery_Date is empty")
+        try:
+            surgery_date = _parse_mapping_date(surgery_val)
+        except (ValueError, TypeError) as e:
+            raise ValueError(f"CSV row {csv_row}: invalid Surgery_Date '{surgery_val}': {e}")
+
+        # Anchor_Date is optional and defaults to June 15, 2024
+        anchor_val = row[anchor_col] if anchor_col else None
+        try:
+            anchor_date = _parse_mapping_date(anchor_val) if anchor_val is not None else datetime(2024, 6, 15)
+        except (ValueError, TypeError) as e:
+            raise ValueError(f"CSV row {csv_row}: invalid Anchor_Date '{anchor_val}': {e}")
+
+        notes = row[notes_col] if notes_col else None
+        notes = notes.strip() if notes is not None else ''
+
+        records.append(PatientRecord(new_id, surgery_date, anchor_date, notes, csv_row))
+    return records
+
+def _build_mapping_index(mapping):
+    """
+    Build the MRN/Accession lookup index once when the mapping CSV is loaded.
+    Each candidate column gets a dict of stripped cell value -> first row position
+    into index['records'] (see _compile_patient_records),
+    so per-file lookups are hash hits instead of full column scans.
+    Duplicate keys whose rows disagree on anything but the key columns are
+    collected in index['ambiguous'] so they can be reported at load time.
+    """
+    columns = mapping.columns
     if len(columns) < 2:
         raise ValueError("Mapping CSV must have at least two columns for MRN/Accession lookup")
 
-    mrn_value = _normalize_value(mrn_value)
-    accession_value = _normalize_value(accession_value)
-
     # Identify primary columns (first two), plus any named MRN/Accession columns if present
-    primary_mrn_col = columns[0]
-    primary_acc_col = columns[1]
-
-    mrn_cols = [primary_mrn_col]
-    acc_cols = [primary_acc_col]
+    mrn_cols = [columns[0]]
+    acc_cols = [columns[1]]
 
     for named in ["MRN", "Mrn", "mrn"]:
-        if named in mapping_df.columns and named not in mrn_cols:
+        if named in columns and named not in mrn_cols:
             mrn_cols.append(named)
 
     for named in ["Accession", "AccessionNumber", "Accession_Number", "accession"]:
-        if named in mapping_df.columns and named not in acc_cols:
+        if named in columns and named not in acc_cols:
             acc_cols.append(named)
 
+    key_cols = list(dict.fromkeys(mrn_cols + acc_cols))
+    patient_idx = [idx for idx, col in enumerate(columns) if col not in key_cols]
+    lookup = {}
+    ambiguous = []
+    for col in key_cols:
+        col_index = {}
+        for pos, cell in enumerate(mapping.column(col)):
+            if cell is None:
+                continue
+            key = cell.strip()
+            if key not in col_index:
+                col_index[key] = pos
+                continue
+            if _normalize_value(key) is None:
+                continue
+            first = [mapping.rows[col_index[key]][idx] for idx in patient_idx]
+            other = [mapping.rows[pos][idx] for idx in patient_idx]
+            if first != other:
+                # CSV row numbers are 1-based and include the header line
+                ambiguous.append((col, key, col_index[key] + 2, pos + 2))
+        lookup[col] = col_index
+
+    return {
+        'records': _compile_patient_records(mapping),
+        'mrn_cols': mrn_cols,
+        'acc_cols': acc_cols,
+        'lookup': lookup,
+        'ambiguous': ambiguous,
+    }
+
+def _match_column(mapping_index, column, value):
+    if value is None or column not in mapping_index['lookup']:
+        return None
+    pos = mapping_index['lookup'][column].get(value)
+    return None if pos is None else mapping_index['records'][pos]
+
+def _find_mapping_row(mapping_index, mrn_value, accession_value):
+    """Return (PatientRecord, match_status) using the MRN/Accession fallback order."""
+    mrn_value = _normalize_value(mrn_value)
+    accession_value = _normalize_value(accession_value)
+    mrn_cols = mapping_index['mrn_cols']
+    acc_cols = mapping_index['acc_cols']
+
     # 1) MRN lookup (preferred)
     for col in mrn_cols:
-        mask = _match_column(mapping_df, col, mrn_value)
-        if mask is not None:
-            return mapping_df[mask].iloc[0], f"mrn:{col}"
+        record = _match_column(mapping_index, col, mrn_value)
+        if record is not None:
+            return record, f"mrn:{col}"
 
     # 2) Accession lookup
     for col in acc_cols:
-        mask = _match_column(mapping_df, col, accession_value)
-        if mask is not None:
-            return mapping_df[mask].iloc[0], f"accession:{col}"
+        record = _match_column(mapping_index, col, accession_value)
+        if record is not None:
+            return record, f"accession:{col}"
 
     # 3) Flip and check for swapped values
     for col in acc_cols:
-        mask = _match_column(mapping_df, col, mrn_value)
-        if mask is not None:
-            return mapping_df[mask].iloc[0], f"flipped_mrn_in_accession:{col}"
+        record = _match_column(mapping_index, col, mrn_value)
+        if record is not None:
+            return record, f"flipped_mrn_in_accession:{col}"
 
     for col in mrn_cols:
-        mask = _match_column(mapping_df, col, accession_value)
-        if mask is not None:
-            return mapping_df[mask].iloc[0], f"flipped_accession_in_mrn:{col}"
+        record = _match_column(mapping_index, col, accession_value)
+        if record is not None:
+            return record, f"flipped_accession_in_mrn:{col}"
 
     raise ValueError(
         f"No mapping found for MRN {mrn_value or 'N/A'} or Accession {accession_value or 'N/A'}"
@@ -122,26 +462,26 @@ def _rebuild_directory_path(raw_path, output_root, input_root, mrn, accession, n
     other_sesn_count = {}
     
     # Debug: show the original path structure
-    print(f"      Original path parts: {parts}")
+    logger.debug("      Original path parts: %s", parts)
     mrn_trusted = bool(match_status and match_status.startswith("mrn:"))
-    print(f"      MRN={mrn}, Accession={accession}, new_id={new_id}, match_status={match_status}")
-    print(f"      MRN trusted for dir match: {mrn_trusted}")
-    print(f"      Level-2 map available: {bool(level2_map)}")
+    logger.debug("      MRN=%s, Accession=%s, new_id=%s, match_status=%s", mrn, accession, new_id, match_status)
+    logger.debug("      MRN trusted for dir match: %s", mrn_trusted)
+    logger.debug("      Level-2 map available: %s", bool(level2_map))
     
     for i, part in enumerate(parts):
         original_part = part
-        # Check if this part is the filename (last part with .dcm)
-        if part.lower().endswith('.dcm'):
+        # Check if this part is the filename (last part; PACS exports may have no .dcm extension)
+        if i == len(parts) - 1 or part.lower().endswith('.dcm'):
             new_parts.append(part)
-            print(f"        [{i}] {original_part:20s} → {part:20s} (DICOM file)")
+            logger.debug("        [%d] %-20s → %-20s (DICOM file)", i, original_part, part)
         # Check if part exactly matches MRN
         elif i == 0 and (mrn_trusted and mrn and part == str(mrn)):
             new_parts.append(new_id)
-            print(f"        [{i}] {original_part:20s} → {new_id:20s} (MRN match)")
+            logger.debug("        [%d] %-20s → %-20s (MRN match)", i, original_part, new_id)
         # Top-level patient directory (e.g., underscore name)
         elif i == 0 and '_' in part and any(c.isalpha() for c in part):
             new_parts.append(new_id)
-            print(f"        [{i}] {original_part:20s} → {new_id:20s} (Patient name pattern)")
+            logger.debug("        [%d] %-20s → %-20s (Patient name pattern)", i, original_part, new_id)
         # Second-level: always rename to new_id_N based on level2_map
         elif i == 1 and level2_map and len(parts) > 1:
             top_level = parts[0]
@@ -149,32 +489,33 @@ def _rebuild_directory_path(raw_path, output_root, input_root, mrn, accession, n
             if key in level2_map:
                 mapped_level2 = f"{new_id}_{level2_map[key]}"
                 new_parts.append(mapped_level2)
-                print(f"        [{i}] {original_part:20s} → {mapped_level2:20s} (Level-2 map)")
+                logger.debug("        [%d] %-20s → %-20s (Level-2 map)", i, original_part, mapped_level2)
             else:
                 fallback_level2 = f"{new_id}_1"
                 new_parts.append(fallback_level2)
-                print(f"        [{i}] {original_part:20s} → {fallback_level2:20s} (Level-2 fallback)")
+                logger.debug("        [%d] %-20s → %-20s (Level-2 fallback)", i, original_part, fallback_level2)
         # Check if part is an accession directory (use map if available)
         elif accession and part == str(accession) and accession_map and (new_id, str(accession)) in accession_map:
             mapped_accession = accession_map[(new_id, str(accession))]
             new_parts.append(mapped_accession)
-            print(f"        [{i}] {original_part:20s} → {mapped_accession:20s} (Accession from map)")
+            logger.debug("        [%d] %-20s → %-20s (Accession from map)", i, original_part, mapped_accession)
         # Check if part is accession-like but not in map (fallback)
         elif accession and part == str(accession):
             fallback_accession = f"{new_id}_1"
             new_parts.append(fallback_accession)
-            print(f"        [{i}] {original_part:20s} → {fallback_accession:20s} (Accession fallback)")
+            logger.debug("        [%d] %-20s → %-20s (Accession fallback)", i, original_part, fallback_accession)
         # Check if part looks like a patient name (contains underscores and alphanumerics)
         elif '_' in part and any(c.isalpha() for c in part):
             new_parts.append(new_id)
-            print(f"        [{i}] {original_part:20s} → {new_id:20s} (Patient name pattern)")
+            logger.debug("        [%d] %-20s → %-20s (Patient name pattern)", i, original_part, new_id)
         # Keep all other parts as-is
         else:
             new_parts.append(part)
-            print(f"        [{i}] {original_part:20s} → {part:20s} (preserved as-is)")
+            logger.debug("        [%d] %-20s → %-20s (preserved as-is)", i, original_part, part)
     
     final_path = output_root / Path(*new_parts)
-    print(f"      Final output path: {final_path.relative_to(output_root)}")
+    if logger.isEnabledFor(logging.DEBUG):
+        logger.debug("      Final output path: %s", final_path.relative_to(output_root))
     
     return final_path
 
@@ -212,287 +553,1415 @@ def _build_directory_map(input_root):
     
     return dir_map
 
-def process_dicom(input_path, output_path, mapping_df, log_path, scan_number):
+def _new_file_plan(raw_path, skip_reason=None):
+    return {
+        'input_path': raw_path,
+        'target_path': None,
+        'mrn': None,
+        'accession': None,
+        'match_status': None,
+        'patient': None,
+        'new_id': None,
+        'new_accession': None,
+        'skip_reason': skip_reason,
+        'size': None,
+        'mtime_ns': None,
+        'hash': False,
+        'stream_pixels': False,
+        'uid_key': None,
+        'series_key': None,
+        'series_mismatch': None,
+        'days_offset': None,
+        'shifted_date': None,
+    }
+
+def _build_file_plan(raw_path, ds, mapping_index, accession_map, patient_accession_count):
+    """
+    Build the per-file plan record from a header-only dataset or HeaderRecord.
+    Registers new accessions in accession_map/patient_accession_count as a side effect.
+    The target path is filled in by the caller once the plan is resolved.
+    """
+    plan = _new_file_plan(raw_path)
+    if _is_999_dose_report(ds):
+        plan['skip_reason'] = 'SERIES_999_DOSE_REPORT'
+        return plan
+
+    mrn = _normalize_value(getattr(ds, "PatientID", None))
+    accession = _normalize_value(getattr(ds, "AccessionNumber", None))
+    plan['mrn'] = mrn
+    plan['accession'] = accession
+
+    patient, match_status = _find_mapping_row(mapping_index, mrn, accession)
+    new_id = patient.new_id
+    plan['patient'] = patient
+    plan['match_status'] = match_status
+    plan['new_id'] = new_id
+
+    # Track unique accession directories per patient
+    if accession:
+        key = (new_id, str(accession))
+        if key not in accession_map:
+            patient_accession_count[new_id] = patient_accession_count.get(new_id, 0) + 1
+            accession_map[key] = f"{new_id}_{patient_accession_count[new_id]}"
+
+    new_accession = accession_map.get((new_id, str(accession)), f"{new_id}_1")
+    # Truncate to 16 chars (DICOM SH VR limit)
+    plan['new_accession'] = new_accession[:16]
+    return plan
+
+def _compute_date_shift(patient, study_date_str):
+    """Return (days from surgery, StudyDate projected onto the patient's anchor date as YYYYMMDD)."""
+    study_date_obj = datetime.strptime(study_date_str, '%Y%m%d')
+    days_offset = (study_date_obj - patient.surgery_date).days
+    shifted_date_obj = patient.anchor_date + timedelta(days=days_offset)
+    return days_offset, shifted_date_obj.strftime('%Y%m%d')
+
+# Header values every instance of a series must share for the series'
+# decision (mapping row, date shift, accession, 999 skip) to be reused.
+SERIES_CONSISTENCY_TAGS = ['PatientID', 'AccessionNumber', 'StudyDate', 'SeriesNumber']
+# Plan fields copied from a series' first instance to the rest of the series
+SERIES_PLAN_FIELDS = [
+    'mrn', 'accession', 'match_status', 'patient', 'new_id', 'new_accession',
+    'skip_reason', 'days_offset', 'shifted_date',
+]
+
+# plan_dataset()/process()/deidentify() keep the decisions of at most this
+# many series (least recently used dropped first). An instance of a dropped
+# series is planned afresh: same accession and UIDs, new consistency check.
+MAX_CACHED_SERIES = 4096
+
+def _series_key(header):
+    """(StudyInstanceUID, SeriesInstanceUID) of a header, or None without a series UID."""
+    if not header.SeriesInstanceUID:
+        return None
+    return (header.StudyInstanceUID or '', header.SeriesInstanceUID)
+
+def _plan_for_instance(raw_path, header, series_groups, mapping_index, accession_map, patient_accession_count):
+    """
+    Plan one file, deciding once per (StudyInstanceUID, SeriesInstanceUID).
+    The first instance of a series is planned with _build_file_plan and its
+    decision is reused for later instances that agree with it on
+    SERIES_CONSISTENCY_TAGS. Instances that disagree are counted as
+    inconsistent and planned on their own, with the differing tags in
+    plan['series_mismatch']. A failed lookup is
+    cached too and raised again for the rest of the series.
+    series_groups maps series key -> {'key', 'values', 'plan', 'error',
+    'files', 'inconsistent', 'outcomes'}; files without a SeriesInstanceUID
+    are planned individually.
+    """
+    values = tuple(getattr(header, tag) for tag in SERIES_CONSISTENCY_TAGS)
+    key = _series_key(header)
+    series = series_groups.get(key) if key else None
+    first = False
+    if series is not None:
+        series['files'] += 1
+        if series['values'] == values:
+            if series['error']:
+                raise ValueError(series['error'])
+            plan = _new_file_plan(raw_path)
+            for field in SERIES_PLAN_FIELDS:
+                plan[field] = series['plan'][field]
+            plan['series_key'] = key
+            return plan
+        series['inconsistent'] += 1
+    elif key:
+        first = True
+        series = series_groups[key] = {
+            'key': key,
+            'values': values,
+            'plan': None,
+            'error': None,
+            'files': 1,
+            'inconsistent': 0,
+            'outcomes': {'success': 0, 'fail': 0, 'skipped_999_dose_reports': 0},
+        }
+
     try:
+        plan = _build_file_plan(raw_path, header, mapping_index, accession_map, patient_accession_count)
+    except Exception as e:
+        if first:
+            series['error'] = str(e)
+        raise
+    if plan['patient'] is not None:
+        try:
+            plan['days_offset'], plan['shifted_date'] = _compute_date_shift(plan['patient'], header.StudyDate)
+        except (TypeError, ValueError):
+            # Left to process_dicom, which reports it against the full dataset
+            pass
+    if first:
+        series['plan'] = plan
+    elif series is not None:
+        plan['series_mismatch'] = [tag for tag, a, b in zip(SERIES_CONSISTENCY_TAGS, series['values'], values) if a != b]
+    if series is not None:
+        plan['series_key'] = key
+    return plan
+
+# --stream-pixels: the pixel data element is copied from input to output in
+# chunks of this size instead of being loaded into memory.
+PIXEL_COPY_CHUNK = 1024 * 1024
+_ITEM_TAG = 0xFFFEE000
+_SEQUENCE_DELIMITER_TAG = 0xFFFEE0DD
+# Explicit VR element headers with 2 reserved bytes and a 4-byte length
+_LONG_LENGTH_VRS = {b'OB', b'OD', b'OF', b'OL', b'OV', b'OW', b'SQ', b'SV', b'UC', b'UN', b'UR', b'UT', b'UV'}
+
+def _element_end(f, start, is_implicit_vr, is_little_endian):
+    """
+    Return (tag, end_offset) for the data element starting at byte offset start.
+    Undefined-length (encapsulated) values are walked item by item, reading
+    only the 8-byte item headers.
+    """
+    endian = '<' if is_little_endian else '>'
+    f.seek(start)
+    header = f.read(12)
+    if len(header) < 8:
+        raise EOFError(f"Truncated data element at offset {start}")
+    group, element = struct.unpack(endian + 'HH', header[:4])
+    tag = (group << 16) | element
+    if is_implicit_vr:
+        length = struct.unpack(endian + 'L', header[4:8])[0]
+        value_start = start + 8
+    elif header[4:6] in _LONG_LENGTH_VRS:
+        length = struct.unpack(endian + 'L', header[8:12])[0]
+        value_start = start + 12
+    else:
+        length = struct.unpack(endian + 'H', header[6:8])[0]
+        value_start = start + 8
+    if length != 0xFFFFFFFF:
+        return tag, value_start + length
+
+    pos = value_start
+    while True:
+        f.seek(pos)
+        item = f.read(8)
+        if len(item) < 8:
+            raise EOFError("Encapsulated pixel data has no sequence delimiter")
+        group, element, item_length = struct.unpack(endian + 'HHL', item)
+        pos += 8
+        item_tag = (group << 16) | element
+        if item_tag == _SEQUENCE_DELIMITER_TAG:
+            return tag, pos
+        if item_tag != _ITEM_TAG:
+            raise ValueError(f"Unexpected tag {item_tag:08X} in encapsulated pixel data")
+        pos += item_length
+
+def _read_without_pixels(input_path):
+    """
+    Read a DICOM file except for its pixel data element, for --stream-pixels.
+    Returns (ds, pixel_span, bytes_read): pixel_span is (tag, start, end) of the
+    raw pixel element in the input, or None if the file has no pixel data.
+    Elements stored after the pixel data (e.g. trailing padding) are parsed
+    and merged into ds. Returns (None, None, 0) when the file cannot be
+    streamed (deflated, or file meta disagreeing with the dataset encoding).
+    """
+    import pydicom
+    from pydicom.filereader import read_dataset
+    from pydicom.uid import DeflatedExplicitVRLittleEndian
+
+    with open(input_path, 'rb') as f:
+        ds = pydicom.dcmread(f, stop_before_pixels=True)
+        start = f.tell()
+        transfer_syntax = ds.file_meta.get('TransferSyntaxUID')
+        if transfer_syntax is None or transfer_syntax == DeflatedExplicitVRLittleEndian:
+            return None, None, 0
+        is_implicit_vr, is_little_endian = ds.original_encoding
+        if (transfer_syntax.is_implicit_VR, transfer_syntax.is_little_endian) != (is_implicit_vr, is_little_endian):
+            return None, None, 0
+        size = f.seek(0, os.SEEK_END)
+        if start >= size:
+            return ds, None, start
+        tag, end = _element_end(f, start, is_implicit_vr, is_little_endian)
+        if end < size:
+            f.seek(end)
+            trailer = read_dataset(f, is_implicit_vr, is_little_endian, parent_encoding=ds._character_set)
+            for elem in trailer:
+                ds.add(elem)
+        return ds, (tag, start, end), start + max(0, size - end)
+
+def _save_streamed(ds, out, input_path, pixel_span):
+    """
+    Write ds to the open file out with the raw pixel element copied from
+    input_path in PIXEL_COPY_CHUNK pieces. Returns the number of bytes copied.
+    """
+    from pydicom.dataset import Dataset
+    from pydicom.filebase import DicomBytesIO
+    from pydicom.filewriter import write_dataset
+
+    pixel_tag, start, end = pixel_span
+    trailer = Dataset()
+    for tag in [t for t in ds.keys() if t > pixel_tag]:
+        trailer.add(ds[tag])
+        del ds[tag]
+    ds.save_as(out)
+
+    with open(input_path, 'rb') as src:
+        src.seek(start)
+        remaining = end - start
+        while remaining:
+            chunk = src.read(min(PIXEL_COPY_CHUNK, remaining))
+            if not chunk:
+                raise EOFError(f"{input_path} shrank while its pixel data was being copied")
+            out.write(chunk)
+            remaining -= len(chunk)
+
+    if len(trailer):
+        transfer_syntax = ds.file_meta.TransferSyntaxUID
+        buffer = DicomBytesIO()
+        buffer.is_implicit_VR = transfer_syntax.is_implicit_VR
+        buffer.is_little_endian = transfer_syntax.is_little_endian
+        write_dataset(buffer, trailer)
+        out.write(buffer.getvalue())
+    return end - start
+
+def _peak_rss_bytes():
+    """
+    Return (this process, largest finished child process) peak resident set
+    size in bytes, or None where the resource module is unavailable.
+    """
+    if resource is None:
+        return None
+    # ru_maxrss is in kilobytes on Linux and in bytes on macOS
+    scale = 1 if sys.platform == 'darwin' else 1024
+    return (
+        resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * scale,
+        resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss * scale,
+    )
+
+# Tags excluded from dicomanonymizer's default actions. The identifying ones
+# are overwritten in process_dicom; the clinical/technical ones are preserved.
+KEEP_TAGS = [
+    (0x0010, 0x0010),  # PatientName
+    (0x0010, 0x0020),  # PatientID
+    (0x0008, 0x0020),  # StudyDate
+    (0x0008, 0x0021),  # SeriesDate
+    (0x0008, 0x0050),  # AccessionNumber
+    (0x0010, 0x4000),  # PatientComments
+    (0x0008, 0x1030),  # StudyDescription
+    (0x0008, 0x103E),  # SeriesDescription
+    (0x0008, 0x0060),  # Modality
+    (0x0018, 0x0015),  # BodyPartExamined
+    (0x0018, 0x0010),  # ContrastAgent
+    (0x0020, 0x0012),  # AcquisitionNumber
+    (0x0010, 0x0040),  # PatientSex
+    (0x0010, 0x1010),  # PatientAge - binned in process_dicom
+]
+
+# Compiled once per process (each worker builds its own on first use)
+_anonymization_plan = None
+_anonymization_plan_lock = threading.Lock()
+
+def _get_anonymization_plan():
+    global _anonymization_plan
+    if _anonymization_plan is None:
+        from anonymization_plan import AnonymizationPlan
+
+        with _anonymization_plan_lock:
+            if _anonymization_plan is None:
+                _anonymization_plan = AnonymizationPlan(KEEP_TAGS, delete_private_tags=True)
+    return _anonymization_plan
+
+def _bin_age(age_str):
+    """Convert age to 5-year bin (e.g., 43 -> '040' for 40-44)"""
+    try:
+        age = int(age_str)
+        binned = (age // 5) * 5
+        return f"{binned:03d}"
+    except:
+        return ""
+
+def process_dicom(plan, ds=None):
+    """
+    De-identify one file described by a pre-scan plan (see _build_file_plan).
+    The mapping lookup and accession numbering already happened in the pre-scan;
+    pass ds to reuse an already-parsed dataset instead of reading input_path.
+    Without a target_path the dataset is de-identified in place but not written.
+    With plan['stream_pixels'] the pixel data is never loaded; it is copied
+    from input to output in fixed-size chunks around the rewritten header.
+    Returns (success, new_id, log_data, timings); the caller writes log_data to
+    the log and merges timings into RunMetrics, so this can run in a worker process.
+    """
+    input_path = str(plan['input_path'])
+    output_path = None if plan['target_path'] is None else str(plan['target_path'])
+    timings = {}
+    try:
+        if output_path is not None:
+            Path(output_path).parent.mkdir(parents=True, exist_ok=True)
+
         # Load the file
-        ds = pydicom.dcmread(input_path)
-        mrn = _normalize_value(getattr(ds, "PatientID", None))
-        accession = _normalize_value(getattr(ds, "AccessionNumber", None))
+        pixel_span = None
+        if ds is None:
+            import pydicom
 
-        # 1. Match MRN/Accession with fallback and flip checks
-        row, _ = _find_mapping_row(mapping_df, mrn, accession)
-        
-        # 2. Setup IDs and Dates
-        new_id_val = _get_column_case_insensitive(row, 'New_Patient_ID')
-        if new_id_val is None:
-            raise ValueError(f"Column 'New_Patient_ID' not found in CSV. Available columns: {list(row.index)}")
-        new_id = _clean_string(new_id_val)
-        if not new_id:
-            raise ValueError("New_Patient_ID is empty after stripping whitespace")
+            t0 = time.perf_counter()
+            if plan['stream_pixels']:
+                ds, pixel_span, timings['bytes_read'] = _read_without_pixels(input_path)
+            if ds is None:
+                with open(input_path, 'rb') as f:
+                    ds = pydicom.dcmread(f)
+                    timings['bytes_read'] = f.tell()
+            timings['dicom_read_seconds'] = time.perf_counter() - t0
+        mrn = plan['mrn']
 
-        # Get accession from map if available (scan_number is actually accession_map)
-        if isinstance(scan_number, dict) and (new_id, str(accession)) in scan_number:
-            new_accession = scan_number[(new_id, str(accession))]
-        else:
-            new_accession = f"{new_id}_1"
-        
-        # Truncate to 16 chars (DICOM SH VR limit)
-        if len(new_accession) > 16:
-            new_accession = new_accession[:16]
-        
-        surgery_date_val = _get_column_case_insensitive(row, 'Surgery_Date')
-        if surgery_date_val is None:
-            raise ValueError(f"Column 'Surgery_Date' not found in CSV. Available columns: {list(row.index)}")
-        actual_surgery = pd.to_datetime(surgery_date_val)
-        
-        # Get Anchor_Date with case-insensitive lookup, default if not found
-        anchor_val = _get_column_case_insensitive(row, 'Anchor_Date')
-        project_anchor = pd.to_datetime(anchor_val) if pd.notnull(anchor_val) else datetime(2024, 6, 15)
-        
-        # Get Notes with case-insensitive lookup
-        notes = _get_column_case_insensitive(row, 'Notes')
-        notes = str(notes).strip() if pd.notnull(notes) else ''
+        # 1-2. Patient record, IDs and accession come from the plan
+        patient = plan['patient']
+        new_id = plan['new_id']
+        new_accession = plan['new_accession']
+        notes = patient.notes
         
-        # 3. Calculate Temporal Offset
-        study_date_str = ds.StudyDate
-        study_date_obj = datetime.strptime(study_date_str, '%Y%m%d')
-        days_offset = (study_date_obj - actual_surgery).days
-        
-        # 4. Project onto Anchor
-        shifted_date_obj = project_anchor + timedelta(days=days_offset)
-        shifted_date_str = shifted_date_obj.strftime('%Y%m%d')
+        t0 = time.perf_counter()
+        # 3-4. Temporal offset and projection onto the anchor date (normally
+        # computed once per series in the pre-scan)
+        if plan['days_offset'] is not None:
+            days_offset, shifted_date_str = plan['days_offset'], plan['shifted_date']
+        else:
+            days_offset, shifted_date_str = _compute_date_shift(patient, ds.StudyDate)
 
-        # 5. Define Explicit Rules
-        # We use a lambda that ignores the original value and returns our new one
+        # 5. Per-file values; everything else comes from the compiled plan
         notes_content = f"IMPORT_NOTES: {notes}" if notes else ""
         patient_comments = f"Offset: {days_offset} days from surgery"
         if notes_content:
             patient_comments = f"{patient_comments}\n{notes_content}"
-        
-        # Helper function to bin patient age to nearest 5-year interval
-        def bin_age(age_str):
-            """Convert age to 5-year bin (e.g., 43 -> '040' for 40-44)"""
-            try:
-                age = int(age_str)
-                binned = (age // 5) * 5
-                return f"{binned:03d}"
-            except:
-                return ""
-        
-        custom_rules = {
-            (0x0010, 0x0010): lambda dataset, tag: new_id,           # PatientName
-            (0x0010, 0x0020): lambda dataset, tag: new_id,           # PatientID
-            (0x0008, 0x0020): lambda dataset, tag: shifted_date_str, # StudyDate
-            (0x0008, 0x0021): lambda dataset, tag: shifted_date_str, # SeriesDate
-            (0x0008, 0x0050): lambda dataset, tag: new_accession,    # AccessionNumber
-            (0x0010, 0x4000): lambda dataset, tag: patient_comments,
-            # Preserve these clinical/technical tags
-            (0x0008, 0x1030): lambda dataset, tag: getattr(ds, 'StudyDescription', ''),       # StudyDescription
-            (0x0008, 0x103E): lambda dataset, tag: getattr(ds, 'SeriesDescription', ''),      # SeriesDescription
-            (0x0008, 0x0060): lambda dataset, tag: getattr(ds, 'Modality', ''),               # Modality
-            (0x0018, 0x0015): lambda dataset, tag: getattr(ds, 'BodyPartExamined', ''),       # BodyPartExamined
-            (0x0018, 0x0010): lambda dataset, tag: getattr(ds, 'ContrastAgent', ''),          # ContrastAgent
-            (0x0020, 0x0012): lambda dataset, tag: getattr(ds, 'AcquisitionNumber', ''),      # AcquisitionNumber
-            (0x0010, 0x0040): lambda dataset, tag: getattr(ds, 'PatientSex', ''),             # PatientSex - preserve
-            (0x0010, 0x1010): lambda dataset, tag: bin_age(getattr(ds, 'PatientAge', ''))    # PatientAge - bin to 5-year interval
-        }
 
-        # 6. RUN ANONYMIZATION
-        # We pass the rules and set delete_private_tags to True
-        anonymize_dataset(ds, custom_rules, delete_private_tags=True)
-        
-        # 7. MANUALLY FORCE CRITICAL TAGS (Double-check)
-        # Sometimes libraries fail to overwrite; we'll do it manually to be safe
+        # 6. RUN ANONYMIZATION (private tags are deleted)
+        if _get_anonymization_plan().apply(ds, plan['uid_key']):
+            timings['anon_plans_compiled'] = 1
+
+        # 7. Set the de-identified values (created if missing)
         ds.PatientName = new_id
         ds.PatientID = new_id
         ds.StudyDate = shifted_date_str
         ds.AccessionNumber = new_accession
         ds.PatientComments = patient_comments
+        if 'PatientAge' in ds:
+            ds.PatientAge = _bin_age(ds.PatientAge)
+        timings['anonymize_seconds'] = time.perf_counter() - t0
         
-        # Preserve clinical/technical tags
-        if hasattr(ds, 'StudyDescription'):
-            ds.StudyDescription = ds.StudyDescription
-        if hasattr(ds, 'SeriesDescription'):
-            ds.SeriesDescription = ds.SeriesDescription
-        if hasattr(ds, 'Modality'):
-            ds.Modality = ds.Modality
-        if hasattr(ds, 'BodyPartExamined'):
-            ds.BodyPartExamined = ds.BodyPartExamined
-        if hasattr(ds, 'ContrastAgent'):
-            ds.ContrastAgent = ds.ContrastAgent
-        if hasattr(ds, 'AcquisitionNumber'):
-            ds.AcquisitionNumber = ds.AcquisitionNumber
-        if hasattr(ds, 'PatientSex'):
-            ds.PatientSex = ds.PatientSex
-        if hasattr(ds, 'PatientAge'):
-            ds.PatientAge = bin_age(ds.PatientAge)
-        
-        ds.save_as(output_path)
-        
-        # 8. Write notes.txt file in output directory
-        if notes:
-            notes_path = Path(output_path).parent / "notes.txt"
-            with open(notes_path, 'w') as f:
-                f.write(notes)
+        if output_path is not None:
+            t0 = time.perf_counter()
+            with open(output_path, 'wb') as f:
+                if pixel_span is None:
+                    ds.save_as(f)
+                else:
+                    timings['bytes_streamed'] = _save_streamed(ds, f, input_path, pixel_span)
+                timings['bytes_written'] = f.tell()
+
+            # 8. Write notes.txt file in output directory
+            if notes:
+                notes_path = Path(output_path).parent / "notes.txt"
+                with open(notes_path, 'w') as f:
+                    f.write(notes)
+            timings['save_seconds'] = time.perf_counter() - t0
         
-        log_event(log_path, {'file': input_path, 'mrn': mrn, 'id': new_id, 'offset': days_offset, 'status': 'SUCCESS'})
-        return True, new_id
+        return True, new_id, {'file': input_path, 'mrn': mrn, 'id': new_id, 'offset': days_offset, 'status': 'SUCCESS'}, timings
         
     except Exception as e:
-        log_event(log_path, {'file': input_path, 'mrn': 'ERR', 'id': 'ERR', 'offset': 'ERR', 'status': f"ERROR: {str(e)}"})
-        return False, None
+        return False, None, {'file': input_path, 'mrn': 'ERR', 'id': 'ERR', 'offset': 'ERR', 'status': f"ERROR: {str(e)}"}, timings
 
-def main():
-    parser = argparse.ArgumentParser(description="De-identify DICOMs for Surgical Robotics Research")
-    parser.add_argument("--csv", required=True, help="Path to the patient mapping CSV")
-    parser.add_argument("--input", required=True, help="Root directory containing raw DICOMs")
-    parser.add_argument("--output", required=True, help="Target directory for de-identified data")
-    args = parser.parse_args()
-    
-    start_time = time.time()
-    mapping_df = pd.read_csv(args.csv)
-    # Strip whitespace from column names
-    mapping_df.columns = mapping_df.columns.str.strip()
-    output_root = Path(args.output)
-    output_root.mkdir(parents=True, exist_ok=True)
-    log_path = setup_logging(args.output)
-    input_root = Path(args.input)
-    
-    # Build level-2 directory map: (top_level_dir, child_dir) -> sequential index
-    level2_map = {}
-    for top_level in sorted([d for d in os.listdir(input_root) if (input_root / d).is_dir()]):
-        child_dirs = [d for d in os.listdir(input_root / top_level) if (input_root / top_level / d).is_dir()]
-        for idx, child in enumerate(sorted(child_dirs), start=1):
-            level2_map[(top_level, child)] = idx
-
-    # Pre-scan: Build accession directory map per patient
-    # This maps (new_patient_id, original_accession_dir) -> new_accession_number (new_id_1, new_id_2, etc)
-    accession_map = {}
-    patient_accession_count = {}
-    prescan_skipped_999 = 0
-    
-    print(f"=== PRE-SCAN PHASE: Building Accession Directory Map ===")
-    file_count = 0
-    
-    for root, _, files in os.walk(input_root):
-        for file in files:
-            if file.lower().endswith('.dcm'):
-                file_count += 1
-                raw_path = Path(root) / file
-                try:
-                    ds_temp = pydicom.dcmread(str(raw_path))
-                    if _is_999_dose_report(ds_temp):
-                        prescan_skipped_999 += 1
-                        print(f"  [{file_count}] {raw_path.relative_to(input_root)}")
-                        print(f"      SKIP: Series 999 dose report (excluded from mapping)")
-                        continue
-
-                    mrn_temp = _normalize_value(getattr(ds_temp, "PatientID", None))
-                    accession_temp = _normalize_value(getattr(ds_temp, "AccessionNumber", None))
-                    
-                    print(f"  [{file_count}] {raw_path.relative_to(input_root)}")
-                    print(f"      MRN: {mrn_temp}, Accession: {accession_temp}")
-                    
-                    if mrn_temp or accession_temp:
-                        row_temp, _ = _find_mapping_row(mapping_df, mrn_temp, accession_temp)
-                        if row_temp is not None:
-                            new_id_temp = _clean_string(_get_column_case_insensitive(row_temp, 'New_Patient_ID'))
-                            print(f"      → New_Patient_ID: {new_id_temp}")
-                            
-                            # Track unique accession directories per patient
-                            if accession_temp:
-                                key = (new_id_temp, str(accession_temp))
-                                if key not in accession_map:
-                                    if new_id_temp not in patient_accession_count:
-                                        patient_accession_count[new_id_temp] = 0
-                                    patient_accession_count[new_id_temp] += 1
-                                    new_accession_num = f"{new_id_temp}_{patient_accession_count[new_id_temp]}"
-                                    accession_map[key] = new_accession_num
-                                    print(f"      → Mapping: {accession_temp} → {new_accession_num}")
-                                else:
-                                    print(f"      → Already mapped: {accession_temp} → {accession_map[key]}")
-                except Exception as e:
-                    print(f"  [{file_count}] ERROR reading {raw_path}: {str(e)}")
-    
-    print(f"\n=== Pre-scan Summary ===")
-    print(f"Total DICOM files scanned: {file_count}")
-    print(f"Series 999 dose reports skipped: {prescan_skipped_999}")
-    print(f"Accession mappings created: {len(accession_map)}")
-    print(f"Accession Map: {accession_map}")
-    print(f"Patient accession counts: {patient_accession_count}")
-    print(f"Level-2 Directory Map: {level2_map}")
-    print(f"==========================================\n")
-    
-    # Summary Counters
-    stats = {"success": 0, "fail": 0, "skipped_999_dose_reports": 0, "unique_patients": set()}
+def run_plan(plan, ds=None):
+    """
+    Worker entry point for the processing phase. Returns a result dict with
+    outcome ('success', 'fail' or 'skipped_999_dose_reports'), new_id,
+    log_data, timings and, when plan['hash'] is set, the input's sha256.
+    ds is passed on to process_dicom.
+    """
+    result = {'outcome': 'fail', 'new_id': None, 'log_data': None, 'timings': {}, 'sha256': ''}
+    skip_reason = plan['skip_reason']
+    if skip_reason == 'SERIES_999_DOSE_REPORT':
+        result['outcome'] = 'skipped_999_dose_reports'
+        result['log_data'] = {
+            'file': str(plan['input_path']),
+            'mrn': 'N/A',
+            'id': 'N/A',
+            'offset': 'N/A',
+            'status': 'SKIPPED: SERIES_999_DOSE_REPORT'
+        }
+    elif skip_reason:
+        result['log_data'] = {'file': str(plan['input_path']), 'mrn': 'ERR', 'id': 'ERR', 'offset': 'ERR', 'status': skip_reason}
+    else:
+        success, result['new_id'], result['log_data'], result['timings'] = process_dicom(plan, ds)
+        result['outcome'] = 'success' if success else 'fail'
 
-    print(f"=== PROCESSING PHASE: De-identifying DICOM Files ===")
-    print(f"Log File: {log_path}\n")
+    if plan['hash'] and result['outcome'] != 'fail':
+        result['sha256'] = _file_sha256(plan['input_path'])
+    return result
 
-    for root, _, files in os.walk(args.input):
-        for file in files:
-            if file.lower().endswith('.dcm'):
-                raw_path = Path(root) / file
-                
-                # Process DICOM file
+# Pipelined processing (--io-threads): on network storage every open, read and
+# write waits for a round trip, so a serial loop leaves the CPU idle most of
+# the time. Inputs are read on I/O threads a bounded number of files ahead,
+# de-identified from memory (in this process or the worker pool) and encoded
+# to bytes, and the bytes are written behind on I/O threads with a cap on
+# the bytes waiting to be written. A result is only handed on, in plan
+# order, once its output is on disk, so the log and manifest never claim a
+# file that was not written.
+
+def _needs_input_bytes(plan):
+    """Processed files need their bytes; a skipped dose report only when --hash records it."""
+    return not plan['skip_reason'] or (plan['hash'] and plan['skip_reason'] == 'SERIES_999_DOSE_REPORT')
+
+def _read_input(path):
+    """Return (file bytes, seconds taken); runs on an I/O thread."""
+    t0 = time.perf_counter()
+    with open(path, 'rb') as f:
+        data = f.read()
+    return data, time.perf_counter() - t0
+
+def _write_output(output_path, data, notes):
+    """Write an encoded output (and notes.txt) like process_dicom does; returns seconds taken."""
+    t0 = time.perf_counter()
+    output_path = Path(output_path)
+    output_path.parent.mkdir(parents=True, exist_ok=True)
+    with open(output_path, 'wb') as f:
+        f.write(data)
+    if notes:
+        with open(output_path.parent / "notes.txt", 'w') as f:
+            f.write(notes)
+    return time.perf_counter() - t0
+
+def _error_result(plan, exc):
+    return {
+        'outcome': 'fail',
+        'new_id': None,
+        'log_data': {'file': str(plan['input_path']), 'mrn': 'ERR', 'id': 'ERR', 'offset': 'ERR', 'status': f"ERROR: {str(exc)}"},
+        'timings': {},
+        'sha256': '',
+    }
+
+def run_prefetched(plan, data):
+    """
+    run_plan for a file whose bytes were already read: parse from memory,
+    de-identify and encode the output without touching the filesystem.
+    Returns (result, output bytes or None); the caller writes the bytes to
+    plan['target_path']. Picklable, so it can run in a worker process.
+    """
+    out = None
+    if plan['skip_reason']:
+        result = run_plan(dict(plan, hash=False))
+    else:
+        import pydicom
+
+        t0 = time.perf_counter()
+        try:
+            ds = pydicom.dcmread(io.BytesIO(data))
+        except Exception as e:
+            return _error_result(plan, e), None
+        read_seconds = time.perf_counter() - t0
+        result = run_plan(dict(plan, target_path=None, hash=False), ds)
+        result['timings'].update(bytes_read=len(data), dicom_read_seconds=read_seconds)
+        if result['outcome'] == 'success':
+            t0 = time.perf_counter()
+            try:
+                buffer = io.BytesIO()
+                ds.save_as(buffer)
+                out = buffer.getvalue()
+            except Exception as e:
+                return _error_result(plan, e), None
+            result['timings']['encode_seconds'] = time.perf_counter() - t0
+    if plan['hash'] and result['outcome'] != 'fail':
+        result['sha256'] = hashlib.sha256(data).hexdigest()
+    return result, out
+
+def _resolved(value):
+    future = Future()
+    future.set_result(value)
+    return future
+
+def pipelined_results(plans, io_threads, read_ahead=32, write_behind_bytes=256 * 1024 * 1024, executor=None, workers=1):
+    """
+    Yield one run_plan-style result per plan, in plan order, with input reads
+    running up to read_ahead files ahead and output writes running behind
+    with at most write_behind_bytes not yet written. With an executor (a
+    process pool of the given number of workers) de-identification runs
+    there; otherwise it runs in the calling thread while the I/O threads wait
+    on storage.
+    """
+    readers = ThreadPoolExecutor(max_workers=io_threads, thread_name_prefix="deid-read")
+    writers = ThreadPoolExecutor(max_workers=io_threads, thread_name_prefix="deid-write")
+    plan_iter = iter(plans)
+    reads = deque()       # (plan, read future or None), in plan order
+    processing = deque()  # (plan, future of (result, output bytes), extra timings), in plan order
+    writes = deque()      # (result, data length, write future or None), in plan order
+    inflight_bytes = 0
+
+    def schedule_read():
+        plan = next(plan_iter, None)
+        if plan is None:
+            return False
+        future = readers.submit(_read_input, plan['input_path']) if _needs_input_bytes(plan) else None
+        reads.append((plan, future))
+        return True
+
+    def queue_write(plan, result, out):
+        nonlocal inflight_bytes
+        future = None
+        if out is not None:
+            notes = plan['patient'].notes
+            future = writers.submit(_write_output, plan['target_path'], out, notes)
+            inflight_bytes += len(out)
+        writes.append((result, 0 if out is None else len(out), future))
+
+    def finish_write():
+        nonlocal inflight_bytes
+        result, size, future = writes.popleft()
+        if future is not None:
+            t0 = time.perf_counter()
+            try:
+                result['timings']['save_seconds'] = future.result()
+                result['timings']['bytes_written'] = size
+            except Exception as e:
+                result.update(outcome='fail', new_id=None, sha256='')
+                result['log_data'] = dict(result['log_data'], mrn='ERR', id='ERR', offset='ERR', status=f"ERROR: {str(e)}")
+            result['timings']['write_wait_seconds'] = time.perf_counter() - t0
+            inflight_bytes -= size
+        return result
+
+    def ready_writes(final=False):
+        # Oldest first: finished writes, or any write once over the byte budget
+        while writes and (
+            final or writes[0][2] is None or writes[0][2].done() or inflight_bytes > write_behind_bytes
+        ):
+            yield finish_write()
+
+    def finish_processing():
+        plan, future, extra_timings = processing.popleft()
+        try:
+            result, out = future.result()
+        except Exception as e:
+            result, out = _error_result(plan, e), None
+        result['timings'].update(extra_timings)
+        queue_write(plan, result, out)
+
+    # Every plan passes through processing in order; outside the pool its
+    # future is already resolved, so the window there is zero.
+    window = 2 * workers if executor is not None else 0
+    try:
+        for _ in range(max(1, read_ahead)):
+            if not schedule_read():
+                break
+        while reads:
+            plan, read_future = reads.popleft()
+            schedule_read()
+            extra_timings = {}
+            if read_future is None:
+                future = _resolved((run_plan(plan), None))
+            else:
+                t0 = time.perf_counter()
                 try:
-                    ds_temp = pydicom.dcmread(str(raw_path))
-                    if _is_999_dose_report(ds_temp):
-                        print(f"  {raw_path.name}: SKIPPED - Series 999 dose report")
-                        log_event(log_path, {
-                            'file': str(raw_path),
-                            'mrn': 'N/A',
-                            'id': 'N/A',
-                            'offset': 'N/A',
-                            'status': 'SKIPPED: SERIES_999_DOSE_REPORT'
-                        })
-                        stats["skipped_999_dose_reports"] += 1
-                        continue
-
-                    mrn_temp = _normalize_value(getattr(ds_temp, "PatientID", None))
-                    accession_temp = _normalize_value(getattr(ds_temp, "AccessionNumber", None))
-                    row_temp, status_temp = _find_mapping_row(mapping_df, mrn_temp, accession_temp)
-                    patient_id_temp = _clean_string(_get_column_case_insensitive(row_temp, 'New_Patient_ID'))
-                    
-                    # Lookup accession number from map
-                    if (patient_id_temp, str(accession_temp)) in accession_map:
-                        new_accession_temp = accession_map[(patient_id_temp, str(accession_temp))]
-                        print(f"  {raw_path.name}: {mrn_temp}/{accession_temp} → {patient_id_temp}/{new_accession_temp}")
+                    data, extra_timings['input_read_seconds'] = read_future.result()
+                except Exception as e:
+                    data = None
+                    future = _resolved((_error_result(plan, e), None))
+                extra_timings['read_wait_seconds'] = time.perf_counter() - t0
+                if data is not None:
+                    if executor is None:
+                        future = _resolved(run_prefetched(plan, data))
                     else:
-                        new_accession_temp = f"{patient_id_temp}_1"
-                        print(f"  {raw_path.name}: {mrn_temp}/{accession_temp} → {patient_id_temp}/{new_accession_temp} (fallback)")
-                    
-                    # Rebuild output path with accession map
-                    print(f"    Calling _rebuild_directory_path with:")
-                    print(f"      input_file: {raw_path.relative_to(input_root)}")
-                    print(f"      mrn={mrn_temp}, accession={accession_temp}, new_id={patient_id_temp}, match_status={status_temp}")
-                    target_path = _rebuild_directory_path(raw_path, output_root, input_root, mrn_temp, accession_temp, patient_id_temp, accession_map, status_temp, level2_map)
-                    print(f"    Result: {target_path.relative_to(output_root)}\n")
-                    target_path.parent.mkdir(parents=True, exist_ok=True)
-                    
-                    # Process DICOM with file path
-                    success, patient_id = process_dicom(str(raw_path), str(target_path), mapping_df, log_path, accession_map)
-                    
-                    if success:
-                        stats["success"] += 1
-                        stats["unique_patients"].add(patient_id)
+                        future = executor.submit(run_prefetched, plan, data)
+            processing.append((plan, future, extra_timings))
+            while len(processing) > window or (processing and not reads):
+                finish_processing()
+            yield from ready_writes()
+        yield from ready_writes(final=True)
+    finally:
+        readers.shutdown(wait=True, cancel_futures=True)
+        writers.shutdown(wait=True, cancel_futures=True)
+
+def print_index_stats(output_root):
+    index_path = output_root / INDEX_NAME
+    if not index_path.exists():
+        raise ValueError(f"No header index found at {index_path}; run a de-identification first")
+    header_index = HeaderIndex(index_path)
+    try:
+        stats = header_index.stats()
+    finally:
+        header_index.close()
+    print(f"\n--- Header Index Statistics ---")
+    print(f"Index File:         {index_path}")
+    print(f"DICOM Files:        {stats['files']}")
+    print(f"Patients:           {stats['patients']}")
+    print(f"Accessions:         {stats['accessions']}")
+    print(f"Studies:            {stats['studies']}")
+    print(f"Series:             {stats['series']}")
+    print(f"Series 999 Files:   {stats['series_999']}")
+    print(f"-------------------------------")
+
+def _setup_console(args):
+    """Route console output through the logging module at the level chosen on the command line."""
+    if args.debug:
+        level = logging.DEBUG
+    elif args.verbose:
+        level = VERBOSE
+    elif args.quiet:
+        level = logging.WARNING
+    else:
+        level = logging.INFO
+    handler = logging.StreamHandler(sys.stdout)
+    handler.setFormatter(logging.Formatter("%(message)s"))
+    logger.addHandler(handler)
+    logger.setLevel(level)
+    logger.propagate = False
+    # The progress line only makes sense when per-file lines are hidden.
+    return level == logging.INFO and not args.no_progress
+
+def _print_progress(processed, total, start_time):
+    if total <= 0:
+        return
+    elapsed = max(time.time() - start_time, 1e-9)
+    pct = (processed / total) * 100
+    rate = processed / elapsed
+    print(
+        f"\rProgress: {processed}/{total} ({pct:5.1f}%) | {rate:6.1f} files/s | elapsed {elapsed:6.1f}s",
+        end="",
+        flush=True,
+    )
+
+def _dataset_path(ds):
+    """Path recorded for a Dataset passed in directly: its file name if it was read from one."""
+    filename = getattr(ds, 'filename', None)
+    return Path(filename) if isinstance(filename, str) and filename else Path("<dataset>")
+
+def _path_under(input_root, path):
+    """path (absolute or relative to the working directory) spelled below input_root; ValueError if outside it."""
+    try:
+        rel_path = Path(os.path.abspath(path)).relative_to(os.path.abspath(input_root))
+    except ValueError:
+        raise ValueError(f"{path} is not inside the input root {input_root}")
+    return input_root / rel_path
+
+def _level2_dirs_of(entries, input_root):
+    """(top_level_dir, child_dir) pairs of the folders holding the entries' files two or more levels down."""
+    pairs = set()
+    for entry in entries:
+        parts = Path(entry.path).relative_to(input_root).parts
+        if len(parts) > 2:
+            pairs.add(parts[:2])
+    return pairs
+
+def _stat_entry(path):
+    """FileEntry for a path given directly (not found by a directory walk)."""
+    try:
+        st = os.stat(path)
+    except OSError:
+        # Left for the header read to report
+        return FileEntry(str(path), os.path.basename(path), None, None, True)
+    return FileEntry(str(path), os.path.basename(path), st.st_size, st.st_mtime_ns, True)
+
+class DeidResult:
+    """Outcome of DeidEngine.deidentify for one in-memory object."""
+    __slots__ = ("outcome", "status", "data", "match_status", "days_offset", "new_id", "new_accession")
+
+    def __init__(self, outcome, status, data=None, match_status=None, days_offset=None, new_id=None, new_accession=None):
+        self.outcome = outcome  # 'success', 'fail' or 'skipped_999_dose_reports'
+        self.status = status  # as written to the log, e.g. 'SUCCESS' or 'ERROR: ...'
+        self.data = data  # de-identified DICOM file bytes (success only)
+        self.match_status = match_status
+        self.days_offset = days_offset
+        self.new_id = new_id
+        self.new_accession = new_accession
+
+class DeidEngine:
+    """
+    De-identification engine built once from the mapping and reused for any
+    number of batches, e.g. one accession at a time:
+
+        engine = DeidEngine("mapping.csv", workers=1)
+        engine.run("raw", "deid_output", paths=["raw/patient_12345/ACC001"])
+
+    run() does what the command line does. input_root is always the raw
+    root (patient folders below it), so the patient and accession folders
+    can be renamed; paths limits a run to some of its folders or files.
+    plan() and process() expose the pre-scan and the per-file step on
+    their own. run() continues the accession and folder numbering saved by
+    earlier runs into the same output root, so every batch of a patient gets
+    its own New_ID_N folder; the per-series decisions start afresh for each
+    run. plan()/process()/deidentify() continue the engine's numbering.
+
+    The numbering and the UID key link the output back to patients, so they
+    are saved in state_dir, not in the output tree. By default that is a
+    folder per output root under deid_state/ next to the mapping CSV (see
+    default_state_dir); a DataFrame mapping needs an explicit state_dir.
+
+    process() and deidentify() may be called from many threads at once:
+    accession numbering and the series cache are updated under a lock. They
+    keep the decisions of the max_cached_series most recently seen series
+    (MAX_CACHED_SERIES by default); a long-running caller that knows a
+    series is complete can also drop it with forget_series().
+
+    New UIDs are derived from the old ones with uid_key (see
+    anonymization_plan.keyed_uid), so every worker process and every run
+    with the same key gives a study the same new StudyInstanceUID. Without
+    a uid_key, run() uses the key saved by an earlier run into the same
+    output root and otherwise a new random one; the key in use is saved
+    with the numbering.
+
+    With io_threads > 0, run() overlaps storage I/O with de-identification
+    (see pipelined_results): inputs are read up to read_ahead files ahead and
+    outputs written behind with at most write_behind_bytes pending.
+    """
+
+    def __init__(
+        self,
+        mapping,
+        workers=1,
+        stream_pixels=False,
+        use_hash=False,
+        use_header_index=True,
+        show_progress=False,
+        io_threads=0,
+        read_ahead=32,
+        write_behind_bytes=256 * 1024 * 1024,
+        uid_key=None,
+        state_dir=None,
+        max_cached_series=MAX_CACHED_SERIES,
+    ):
+        if workers < 1 or max_cached_series < 1:
+            raise ValueError("workers and max_cached_series must be >= 1")
+        if io_threads < 0 or read_ahead < 1 or write_behind_bytes < 0:
+            raise ValueError("io_threads must be >= 0, read_ahead >= 1 and write_behind_bytes >= 0")
+        if io_threads and stream_pixels:
+            raise ValueError("io_threads cannot be combined with stream_pixels (pipelined files are read whole)")
+        self.mapping_index = _build_mapping_index(load_mapping(mapping))
+        self._mapping_path = mapping if isinstance(mapping, (str, os.PathLike)) else None
+        self.state_dir = state_dir
+        self.max_cached_series = max_cached_series
+        for col, key, first_row, dup_row in self.mapping_index['ambiguous']:
+            logger.warning(
+                "Ambiguous mapping key '%s' in column '%s' (CSV rows %d and %d); using row %d",
+                key, col, first_row, dup_row, first_row,
+            )
+        self.workers = workers
+        self.stream_pixels = stream_pixels
+        self.use_hash = use_hash
+        self.use_header_index = use_header_index
+        self.show_progress = show_progress
+        self.io_threads = io_threads
+        self.read_ahead = read_ahead
+        self.write_behind_bytes = write_behind_bytes
+        self._explicit_uid_key = uid_key is not None
+        self.uid_key = uid_key if uid_key is not None else secrets.token_hex(16)
+        self.metrics = RunMetrics("deid")
+        self._lock = threading.Lock()
+        self.reset()
+
+    def numbering(self):
+        """Copies of (accession_map, patient_accession_count), taken under the engine lock."""
+        with self._lock:
+            return dict(self.accession_map), dict(self.patient_accession_count)
+
+    def restore_uid_key(self, saved_uid_key):
+        """Use the UID key saved by an earlier run, unless a uid_key was passed to the constructor."""
+        if saved_uid_key and not self._explicit_uid_key:
+            self.uid_key = saved_uid_key
+
+    def state_dir_for(self, output_root):
+        """Folder holding the numbering and UID key for runs into output_root."""
+        if self.state_dir is not None:
+            return Path(self.state_dir)
+        if self._mapping_path is None:
+            raise ValueError("state_dir is required when the mapping is not read from a CSV file")
+        return default_state_dir(self._mapping_path, output_root)
+
+    def load_state(self, output_root):
+        """
+        Continue the numbering and UID key of earlier runs into output_root
+        (restarting the per-series decisions). Returns the saved level2_map.
+        """
+        state_dir = self.state_dir_for(output_root)
+        if not (state_dir / NUMBERING_NAME).exists() and (Path(output_root) / NUMBERING_NAME).exists():
+            # Saved inside the output root by earlier versions; moved out by save_state
+            state_dir = Path(output_root)
+        accession_map, patient_accession_count, level2_map, saved_uid_key = load_numbering(state_dir)
+        self.restore_uid_key(saved_uid_key)
+        self.reset(accession_map, patient_accession_count)
+        return level2_map
+
+    def save_state(self, output_root, level2_map):
+        """Save the numbering and UID key for output_root (atomic replace)."""
+        state_dir = self.state_dir_for(output_root)
+        accession_map, patient_accession_count = self.numbering()
+        save_numbering(state_dir, accession_map, patient_accession_count, level2_map, self.uid_key)
+        legacy_path = Path(output_root) / NUMBERING_NAME
+        if legacy_path.exists():
+            legacy_path.unlink()
+            logger.warning("Moved %s out of the output folder to %s", NUMBERING_NAME, state_dir)
+
+    def forget_series(self, series_keys):
+        """Drop the cached per-series decisions for series_keys (thread-safe), e.g. once no more instances are expected."""
+        with self._lock:
+            for key in series_keys:
+                self.series_groups.pop(key, None)
+
+    def _touch_series(self, key):
+        """Mark series key as most recently used and drop the least recently used beyond max_cached_series (lock held)."""
+        series_groups = self.series_groups
+        if key in series_groups:
+            series_groups[key] = series_groups.pop(key)
+        while len(series_groups) > self.max_cached_series:
+            del series_groups[next(iter(series_groups))]
+
+    def reset(self, accession_map=None, patient_accession_count=None):
+        """Start new accession numbering (optionally from saved maps) and forget series decisions."""
+        self.accession_map = accession_map if accession_map is not None else {}
+        self.patient_accession_count = patient_accession_count if patient_accession_count is not None else {}
+        self.series_groups = {}
+        # (input parent dir, new_id, mrn, accession, match_status) -> output parent dir
+        self._target_dirs = {}
+
+    def plan(self, paths, input_root=None, output_root=None):
+        """
+        Pre-scan files without de-identifying them: read their headers, look up
+        the mapping, number accessions and, when output_root is given, choose
+        output paths. paths are file paths or dicom_walk.FileEntry objects;
+        input_root defaults to their common parent directory. Returns the plan
+        dicts in input order. Files that cannot be planned get a plan whose
+        skip_reason starts with 'ERROR:'.
+        """
+        entries = [
+            FileEntry(os.path.abspath(p.path), p.name, p.size, p.mtime_ns, p.is_dicom)
+            if isinstance(p, FileEntry) else _stat_entry(os.path.abspath(p))
+            for p in paths
+        ]
+        if input_root is None:
+            input_root = os.path.commonpath([os.path.dirname(e.path) for e in entries]) if entries else os.getcwd()
+        input_root = Path(os.path.abspath(input_root))
+        # Second-level directories are numbered among those holding the given files
+        level2_map = _merge_level2_map({}, _level2_dirs_of(entries, input_root))
+        plans, _ = self._prescan(entries, input_root, Path(output_root) if output_root is not None else None, level2_map)
+        return plans
+
+    def _prescan_lookups(self, entries, input_root, output_root, previous_manifest, header_index):
+        """
+        Yield (entry, kind, value) for every entry: ('unchanged', None) when the
+        manifest says it can be skipped, ('cached', header) on a header index
+        hit, ('read', None or future of _read_header) on a miss, or
+        ('error', exception). With io_threads the reads for misses run up to
+        read_ahead entries ahead on I/O threads; the manifest and index are
+        only consulted from the calling thread.
+        """
+        readers = ThreadPoolExecutor(max_workers=self.io_threads, thread_name_prefix="deid-header") if self.io_threads else None
+        window = self.read_ahead if readers is not None else 0
+
+        def lookup(st):
+            try:
+                raw_path = Path(st.path)
+                rel_input = str(raw_path.relative_to(input_root))
+                if previous_manifest is not None and _is_unchanged(previous_manifest.get(rel_input), st.size, st.mtime_ns, raw_path, output_root, self.use_hash):
+                    return st, 'unchanged', None
+                header = header_index.get(os.path.abspath(raw_path), st.size, st.mtime_ns) if header_index else None
+                if header is not None:
+                    return st, 'cached', header
+                return st, 'read', None if readers is None else readers.submit(_read_header, raw_path, PRESCAN_TAGS)
+            except Exception as e:
+                return st, 'error', e
+
+        pending = deque(lookup(st) for st in entries[:window])
+        try:
+            for st in entries[window:]:
+                pending.append(lookup(st))
+                yield pending.popleft()
+            while pending:
+                yield pending.popleft()
+        finally:
+            if readers is not None:
+                readers.shutdown(wait=True, cancel_futures=True)
+
+    def _prescan(self, entries, input_root, output_root, level2_map, previous_manifest=None, header_index=None):
+        """
+        Plan every entry. Returns (plans, counts) where counts has files,
+        bytes_read, index_hits, skipped_999 and unchanged.
+        """
+        metrics = self.metrics
+        counts = {'files': 0, 'bytes_read': 0, 'index_hits': 0, 'skipped_999': 0, 'unchanged': 0}
+        prescan_start = time.time()
+        last_progress_ts = 0.0
+        plans = []
+        for st, kind, value in self._prescan_lookups(entries, input_root, output_root, previous_manifest, header_index):
+            raw_path = Path(st.path)
+            counts['files'] += 1
+            file_count = counts['files']
+            rel_input = str(raw_path.relative_to(input_root))
+            header = None
+            try:
+                if kind == 'error':
+                    raise value
+                if kind == 'unchanged':
+                    counts['unchanged'] += 1
+                    logger.log(VERBOSE, "  [%d] %s: unchanged since last run, skipping", file_count, rel_input)
+                    continue
+                t0 = time.perf_counter()
+                abs_path = os.path.abspath(raw_path)
+                if kind == 'read':
+                    ds_temp, bytes_read = _read_header(raw_path, PRESCAN_TAGS) if value is None else value.result()
+                    header = HeaderRecord.from_dataset(ds_temp)
+                    if header_index:
+                        header_index.put(abs_path, st.size, st.mtime_ns, header)
+                    counts['bytes_read'] += bytes_read
+                    stage = "header_read"
+                else:
+                    header = value
+                    counts['index_hits'] += 1
+                    stage = "header_cache"
+                t1 = time.perf_counter()
+                metrics.record(stage, t1 - t0)
+                plan = _plan_for_instance(raw_path, header, self.series_groups, self.mapping_index, self.accession_map, self.patient_accession_count)
+                metrics.record("mapping_lookup", time.perf_counter() - t1)
+            except Exception as e:
+                # Reported once as a failure in the processing phase
+                logger.log(VERBOSE, "  [%d] %s: ERROR: %s", file_count, rel_input, e)
+                error_plan = _new_file_plan(raw_path, f"ERROR: {str(e)}")
+                if header is not None and _series_key(header) in self.series_groups:
+                    error_plan['series_key'] = _series_key(header)
+                plans.append(error_plan)
+                continue
+
+            plan['size'] = st.size
+            plan['mtime_ns'] = st.mtime_ns
+            plan['hash'] = self.use_hash
+            plan['uid_key'] = self.uid_key
+            plan['stream_pixels'] = self.stream_pixels
+            plans.append(plan)
+            if plan['series_mismatch']:
+                # First mismatch per series as a warning, the rest only with --verbose
+                first_mismatch = self.series_groups[plan['series_key']]['inconsistent'] == 1
+                if first_mismatch and self.show_progress:
+                    print()
+                logger.log(
+                    logging.WARNING if first_mismatch else VERBOSE,
+                    "%s disagrees with the first instance of its series on %s; planned individually",
+                    rel_input, ", ".join(plan['series_mismatch']),
+                )
+            if plan['skip_reason'] == 'SERIES_999_DOSE_REPORT':
+                counts['skipped_999'] += 1
+                logger.log(VERBOSE, "  [%d] %s: SKIP: Series 999 dose report (excluded from mapping)", file_count, raw_path.relative_to(input_root))
+            else:
+                logger.log(
+                    VERBOSE, "  [%d] %s: MRN: %s, Accession: %s → %s/%s (%s)",
+                    file_count, raw_path.relative_to(input_root), plan['mrn'], plan['accession'],
+                    plan['new_id'], plan['new_accession'], plan['match_status'],
+                )
+                if output_root is not None:
+                    # The file name is always kept, so the output directory only depends on the parent
+                    dir_key = (raw_path.parent, plan['new_id'], plan['mrn'], plan['accession'], plan['match_status'])
+                    target_dir = self._target_dirs.get(dir_key)
+                    if target_dir is None:
+                        plan['target_path'] = _rebuild_directory_path(
+                            raw_path, output_root, input_root, plan['mrn'], plan['accession'], plan['new_id'],
+                            self.accession_map, plan['match_status'], level2_map
+                        )
+                        self._target_dirs[dir_key] = plan['target_path'].parent
                     else:
-                        stats["fail"] += 1
-                except Exception as e:
-                    print(f"  {raw_path.name}: ERROR - {str(e)}")
-                    log_event(log_path, {'file': str(raw_path), 'mrn': 'ERR', 'id': 'ERR', 'offset': 'ERR', 'status': f"ERROR: {str(e)}"})
-                    stats["fail"] += 1
-
-    # Final Summary Report
-    duration = time.time() - start_time
-    print(f"\n--- Processing Summary ---")
-    print(f"Total Time:         {duration:.2f} seconds")
-    print(f"Files Processed:    {stats['success']}")
-    print(f"Files Failed:       {stats['fail']}")
-    print(f"Files Skipped 999:  {stats['skipped_999_dose_reports']}")
-    print(f"Unique Patients:    {len(stats['unique_patients'])}")
-    print(f"Output Directory:   {args.output}")
-    print(f"--------------------------")
+                        plan['target_path'] = target_dir / raw_path.name
+
+            if self.show_progress:
+                now = time.time()
+                if file_count == len(entries) or now - last_progress_ts >= 0.5:
+                    _print_progress(file_count, len(entries), prescan_start)
+                    last_progress_ts = now
+
+        if entries and self.show_progress:
+            print()
+        return plans, counts
+
+    def process(self, source, output_path=None):
+        """
+        De-identify a single file path or pydicom Dataset (changed in place)
+        outside run(), continuing this engine's numbering. The result is
+        written to output_path when one is given. Returns the result dict of
+        the processing phase (outcome, new_id, log_data, timings) plus
+        'dataset': the de-identified Dataset, or None if skipped or failed.
+        """
+        import pydicom
+
+        if isinstance(source, pydicom.Dataset):
+            ds = source
+            raw_path = _dataset_path(ds)
+        else:
+            ds = None
+            raw_path = Path(source)
+        try:
+            if ds is None:
+                ds = pydicom.dcmread(raw_path)
+        except Exception as e:
+            plan = _new_file_plan(raw_path, f"ERROR: {str(e)}")
+        else:
+            plan = self.plan_dataset(raw_path, ds)
+        if output_path is not None and not plan['skip_reason']:
+            plan['target_path'] = Path(output_path)
+        result = run_plan(plan, ds)
+        result['dataset'] = ds if result['outcome'] == 'success' else None
+        return result
+
+    def plan_dataset(self, raw_path, ds):
+        """
+        Plan a fully read dataset (thread-safe); errors become an ERROR plan.
+        raw_path is only recorded in the plan. Pass the plan and ds to
+        run_plan() to de-identify it.
+        """
+        try:
+            header = HeaderRecord.from_dataset(ds)
+            key = _series_key(header)
+            with self._lock:
+                try:
+                    plan = _plan_for_instance(raw_path, header, self.series_groups, self.mapping_index, self.accession_map, self.patient_accession_count)
+                finally:
+                    self._touch_series(key)
+            plan['uid_key'] = self.uid_key
+            return plan
+        except Exception as e:
+            return _new_file_plan(raw_path, f"ERROR: {str(e)}")
+
+    def deidentify(self, source):
+        """
+        De-identify one DICOM object in memory, e.g. inside a routing service.
+        source is the file's bytes, a binary file-like object, or a pydicom
+        Dataset (changed in place). Nothing is read from or written to disk
+        and nothing is logged to files. Returns a DeidResult whose data holds
+        the de-identified file bytes when outcome is 'success'.
+        """
+        import pydicom
+
+        if isinstance(source, pydicom.Dataset):
+            ds = source
+            raw_path = _dataset_path(ds)
+        else:
+            raw_path = Path("<memory>")
+            try:
+                fileobj = io.BytesIO(source) if isinstance(source, (bytes, bytearray, memoryview)) else source
+                ds = pydicom.dcmread(fileobj)
+            except Exception as e:
+                return DeidResult('fail', f"ERROR: {str(e)}")
+
+        plan = self.plan_dataset(raw_path, ds)
+        result = run_plan(plan, ds)
+        status = result['log_data']['status']
+        data = None
+        if result['outcome'] == 'success':
+            try:
+                buffer = io.BytesIO()
+                ds.save_as(buffer)
+                data = buffer.getvalue()
+            except Exception as e:
+                return DeidResult('fail', f"ERROR: {str(e)}", match_status=plan['match_status'])
+        return DeidResult(
+            result['outcome'],
+            status,
+            data,
+            plan['match_status'],
+            result['log_data']['offset'] if result['outcome'] == 'success' else None,
+            plan['new_id'],
+            plan['new_accession'],
+        )
+
+    def run(self, input_root, output_root, resume=False, metrics_out=None, paths=None):
+        """
+        De-identify every DICOM file under input_root into output_root, writing
+        the log, series log and manifest there (and the numbering to the state
+        folder) as the command line does. paths (files or directories inside input_root) limits the run to
+        those; input_root stays the raw root the output folders are named from.
+        Returns a summary dict: success, fail, skipped_999_dose_reports,
+        unchanged, unique_patients and metrics (the run's RunMetrics).
+        """
+        self.metrics = metrics = RunMetrics("deid")
+        show_progress = self.show_progress
+
+        start_time = time.time()
+        output_root = Path(output_root)
+        output_root.mkdir(parents=True, exist_ok=True)
+        log = setup_logging(output_root)
+        series_log = setup_series_logging(output_root)
+        input_root = Path(input_root)
+        scan_roots = [input_root] if paths is None else [_path_under(input_root, path) for path in paths]
+
+        # Single scandir pass: file list with cached stat values plus the top two directory levels
+        t0 = time.perf_counter()
+        if paths is None:
+            tree = scan_tree(input_root, exclude=[output_root])
+            dicom_entries = tree.dicom_files()
+            level2_dirs = {(top_level, child) for top_level, child_dirs in tree.level2_dirs() for child in child_dirs}
+        else:
+            dicom_entries = []
+            for path in scan_roots:
+                if path.is_dir():
+                    dicom_entries.extend(scan_tree(path, exclude=[output_root]).dicom_files())
+                else:
+                    dicom_entries.append(_stat_entry(path))
+            level2_dirs = _level2_dirs_of(dicom_entries, input_root)
+        metrics.record("traversal", time.perf_counter() - t0)
+        sniffed_files = sum(1 for e in dicom_entries if not is_dicom_name(e.name))
+        metrics.add("files_sniffed_dicom", sniffed_files)
+
+        # Pre-scan: Build accession directory map per patient
+        # This maps (new_patient_id, original_accession_dir) -> new_accession_number (new_id_1, new_id_2, etc)
+        # Numbering continues from earlier runs into this output root, so a
+        # later batch never reuses an accession or level-2 folder number.
+        # Level-2 map: (top_level_dir, child_dir) -> sequential index
+        previous_manifest = None
+        # Same replacement UIDs as earlier runs into this output root
+        level2_map = _merge_level2_map(self.load_state(output_root), level2_dirs)
+        if resume:
+            previous_manifest = load_manifest(output_root)
+            logger.info("Resuming: %d inputs in manifest, %d accessions already numbered", len(previous_manifest), len(self.accession_map))
+        manifest = open_manifest(output_root)
+        header_index = HeaderIndex(output_root / INDEX_NAME) if self.use_header_index else None
+
+        logger.info("=== PRE-SCAN PHASE: Building Accession Directory Map ===")
+        prescan_start = time.time()
+        plans, counts = self._prescan(dicom_entries, input_root, output_root, level2_map, previous_manifest, header_index)
+        series_groups = self.series_groups
+        file_count = counts['files']
+        prescan_bytes_read = counts['bytes_read']
+        unchanged_files = counts['unchanged']
+
+        if header_index:
+            seen_paths = [os.path.abspath(e.path) for e in dicom_entries]
+            for path in scan_roots:
+                if path.is_dir():
+                    header_index.prune(os.path.abspath(path), seen_paths)
+            header_index.close()
+        prescan_duration = max(time.time() - prescan_start, 1e-9)
+        metrics.set_gauge("prescan_seconds", prescan_duration)
+        metrics.add("bytes_read", prescan_bytes_read)
+        metrics.add("header_index_hits", counts['index_hits'])
+        inconsistent_series = sum(1 for series in series_groups.values() if series['inconsistent'])
+        metrics.add("series", len(series_groups))
+        metrics.add("series_inconsistent", inconsistent_series)
+        self.save_state(output_root, level2_map)
+        logger.info("\n=== Pre-scan Summary ===")
+        logger.info("Total DICOM files scanned: %d", file_count)
+        if sniffed_files:
+            logger.info("  of which detected by DICM header (no .dcm extension): %d", sniffed_files)
+        logger.info("Header bytes read: %d (%.1f MB)", prescan_bytes_read, prescan_bytes_read / 1e6)
+        if header_index:
+            logger.info("Header cache hits: %d", counts['index_hits'])
+        logger.info("Pre-scan time: %.2f seconds (%.1f files/s)", prescan_duration, file_count / prescan_duration)
+        logger.info("Series 999 dose reports skipped: %d", counts['skipped_999'])
+        logger.info("Series: %d (%d with inconsistent instances)", len(series_groups), inconsistent_series)
+        if resume:
+            logger.info("Unchanged since last run: %d", unchanged_files)
+        logger.info("Accession mappings created: %d", len(self.accession_map))
+        logger.log(VERBOSE, "Accession Map: %s", self.accession_map)
+        logger.log(VERBOSE, "Patient accession counts: %s", self.patient_accession_count)
+        logger.log(VERBOSE, "Level-2 Directory Map: %s", level2_map)
+        logger.info("==========================================\n")
+
+        # Summary Counters
+        stats = {"success": 0, "fail": 0, "skipped_999_dose_reports": 0, "unique_patients": set()}
+
+        logger.info("=== PROCESSING PHASE: De-identifying DICOM Files ===")
+        logger.info("Log File: %s", log.path)
+        logger.info("Series Log File: %s\n", series_log.path)
+
+        # Results come back in plan order, so the log matches a serial run.
+        process_start = time.time()
+        total_files = len(plans)
+        processed_files = 0
+        last_progress_ts = 0.0
+        executor = ProcessPoolExecutor(max_workers=self.workers) if self.workers > 1 else None
+        if self.io_threads:
+            results = pipelined_results(
+                plans,
+                self.io_threads,
+                read_ahead=self.read_ahead,
+                write_behind_bytes=self.write_behind_bytes,
+                executor=executor,
+                workers=self.workers,
+            )
+        elif executor is not None:
+            chunksize = max(1, min(64, total_files // (self.workers * 4)))
+            results = executor.map(run_plan, plans, chunksize=chunksize)
+        else:
+            results = map(run_plan, plans)
+
+        try:
+            for plan, result in zip(plans, results):
+                raw_path = plan['input_path']
+                outcome = result['outcome']
+                patient_id = result['new_id']
+                log_data = result['log_data']
+                if outcome == 'skipped_999_dose_reports':
+                    logger.log(VERBOSE, "  %s: SKIPPED - Series 999 dose report", raw_path.name)
+                elif outcome == 'success':
+                    logger.log(VERBOSE, "  %s: %s/%s → %s/%s", raw_path.name, plan['mrn'], plan['accession'], patient_id, plan['new_accession'])
+                    stats["unique_patients"].add(patient_id)
+                else:
+                    if show_progress:
+                        # Keep the error off the progress line
+                        print()
+                    logger.warning("  %s: %s", raw_path, log_data['status'])
+                stats[outcome] += 1
+                if plan['series_key'] is not None:
+                    series_groups[plan['series_key']]['outcomes'][outcome] += 1
+                metrics.add(f"files_{outcome}")
+                metrics.merge(result['timings'])
+                t0 = time.perf_counter()
+                log_event(log, log_data)
+                manifest.write([
+                    str(raw_path.relative_to(input_root)),
+                    '' if plan['size'] is None else plan['size'],
+                    '' if plan['mtime_ns'] is None else plan['mtime_ns'],
+                    result['sha256'],
+                    str(plan['target_path'].relative_to(output_root)) if outcome == 'success' else '',
+                    log_data['status'],
+                ])
+                metrics.record("log_write", time.perf_counter() - t0)
+
+                processed_files += 1
+                if show_progress:
+                    now = time.time()
+                    if processed_files == total_files or now - last_progress_ts >= 0.5:
+                        _print_progress(processed_files, total_files, process_start)
+                        last_progress_ts = now
+        finally:
+            if self.io_threads:
+                # Lets in-flight writes finish before the log is closed
+                results.close()
+            if executor is not None:
+                executor.shutdown()
+            log.close()
+            manifest.close()
+
+        metrics.set_gauge("processing_seconds", time.time() - process_start)
+        if total_files > 0 and show_progress:
+            print()
+
+        with series_log:
+            for series in series_groups.values():
+                log_series(series_log, series)
+
+        # Final Summary Report
+        duration = time.time() - start_time
+        logger.info("\n--- Processing Summary ---")
+        logger.info("Total Time:         %.2f seconds", duration)
+        logger.info("Worker Processes:   %d", self.workers)
+        if self.io_threads:
+            logger.info(
+                "I/O Threads:        %d (read-ahead %d files, write-behind %.0f MB)",
+                self.io_threads, self.read_ahead, self.write_behind_bytes / (1024 * 1024),
+            )
+        logger.info("Files Processed:    %d", stats['success'])
+        logger.info("Files Failed:       %d", stats['fail'])
+        logger.info("Files Skipped 999:  %d", stats['skipped_999_dose_reports'])
+        if resume:
+            logger.info("Files Unchanged:    %d", unchanged_files)
+        logger.info("Unique Patients:    %d", len(stats['unique_patients']))
+        peak_rss = _peak_rss_bytes()
+        if peak_rss is not None:
+            main_rss, worker_rss = peak_rss
+            metrics.set_gauge("peak_rss_bytes", main_rss)
+            logger.info("Peak RSS:           %.1f MB (main process)", main_rss / 1e6)
+            if self.workers > 1:
+                metrics.set_gauge("worker_peak_rss_bytes", worker_rss)
+                logger.info("                    %.1f MB (largest worker)", worker_rss / 1e6)
+        logger.info("Output Directory:   %s", output_root)
+        logger.info("--------------------------")
+
+        logger.info("\n--- Stage Timings ---")
+        for line in metrics.summary_lines():
+            logger.info(line)
+        if metrics_out:
+            metrics.write(metrics_out)
+            logger.info("Metrics written to: %s", metrics_out)
+        logger.info("---------------------")
+
+        return {
+            "success": stats["success"],
+            "fail": stats["fail"],
+            "skipped_999_dose_reports": stats["skipped_999_dose_reports"],
+            "unchanged": unchanged_files,
+            "unique_patients": len(stats["unique_patients"]),
+            "metrics": metrics,
+        }
+
+def main():
+    parser = argparse.ArgumentParser(description="De-identify DICOMs for Surgical Robotics Research")
+    parser.add_argument("--csv", help="Path to the patient mapping CSV")
+    parser.add_argument("--input", help="Root directory containing raw DICOMs")
+    parser.add_argument("--output", required=True, help="Target directory for de-identified data")
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=1,
+        help="Number of worker processes for the processing phase (default: 1 = serial)",
+    )
+    parser.add_argument("--no-progress", action="store_true", help="Disable live progress indicator")
+    parser.add_argument(
+        "--state-dir",
+        help=f"Folder for the accession numbering and UID key (default: {STATE_DIR_NAME}/<output name>_<hash> next to --csv)",
+    )
+    parser.add_argument(
+        "--resume",
+        action="store_true",
+        help="Skip inputs the output manifest already records as done and unchanged",
+    )
+    parser.add_argument(
+        "--hash",
+        action="store_true",
+        help="Record a SHA-256 of each input in the manifest (lets --resume recognise touched but identical files)",
+    )
+    parser.add_argument(
+        "--no-header-index",
+        action="store_true",
+        help=f"Do not use or update the pre-scan header cache ({INDEX_NAME} in --output)",
+    )
+    parser.add_argument(
+        "--index-stats",
+        action="store_true",
+        help="Print patient/accession/series counts from the header cache in --output and exit (no DICOM reads)",
+    )
+    parser.add_argument(
+        "--stream-pixels",
+        action="store_true",
+        help="Copy pixel data from input to output in chunks instead of loading it (bounded memory for very large files)",
+    )
+    parser.add_argument(
+        "--io-threads",
+        type=int,
+        default=0,
+        help="Read inputs ahead and write outputs behind on this many I/O threads while files are de-identified (for NFS/SMB; default: 0 = off)",
+    )
+    parser.add_argument(
+        "--read-ahead",
+        type=int,
+        default=32,
+        help="With --io-threads: how many files to read ahead of processing (default: 32)",
+    )
+    parser.add_argument(
+        "--write-behind-mb",
+        type=float,
+        default=256,
+        help="With --io-threads: most output MB waiting to be written before processing waits (default: 256)",
+    )
+    parser.add_argument(
+        "--metrics-out",
+        help="Write per-stage timing metrics to this file (JSON, or Prometheus text format if it ends in .prom)",
+    )
+    verbosity = parser.add_mutually_exclusive_group()
+    verbosity.add_argument("--quiet", action="store_true", help="Only print warnings and errors")
+    verbosity.add_argument("--verbose", action="store_true", help="Print one line per file")
+    verbosity.add_argument("--debug", action="store_true", help="Also trace output path construction per path part")
+    args = parser.parse_args()
+    if args.index_stats:
+        return print_index_stats(Path(args.output))
+    if not args.csv or not args.input:
+        parser.error("--csv and --input are required unless --index-stats is used")
+    if args.workers < 1:
+        parser.error("--workers must be >= 1")
+    if args.io_threads < 0 or args.read_ahead < 1 or args.write_behind_mb < 0:
+        parser.error("--io-threads must be >= 0, --read-ahead >= 1 and --write-behind-mb >= 0")
+    if args.io_threads and args.stream_pixels:
+        parser.error("--io-threads cannot be combined with --stream-pixels")
+    show_progress = _setup_console(args)
+    engine = DeidEngine(
+        args.csv,
+        workers=args.workers,
+        stream_pixels=args.stream_pixels,
+        use_hash=args.hash,
+        use_header_index=not args.no_header_index,
+        show_progress=show_progress,
+        io_threads=args.io_threads,
+        read_ahead=args.read_ahead,
+        write_behind_bytes=int(args.write_behind_mb * 1024 * 1024),
+        state_dir=args.state_dir,
+    )
+    engine.run(args.input, args.output, resume=args.resume, metrics_out=args.metrics_out)
 
 if __name__ == "__main__":
     main()
\ No newline at end of file
@@ -0,0 +1,125 @@
+import os
+
+# dicom_walk.py
+#
+# Purpose:
+#   Single-pass directory traversal built on os.scandir.
+#
+#   Each file's size and mtime come from one stat call on its DirEntry, and
+#   files are yielded in the same order os.walk would produce them (a
+#   directory's files before its subdirectories, depth first), so numbering
+#   that depends on first-seen order is unchanged. DICOM files are detected
+#   by a .dcm extension, or by the 128-byte preamble followed by the "DICM"
+#   magic for extensionless PACS exports such as IM000123.
+
+DICM_OFFSET = 128
+DICM_MAGIC = b"DICM"
+
+# Media directory files carry the DICM magic but are not images to de-identify.
+NON_IMAGE_NAMES = {"DICOMDIR"}
+
+
+class FileEntry:
+    """One file found by the traversal, with its cached stat values."""
+
+    __slots__ = ("path", "name", "size", "mtime_ns", "is_dicom")
+
+    def __init__(self, path, name, size, mtime_ns, is_dicom):
+        self.path = path
+        self.name = name
+        self.size = size
+        self.mtime_ns = mtime_ns
+        self.is_dicom = is_dicom
+
+
+class TreeScan:
+    """Result of scan_tree: all files plus the first two directory levels."""
+
+    def __init__(self, root):
+        self.root = root
+        self.files = []
+        # relative directory parts tuple -> child directory names (depth 0 and 1 only)
+        self.subdirs = {}
+
+    def dicom_files(self):
+        return [entry for entry in self.files if entry.is_dicom]
+
+    def level2_dirs(self):
+        """Yield (top_level_dir, [child_dirs]) for every top-level directory, sorted."""
+        for top_level in sorted(self.subdirs.get((), [])):
+            yield top_level, sorted(self.subdirs.get((top_level,), []))
+
+
+def sniff_dicom(path):
+    """True if the file has a DICOM preamble + 'DICM' magic (reads 132 bytes)."""
+    try:
+        with open(path, "rb") as f:
+            header = f.read(DICM_OFFSET + len(DICM_MAGIC))
+    except OSError:
+        return False
+    return header[DICM_OFFSET:] == DICM_MAGIC
+
+
+def is_dicom_name(name):
+    return name.lower().endswith(".dcm")
+
+
+def iter_tree(root, sniff=True, subdirs=None, with_stat=True, exclude=()):
+    """
+    Yield a FileEntry for every file under root, in os.walk order.
+    With sniff=False only the .dcm extension marks a file as DICOM.
+    With with_stat=False files are not stat'ed and size/mtime_ns are None.
+    If subdirs is a dict, child directory names of the root and of each
+    top-level directory are recorded into it as the walk goes.
+    Directories in exclude (e.g. an output folder inside root) are neither
+    entered nor listed.
+    """
+    root = os.fspath(root)
+    excluded = {os.path.realpath(path) for path in exclude}
+    stack = [(root, ())]
+    while stack:
+        directory, rel_parts = stack.pop()
+        try:
+            with os.scandir(directory) as it:
+                entries = list(it)
+        except OSError:
+            continue
+
+        child_dirs = []
+        for entry in entries:
+            try:
+                is_dir = entry.is_dir()
+            except OSError:
+                is_dir = False
+            if is_dir:
+                if not excluded or os.path.realpath(entry.path) not in excluded:
+                    child_dirs.append(entry)
+                continue
+            size = mtime_ns = None
+            if with_stat:
+                try:
+                    st = entry.stat()
+                except OSError:
+                    continue
+                size, mtime_ns = st.st_size, st.st_mtime_ns
+            if is_dicom_name(entry.name):
+                is_dicom = True
+            elif sniff and entry.name not in NON_IMAGE_NAMES:
+                is_dicom = sniff_dicom(entry.path)
+            else:
+                is_dicom = False
+            yield FileEntry(entry.path, entry.name, size, mtime_ns, is_dicom)
+
+        if subdirs is not None and len(rel_parts) < 2:
+            subdirs[rel_parts] = [entry.name for entry in child_dirs]
+        # Like os.walk(followlinks=False): symlinked directories are listed but not entered
+        for entry in reversed(child_dirs):
+            if not entry.is_symlink():
+                stack.append((entry.path, rel_parts + (entry.name,)))
+
+
+def scan_tree(root, sniff=True, exclude=()):
+    """Walk root once and return a TreeScan with every file and the top two directory levels."""
+    scan = TreeScan(root)
+    scan.files = list(iter_tree(root, sniff=sniff, subdirs=scan.subdirs, exclude=exclude))
+    return scan
@@ -0,0 +1,138 @@
+import os
+import sqlite3
+from pathlib import Path
+
+# header_index.py
+#
+# Purpose:
+#   Persistent cache of the few DICOM header values deid_tool.py needs in its
+#   pre-scan, stored as SQLite in the output root.
+#
+#   Rows are keyed by absolute path and are only trusted while the file's size
+#   and mtime_ns match, so an unchanged archive is re-scanned without opening
+#   any DICOM file. The same table answers dataset statistics (patients,
+#   accessions, series-999 count) without DICOM reads.
+
+INDEX_NAME = "deid_header_index.sqlite"
+
+# DICOM keywords cached per file (also the specific_tags used for header reads)
+INDEXED_TAGS = [
+    "PatientID",
+    "AccessionNumber",
+    "SeriesNumber",
+    "StudyDate",
+    "StudyInstanceUID",
+    "SeriesInstanceUID",
+    "SOPInstanceUID",
+]
+
+_COLUMNS = [
+    "patient_id",
+    "accession_number",
+    "series_number",
+    "study_date",
+    "study_uid",
+    "series_uid",
+    "sop_uid",
+]
+
+COMMIT_EVERY = 1000
+
+
+class HeaderRecord:
+    """Header values for one file; attribute names match the DICOM keywords."""
+
+    __slots__ = tuple(INDEXED_TAGS)
+
+    def __init__(self, values):
+        for tag, value in zip(INDEXED_TAGS, values):
+            setattr(self, tag, value)
+
+    @classmethod
+    def from_dataset(cls, ds):
+        values = []
+        for tag in INDEXED_TAGS:
+            value = getattr(ds, tag, None)
+            values.append(None if value is None else str(value))
+        return cls(values)
+
+    def values(self):
+        return [getattr(self, tag) for tag in INDEXED_TAGS]
+
+
+class HeaderIndex:
+    """SQLite-backed path+size+mtime -> HeaderRecord cache."""
+
+    def __init__(self, path):
+        self.path = Path(path)
+        self._conn = sqlite3.connect(str(self.path))
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS headers ("
+            "path TEXT PRIMARY KEY, size INTEGER, mtime_ns INTEGER, "
+            + ", ".join(f"{col} TEXT" for col in _COLUMNS)
+            + ")"
+        )
+        self._pending = 0
+
+    def get(self, path, size, mtime_ns):
+        """Return the cached HeaderRecord, or None if missing or stale."""
+        row = self._conn.execute(
+            f"SELECT size, mtime_ns, {', '.join(_COLUMNS)} FROM headers WHERE path = ?",
+            (str(path),),
+        ).fetchone()
+        if row is None or row[0] != size or row[1] != mtime_ns:
+            return None
+        return HeaderRecord(row[2:])
+
+    def put(self, path, size, mtime_ns, record):
+        self._conn.execute(
+            f"INSERT OR REPLACE INTO headers (path, size, mtime_ns, {', '.join(_COLUMNS)}) "
+            f"VALUES ({', '.join('?' * (3 + len(_COLUMNS)))})",
+            (str(path), size, mtime_ns, *record.values()),
+        )
+        self._pending += 1
+        if self._pending >= COMMIT_EVERY:
+            self.commit()
+
+    def prune(self, root, seen_paths):
+        """Drop rows under root whose files were not seen in this scan."""
+        prefix = os.path.join(str(root), "")
+        self._conn.execute("CREATE TEMP TABLE IF NOT EXISTS seen (path TEXT PRIMARY KEY)")
+        self._conn.execute("DELETE FROM seen")
+        self._conn.executemany("INSERT OR IGNORE INTO seen (path) VALUES (?)", ((str(p),) for p in seen_paths))
+        deleted = self._conn.execute(
+            "DELETE FROM headers WHERE substr(path, 1, ?) = ? AND path NOT IN (SELECT path FROM seen)",
+            (len(prefix), prefix),
+        ).rowcount
+        self.commit()
+        return deleted
+
+    def stats(self):
+        query = (
+            "SELECT COUNT(*), "
+            "COUNT(DISTINCT patient_id), "
+            "COUNT(DISTINCT patient_id || char(0) || accession_number), "
+            "COUNT(DISTINCT study_uid), "
+            "COUNT(DISTINCT series_uid), "
+            "SUM(CASE WHEN trim(series_number) = '999' THEN 1 ELSE 0 END) "
+            "FROM headers"
+        )
+        files, patients, accessions, studies, series, series_999 = self._conn.execute(query).fetchone()
+        return {
+            "files": files,
+            "patients": patients,
+            "accessions": accessions,
+            "studies": studies,
+            "series": series,
+            "series_999": series_999 or 0,
+        }
+
+    def commit(self):
+        self._conn.commit()
+        self._pending = 0
+
+    def close(self):
+        self.commit()
+        self._conn.close()
@@ -0,0 +1,92 @@
+import argparse
+import builtins
+import io
+import os
+import runpy
+import sys
+import time
+
+# latency_shim.py
+#
+# Purpose:
+#   Make a local directory behave like high-latency network storage
+#   (NFS/SMB) for testing, without root or a mount: run any of the scripts
+#   under it and every open() of a file below one of the --root directories
+#   first sleeps for --latency-ms (the open round trip). Closing a file
+#   opened for writing sleeps again (the flush on close). Sleeps release the
+#   GIL like a real network wait does, so overlapping I/O shows up as it
+#   would on the real mount.
+#
+#   python latency_shim.py --latency-ms 20 --root ./raw_input --root ./out -- \
+#       deid_tool.py --csv mapping.csv --input ./raw_input --output ./out --io-threads 8
+#
+#   Worker processes started by fork inherit the shim. Directory listings
+#   and stat calls are not slowed down.
+
+_real_open = builtins.open
+
+
+class _SlowCloseFile:
+    """File wrapper that waits one round trip when closed (write modes only)."""
+
+    def __init__(self, f, latency):
+        self._f = f
+        self._latency = latency
+
+    def __getattr__(self, name):
+        return getattr(self._f, name)
+
+    def __iter__(self):
+        return iter(self._f)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def close(self):
+        if not self._f.closed:
+            self._f.close()
+            time.sleep(self._latency)
+
+
+def install(roots, latency_ms):
+    """Patch open() so files under any of roots take latency_ms per open and per close after writing."""
+    latency = latency_ms / 1000.0
+    prefixes = tuple(os.path.join(os.path.abspath(root), "") for root in roots)
+
+    def slow_open(file, mode="r", *args, **kwargs):
+        if isinstance(file, int) or not os.path.abspath(os.fsdecode(file)).startswith(prefixes):
+            return _real_open(file, mode, *args, **kwargs)
+        time.sleep(latency)
+        f = _real_open(file, mode, *args, **kwargs)
+        if any(flag in mode for flag in "wax+"):
+            return _SlowCloseFile(f, latency)
+        return f
+
+    builtins.open = slow_open
+    io.open = slow_open
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Run a script with artificial storage latency on files under the given directories"
+    )
+    parser.add_argument("--latency-ms", type=float, default=10.0, help="Delay per open and per close after writing (ms)")
+    parser.add_argument("--root", action="append", required=True, help="Directory to slow down (repeatable)")
+    parser.add_argument("script", help="Script to run, followed by its own arguments (after --)")
+    parser.add_argument("script_args", nargs=argparse.REMAINDER)
+    args = parser.parse_args()
+    if args.latency_ms < 0:
+        parser.error("--latency-ms must be >= 0")
+
+    install(args.root, args.latency_ms)
+    script = os.path.abspath(args.script)
+    sys.argv = [script] + args.script_args
+    sys.path.insert(0, os.path.dirname(script))
+    runpy.run_path(script, run_name="__main__")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,220 @@
+import argparse
+import csv
+import os
+from datetime import datetime, timedelta
+from pathlib import Path
+
+from pydicom import dcmread
+from pydicom.data import get_testdata_file
+from pydicom.uid import RLELossless, generate_uid
+
+# make_test_cohort.py
+#
+# Purpose:
+#   Generate a synthetic cohort of any size plus its mapping CSV, for
+#   reproducing scaling behaviour of deid_tool.py and
+#   remove_999_dose_reports.py outside production. make_test_data.py stays
+#   the small hand-checked example; this script is for volume.
+#
+#   Layout: <output>/patient_<MRN>/<Accession>/SER<nn>/<file>
+#   for N patients x accessions x series x instances. Series cycle through
+#   single-frame CT, multi-frame and RLE-compressed images, and every
+#   accession also gets one Series 999 dose report. Some files have no .dcm
+#   extension, some patients have an underscore-padded MRN (matched by
+#   accession) and some have MRN and accession swapped in the DICOM header.
+#   Everything is derived from --seed, so the same arguments give the same
+#   cohort.
+
+SERIES_KINDS = ["single", "multiframe", "compressed"]
+
+UNDERSCORE_MRN = "_____"
+BASE_SURGERY_DATE = datetime(2024, 1, 1)
+ANCHOR_DATE = "2024-06-15"
+
+MULTIFRAME_WORD_SC_STORAGE = "1.2.840.10008.5.1.4.1.1.7.3"
+SECONDARY_CAPTURE_STORAGE = "1.2.840.10008.5.1.4.1.1.7"
+
+MAPPING_COLUMNS = ["MRN", "Accession", "New_Patient_ID", "Surgery_Date", "Anchor_Date", "Notes"]
+
+
+def _every(index, interval):
+    """True for every interval-th item (interval 0 disables)."""
+    return interval > 0 and index % interval == interval - 1
+
+
+def _load_templates(frames):
+    """One dataset per kind, built once and re-stamped for every file written."""
+    sample_path = get_testdata_file("CT_small.dcm")
+    templates = {}
+
+    templates["single"] = dcmread(sample_path)
+
+    ds = dcmread(sample_path)
+    ds.SOPClassUID = MULTIFRAME_WORD_SC_STORAGE
+    ds.file_meta.MediaStorageSOPClassUID = MULTIFRAME_WORD_SC_STORAGE
+    ds.NumberOfFrames = frames
+    ds.PixelData = ds.PixelData * frames
+    templates["multiframe"] = ds
+
+    ds = dcmread(sample_path)
+    ds.compress(RLELossless, generate_instance_uid=False)
+    templates["compressed"] = ds
+
+    ds = dcmread(sample_path)
+    ds.SOPClassUID = SECONDARY_CAPTURE_STORAGE
+    ds.file_meta.MediaStorageSOPClassUID = SECONDARY_CAPTURE_STORAGE
+    ds.ImageType = ["DERIVED", "SECONDARY", "DOSE_INFO"]
+    ds.SeriesDescription = "Dose Report"
+    templates["dose_report"] = ds
+    return templates
+
+
+def _uid(seed, *parts):
+    return generate_uid(entropy_srcs=[str(seed), *map(str, parts)])
+
+
+def generate_cohort(
+    output,
+    csv_path,
+    patients,
+    accessions=2,
+    series=3,
+    instances=5,
+    frames=8,
+    seed=0,
+    extensionless_every=5,
+    underscore_every=7,
+    swap_every=11,
+):
+    """
+    Write the cohort under output and its mapping CSV to csv_path.
+    Returns a dict of counts (patients, accessions, series, files, dose_reports, bytes).
+    """
+    output = Path(output)
+    templates = _load_templates(frames)
+    summary = {"patients": 0, "accessions": 0, "series": 0, "files": 0, "dose_reports": 0, "bytes": 0}
+    mapping_rows = []
+    file_counter = 0
+
+    for p in range(patients):
+        mrn = f"{100000 + p}"
+        new_id = f"SYN_{p + 1:06d}"
+        underscore = _every(p, underscore_every)
+        swapped = not underscore and _every(p, swap_every)
+        surgery_date = BASE_SURGERY_DATE + timedelta(days=p % 365)
+        sex = "MF"[p % 2]
+        age = f"{20 + p % 60:03d}"
+        notes = "underscore MRN" if underscore else "swapped MRN/accession" if swapped else ""
+        summary["patients"] += 1
+
+        for a in range(accessions):
+            accession = f"A{p:06d}{a:02d}"
+            study_date = (surgery_date + timedelta(days=30 * a - 15)).strftime("%Y%m%d")
+            study_uid = _uid(seed, "study", mrn, accession)
+            mapping_rows.append(
+                [
+                    UNDERSCORE_MRN if underscore else mrn,
+                    accession,
+                    new_id,
+                    surgery_date.strftime("%Y-%m-%d"),
+                    ANCHOR_DATE,
+                    notes,
+                ]
+            )
+            summary["accessions"] += 1
+
+            # Regular series, then the dose report as Series 999
+            series_specs = [(s + 1, SERIES_KINDS[s % len(SERIES_KINDS)], instances) for s in range(series)]
+            series_specs.append((999, "dose_report", 1))
+            for series_number, kind, count in series_specs:
+                series_dir = output / f"patient_{mrn}" / accession / f"SER{series_number:03d}"
+                series_dir.mkdir(parents=True, exist_ok=True)
+                series_uid = _uid(seed, "series", study_uid, series_number)
+                ds = templates[kind]
+                summary["series"] += 1
+
+                for i in range(count):
+                    sop_uid = _uid(seed, "sop", series_uid, i)
+                    ds.PatientName = f"Synthetic^Patient{p:06d}"
+                    ds.PatientID = accession if swapped else UNDERSCORE_MRN if underscore else mrn
+                    ds.AccessionNumber = mrn if swapped else accession
+                    ds.PatientSex = sex
+                    ds.PatientAge = age
+                    ds.StudyDate = study_date
+                    ds.SeriesDate = study_date
+                    ds.StudyInstanceUID = study_uid
+                    ds.SeriesInstanceUID = series_uid
+                    ds.SOPInstanceUID = sop_uid
+                    ds.file_meta.MediaStorageSOPInstanceUID = sop_uid
+                    ds.SeriesNumber = series_number
+                    ds.InstanceNumber = i + 1
+                    if kind != "dose_report":
+                        ds.SeriesDescription = f"Synthetic {kind} {series_number}"
+
+                    file_counter += 1
+                    if _every(file_counter, extensionless_every):
+                        name = f"IM{file_counter:06d}"
+                    else:
+                        name = f"IMG_{file_counter:06d}.dcm"
+                    target = series_dir / name
+                    ds.save_as(str(target))
+                    summary["files"] += 1
+                    summary["bytes"] += os.path.getsize(target)
+                    if kind == "dose_report":
+                        summary["dose_reports"] += 1
+
+    Path(csv_path).parent.mkdir(parents=True, exist_ok=True)
+    with open(csv_path, "w", newline="") as f:
+        writer = csv.writer(f)
+        writer.writerow(MAPPING_COLUMNS)
+        writer.writerows(mapping_rows)
+    return summary
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Generate a synthetic DICOM cohort and mapping CSV for scale testing")
+    parser.add_argument("--output", default="./synthetic_input", help="Root directory to write the cohort to")
+    parser.add_argument("--csv", default="./synthetic_mapping.csv", help="Path of the mapping CSV to write")
+    parser.add_argument("--patients", type=int, default=10, help="Number of patients")
+    parser.add_argument("--accessions", type=int, default=2, help="Accessions per patient")
+    parser.add_argument("--series", type=int, default=3, help="Image series per accession (plus one Series 999)")
+    parser.add_argument("--instances", type=int, default=5, help="Files per image series")
+    parser.add_argument("--frames", type=int, default=8, help="Frames per multi-frame file")
+    parser.add_argument("--seed", type=int, default=0, help="Seed for UIDs (same seed, same cohort)")
+    parser.add_argument(
+        "--extensionless-every", type=int, default=5, help="Write every Nth file without .dcm extension (0 = never)"
+    )
+    parser.add_argument(
+        "--underscore-every", type=int, default=7, help="Give every Nth patient an underscore-padded MRN (0 = never)"
+    )
+    parser.add_argument(
+        "--swap-every", type=int, default=11, help="Swap MRN and accession in the headers of every Nth patient (0 = never)"
+    )
+    args = parser.parse_args()
+    if min(args.patients, args.accessions, args.instances, args.frames) < 1 or args.series < 0:
+        parser.error("--patients, --accessions, --instances and --frames must be >= 1, --series >= 0")
+
+    summary = generate_cohort(
+        args.output,
+        args.csv,
+        args.patients,
+        accessions=args.accessions,
+        series=args.series,
+        instances=args.instances,
+        frames=args.frames,
+        seed=args.seed,
+        extensionless_every=args.extensionless_every,
+        underscore_every=args.underscore_every,
+        swap_every=args.swap_every,
+    )
+    print(f"Patients:      {summary['patients']}")
+    print(f"Accessions:    {summary['accessions']}")
+    print(f"Series:        {summary['series']} (including {summary['dose_reports']} Series 999 dose reports)")
+    print(f"Files:         {summary['files']} ({summary['bytes'] / 1e6:.1f} MB)")
+    print(f"Cohort:        {args.output}")
+    print(f"Mapping CSV:   {args.csv}")
+    print(f"\npython deid_tool.py --csv {args.csv} --input {args.output} --output ./synthetic_deid_output")
+
+
+if __name__ == "__main__":
+    main()
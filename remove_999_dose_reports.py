@@ -1,14 +1,26 @@
 import argparse
 import os
-import shutil
 import sys
 import time
-from concurrent.futures import ThreadPoolExecutor, as_completed
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, ThreadPoolExecutor, wait
 from datetime import datetime
 from pathlib import Path
 
 import pydicom
-from pydicom.uid import ExplicitVRLittleEndian
+from pydicom.filereader import read_partial
+from pydicom.pixels import get_encoder
+from pydicom.uid import (
+    DeflatedExplicitVRLittleEndian,
+    ExplicitVRLittleEndian,
+    ImplicitVRLittleEndian,
+    JPEG2000Lossless,
+    JPEGLSLossless,
+    RLELossless,
+)
+
+from audit_log import AuditLogWriter
+from dicom_walk import iter_tree
+from file_transfer import LINK_MODES, transfer_file
 
 # remove_999_dose_reports.py
 #
@@ -30,12 +42,20 @@ from pydicom.uid import ExplicitVRLittleEndian
 #
 # Optional args:
 #   --workers N                  Parallel worker threads (default: auto).
+#   --crop-workers N             Processes for Series 999 decode/crop/write
+#                                (default: 0 = on the worker threads).
+#   --output-syntax SYNTAX       Transfer syntax of cropped files: explicit
+#                                (default), rle, or original (re-encode
+#                                losslessly in the source syntax where possible).
+#   --link-mode MODE             How kept files reach --output: copy (default),
+#                                hardlink, reflink or auto (reflink, else copy).
 #   --dry-run                    Preview actions without writing changes.
 #   --no-progress                Disable live progress line.
 #
 # Note:
-#   Some dose-report DICOMs are compressed and require an installed pixel
-#   decoder backend (e.g., pylibjpeg or GDCM) to access pixel_array.
+#   Uncompressed little-endian dose reports are cropped by slicing the raw
+#   PixelData bytes. Compressed ones require an installed pixel decoder
+#   backend (e.g., pylibjpeg or GDCM) to access pixel_array.
 #   If cropping fails for Series 999, the script exits non-zero.
 #
 # Examples:
@@ -43,6 +63,21 @@ from pydicom.uid import ExplicitVRLittleEndian
 #   python remove_999_dose_reports.py --input ./old_deid_output --in-place
 
 
+SERIES_NUMBER_TAG = 0x00200011
+
+OUTPUT_SYNTAXES = ["explicit", "rle", "original"]
+
+# Compressed syntaxes that can be re-encoded without loss when their pydicom
+# encoder plugin is installed. Other compressed sources (e.g. lossy JPEG) are
+# written as RLE Lossless for --output-syntax original.
+_LOSSLESS_REENCODABLE = {RLELossless, JPEGLSLossless, JPEG2000Lossless}
+
+# Files submitted to the thread pool but not yet finished, per worker thread.
+# Traversal pauses when the limit is reached, so memory does not grow with the
+# size of the input tree.
+PENDING_PER_WORKER = 4
+
+
 def _normalize_value(value):
     if value is None:
         return None
@@ -61,59 +96,146 @@ def _is_999_dose_report(ds):
 def _setup_log(log_root):
     log_root.mkdir(parents=True, exist_ok=True)
     log_path = log_root / f"dose_report_cleanup_{datetime.now().strftime('%Y%m%d_%H%M%S')}.csv"
-    with open(log_path, "w", encoding="utf-8") as f:
-        f.write("Timestamp,File,SeriesNumber,Action,Status,Details\n")
-    return log_path
+    return AuditLogWriter(log_path, ["File", "SeriesNumber", "Action", "Status", "Details"])
 
 
-def _log_event(log_path, file_path, series_number, action, status, details=""):
-    with open(log_path, "a", encoding="utf-8") as f:
-        f.write(
-            f"{datetime.now().isoformat()},{file_path},{series_number},{action},{status},{details}\n"
-        )
+def _log_event(log, file_path, series_number, action, status, details=""):
+    log.write([file_path, series_number, action, status, details])
 
 
-def _copy_file(source_root, output_root, file_path):
+def _copy_file(source_root, output_root, file_path, stats, link_mode="copy"):
+    """Place one file in the mirrored output tree and count how it got there in stats."""
     rel_path = file_path.relative_to(source_root)
     target = output_root / rel_path
     target.parent.mkdir(parents=True, exist_ok=True)
-    shutil.copy2(file_path, target)
+    method = transfer_file(file_path, target, link_mode)
+    if method == "copy":
+        stats["files_copied"] += 1
+        stats["bytes_copied"] += target.stat().st_size
+    else:
+        stats[f"files_{method}ed"] += 1
+
+
+def _stop_after_series_number(tag, vr, length):
+    return tag > SERIES_NUMBER_TAG
+
+
+def _read_series_header(file_path):
+    """
+    Parse only as far as SeriesNumber (0020,0011); everything after it,
+    including PixelData, is never read. Returns (header_ds, bytes_parsed).
+    """
+    with open(file_path, "rb") as f:
+        ds = read_partial(f, stop_when=_stop_after_series_number, specific_tags=[SERIES_NUMBER_TAG])
+        return ds, f.tell()
+
+
+def _choose_output_syntax(source_syntax, output_syntax):
+    """Transfer syntax UID to write a cropped file in (see OUTPUT_SYNTAXES)."""
+    if output_syntax == "explicit":
+        return ExplicitVRLittleEndian
+    if output_syntax == "rle":
+        return RLELossless
+    if source_syntax in (ExplicitVRLittleEndian, ImplicitVRLittleEndian, DeflatedExplicitVRLittleEndian):
+        return source_syntax
+    if source_syntax is None or not source_syntax.is_compressed:
+        # Big endian sources are written little endian
+        return ExplicitVRLittleEndian
+    if source_syntax in _LOSSLESS_REENCODABLE and get_encoder(source_syntax).is_available:
+        return source_syntax
+    return RLELossless
+
+
+def _crop_and_write(file_path, target_path, output_syntax="explicit"):
+    """
+    Read a Series 999 file in full, crop it and write it to target_path
+    (nothing is written when target_path is None, i.e. --dry-run).
+    Returns a dict with crop_rows, decoded, bytes_parsed, syntax (name of the
+    output transfer syntax), size_before and size_after (None on dry runs).
+    Top-level so it can run in the --crop-workers process pool.
+    """
+    with open(file_path, "rb") as f:
+        ds = pydicom.dcmread(f)
+        bytes_parsed = f.tell()
+    syntax = _choose_output_syntax(ds.file_meta.get("TransferSyntaxUID"), output_syntax)
+    crop_rows, decoded = _crop_top_quarter(ds)
+    size_after = None
+    if target_path is not None:
+        syntax = _write_dicom(ds, target_path, syntax)
+        size_after = os.path.getsize(target_path)
+    return {
+        "crop_rows": crop_rows,
+        "decoded": decoded,
+        "bytes_parsed": bytes_parsed,
+        "syntax": syntax.name,
+        "size_before": bytes_parsed,
+        "size_after": size_after,
+    }
 
 
-def _process_file(file_path, input_root, output_root, in_place, dry_run):
+def _process_file(
+    file_path, input_root, output_root, in_place, dry_run, link_mode="copy", crop_executor=None, output_syntax="explicit"
+):
+    """
+    Classify and handle one file. Runs on a worker thread; with crop_executor
+    (a process pool) the decode/crop/write of Series 999 files is handed to
+    it and this thread waits for the result, keeping the GIL-heavy work off
+    the threads that do header reads and copies.
+    """
     rel_path = file_path.relative_to(input_root)
     stats = {
         "total_files": 1,
         "dicom_files": 0,
         "cropped_999": 0,
+        "decoded_999": 0,
         "failed_999": 0,
         "kept_dicom": 0,
         "copied_non_dicom": 0,
         "errors": 0,
+        "bytes_parsed": 0,
+        "bytes_copied": 0,
+        "files_copied": 0,
+        "files_hardlinked": 0,
+        "files_reflinked": 0,
     }
 
     if file_path.suffix.lower() != ".dcm":
         if output_root and not dry_run:
-            _copy_file(input_root, output_root, file_path)
+            _copy_file(input_root, output_root, file_path, stats, link_mode)
         if output_root:
             stats["copied_non_dicom"] += 1
         return stats, None
 
     stats["dicom_files"] += 1
 
+    is_999 = False
     try:
-        ds = pydicom.dcmread(str(file_path))
-        series_number = _normalize_value(getattr(ds, "SeriesNumber", "")) or "N/A"
-
-        if _is_999_dose_report(ds):
-            crop_rows = _crop_top_quarter(ds)
-            stats["cropped_999"] += 1
+        # Classify from the header; only Series 999 files are read in full.
+        header, bytes_parsed = _read_series_header(file_path)
+        stats["bytes_parsed"] += bytes_parsed
+        series_number = _normalize_value(getattr(header, "SeriesNumber", "")) or "N/A"
+        is_999 = _is_999_dose_report(header)
 
+        if is_999:
             target_path = file_path if in_place else output_root / rel_path
-            if not dry_run:
-                if not in_place:
-                    target_path.parent.mkdir(parents=True, exist_ok=True)
-                _write_dicom(ds, target_path)
+            if dry_run:
+                target_path = None
+            elif not in_place:
+                target_path.parent.mkdir(parents=True, exist_ok=True)
+                # Never write through a hardlink to the input left by an earlier --link-mode hardlink run
+                if target_path.exists() and os.path.samefile(file_path, target_path):
+                    target_path.unlink()
+
+            if crop_executor is None:
+                result = _crop_and_write(file_path, target_path, output_syntax)
+            else:
+                result = crop_executor.submit(_crop_and_write, file_path, target_path, output_syntax).result()
+            stats["bytes_parsed"] += result["bytes_parsed"]
+            stats["cropped_999"] += 1
+            stats["decoded_999"] += int(result["decoded"])
+            details = f"removed_rows={result['crop_rows']}; output_syntax={result['syntax']}; size_before={result['size_before']}"
+            if result["size_after"] is not None:
+                details += f"; size_after={result['size_after']}"
 
             return (
                 stats,
@@ -122,13 +244,13 @@ def _process_file(file_path, input_root, output_root, in_place, dry_run):
                     "series": series_number,
                     "action": "CROP_TOP_QUARTER",
                     "status": "SERIES_999_DOSE_REPORT",
-                    "details": f"removed_rows={crop_rows}",
+                    "details": details,
                 },
             )
 
         stats["kept_dicom"] += 1
         if output_root and not dry_run:
-            _copy_file(input_root, output_root, file_path)
+            _copy_file(input_root, output_root, file_path, stats, link_mode)
 
         return (
             stats,
@@ -143,18 +265,12 @@ def _process_file(file_path, input_root, output_root, in_place, dry_run):
 
     except Exception as exc:
         stats["errors"] += 1
-        is_999 = False
-        try:
-            ds_header = pydicom.dcmread(str(file_path), stop_before_pixels=True)
-            is_999 = _is_999_dose_report(ds_header)
-        except Exception:
-            is_999 = False
 
         if is_999:
             stats["failed_999"] += 1
         elif output_root and not dry_run:
             # Keep non-999 files on error so data is not dropped unexpectedly.
-            _copy_file(input_root, output_root, file_path)
+            _copy_file(input_root, output_root, file_path, stats, link_mode)
 
         return (
             stats,
@@ -163,31 +279,72 @@ def _process_file(file_path, input_root, output_root, in_place, dry_run):
                 "series": "N/A",
                 "action": "ERROR",
                 "status": "CROP_FAILED_999" if is_999 else "READ_FAILED",
-                "details": str(exc).replace(",", ";"),
+                "details": str(exc),
             },
         )
 
 
-def _write_dicom(ds, target_path):
-    # Force an uncompressed transfer syntax to safely persist edited pixel data.
+def _write_dicom(ds, target_path, syntax=ExplicitVRLittleEndian):
+    """
+    Write ds (whose PixelData is native after cropping) in the given transfer
+    syntax. Compressed syntaxes are encoded losslessly; if encoding fails the
+    file is written as Explicit VR Little Endian instead. Returns the syntax used.
+    """
     ds.file_meta.TransferSyntaxUID = ExplicitVRLittleEndian
-    ds.is_little_endian = True
-    ds.is_implicit_VR = False
-    ds.save_as(str(target_path), write_like_original=False)
+    if syntax.is_compressed:
+        try:
+            # Lossless re-encoding of the same pixels keeps the SOP Instance UID
+            ds.compress(syntax, generate_instance_uid=False)
+        except Exception:
+            syntax = ExplicitVRLittleEndian
+    ds.file_meta.TransferSyntaxUID = syntax
+    # Explicit encoding arguments let pydicom convert big endian sources to little endian
+    pydicom.dcmwrite(
+        str(target_path), ds, implicit_vr=syntax.is_implicit_VR, little_endian=True, enforce_file_format=True
+    )
+    return syntax
+
+
+def _crop_raw_pixels(ds, crop_rows):
+    """
+    Crop by slicing the raw PixelData buffer, without decoding.
+
+    Applies to native (uncompressed) little-endian pixel data with whole-byte
+    samples: each frame (and each colour plane when PlanarConfiguration is 1)
+    is a block of Rows rows, so cropping skips crop_rows rows per block.
+    Returns the cropped bytes, or None when the data must be decoded instead
+    (encapsulated/big-endian syntaxes, 1-bit data, horizontally subsampled
+    YBR_*_422).
+    """
+    transfer_syntax = ds.file_meta.get("TransferSyntaxUID")
+    if transfer_syntax is None or transfer_syntax.is_compressed or not transfer_syntax.is_little_endian:
+        return None
+    bits_allocated = int(ds.BitsAllocated)
+    if bits_allocated % 8:
+        return None
+    if str(getattr(ds, "PhotometricInterpretation", "")).endswith("_422"):
+        return None
 
+    rows = int(ds.Rows)
+    columns = int(ds.Columns)
+    number_of_frames = int(getattr(ds, "NumberOfFrames", 1) or 1)
+    samples_per_pixel = int(getattr(ds, "SamplesPerPixel", 1) or 1)
+    planar = samples_per_pixel > 1 and int(getattr(ds, "PlanarConfiguration", 0) or 0) == 1
 
-def _crop_top_quarter(ds):
-    """Crop out the top 25% of image rows and update Rows/PixelData."""
-    if not hasattr(ds, "PixelData") or not hasattr(ds, "Rows"):
-        raise ValueError("No pixel data available")
+    row_bytes = columns * (bits_allocated // 8) * (1 if planar else samples_per_pixel)
+    blocks = number_of_frames * (samples_per_pixel if planar else 1)
+    block_bytes = rows * row_bytes
 
-    pixel_array = ds.pixel_array
-    rows = int(ds.Rows)
-    crop_rows = rows // 4
+    data = memoryview(ds.PixelData)
+    if len(data) < blocks * block_bytes:
+        raise ValueError(f"PixelData has {len(data)} bytes, expected at least {blocks * block_bytes}")
+    skip = crop_rows * row_bytes
+    return b"".join(data[i * block_bytes + skip:(i + 1) * block_bytes] for i in range(blocks))
 
-    if crop_rows <= 0:
-        return 0
 
+def _decode_and_crop(ds, crop_rows):
+    """Crop via the decoded pixel_array (needs a decoder for compressed syntaxes)."""
+    pixel_array = ds.pixel_array
     number_of_frames = int(getattr(ds, "NumberOfFrames", 1) or 1)
     samples_per_pixel = int(getattr(ds, "SamplesPerPixel", 1) or 1)
 
@@ -204,26 +361,55 @@ def _crop_top_quarter(ds):
         cropped = pixel_array[:, crop_rows:, :, :]
     else:
         raise ValueError(f"Unsupported pixel array shape: {pixel_array.shape}")
+    # Arrays decoded from big endian sources are big endian; output is always little endian
+    return cropped.astype(cropped.dtype.newbyteorder("<"), copy=False).tobytes()
+
+
+def _crop_top_quarter(ds):
+    """
+    Crop out the top 25% of image rows and update Rows/PixelData.
+    Returns (crop_rows, decoded) where decoded tells whether pixel_array was needed.
+    """
+    if not hasattr(ds, "PixelData") or not hasattr(ds, "Rows"):
+        raise ValueError("No pixel data available")
+
+    rows = int(ds.Rows)
+    # Images under 4 rows lose nothing, but compressed data is still decoded
+    # because _write_dicom always writes native pixel data.
+    crop_rows = rows // 4
+
+    cropped = _crop_raw_pixels(ds, crop_rows)
+    decoded = cropped is None
+    if decoded:
+        cropped = _decode_and_crop(ds, crop_rows)
 
     ds.Rows = rows - crop_rows
-    ds.PixelData = cropped.tobytes()
+    ds.PixelData = cropped
+    # pixel_array is always colour-by-pixel, whatever the source's planar configuration
+    if decoded and "PlanarConfiguration" in ds:
+        ds.PlanarConfiguration = 0
 
     # Remove potentially stale derived values if present.
     for keyword in ["SmallestImagePixelValue", "LargestImagePixelValue"]:
         if keyword in ds:
             del ds[keyword]
 
-    return crop_rows
+    return crop_rows, decoded
 
 
-def _print_progress(processed, total, start_time):
-    if total <= 0:
+def _print_progress(processed, discovered, start_time, walk_done):
+    """Progress line; the total is only known once traversal has finished."""
+    if discovered <= 0:
         return
     elapsed = max(time.time() - start_time, 1e-9)
-    pct = (processed / total) * 100
     rate = processed / elapsed
+    if walk_done:
+        pct = (processed / discovered) * 100
+        position = f"{processed}/{discovered} ({pct:5.1f}%)"
+    else:
+        position = f"{processed} done, {discovered} discovered so far"
     print(
-        f"\rProgress: {processed}/{total} ({pct:5.1f}%) | {rate:6.1f} files/s | elapsed {elapsed:6.1f}s",
+        f"\rProgress: {position:<40} | {rate:6.1f} files/s | elapsed {elapsed:6.1f}s",
         end="",
         flush=True,
     )
@@ -256,6 +442,34 @@ def main():
         default=max(1, min(32, (os.cpu_count() or 4) * 2)),
         help="Number of parallel worker threads (default: auto)",
     )
+    parser.add_argument(
+        "--crop-workers",
+        type=int,
+        default=0,
+        help=(
+            "Number of worker processes for decoding, cropping and writing Series 999 files; "
+            "header reads and copies stay on the --workers threads (default: 0 = crop on the threads)"
+        ),
+    )
+    parser.add_argument(
+        "--output-syntax",
+        choices=OUTPUT_SYNTAXES,
+        default="explicit",
+        help=(
+            "Transfer syntax for cropped Series 999 files: explicit (uncompressed, default), "
+            "rle (RLE Lossless), or original (source syntax, re-encoded losslessly; RLE for lossy or "
+            "unsupported sources)"
+        ),
+    )
+    parser.add_argument(
+        "--link-mode",
+        choices=LINK_MODES,
+        default="copy",
+        help=(
+            "How unchanged files are placed in --output: copy, hardlink (shares the input's inode), "
+            "reflink (copy-on-write clone) or auto (reflink where supported, else copy). Default: copy"
+        ),
+    )
     parser.add_argument(
         "--no-progress",
         action="store_true",
@@ -280,43 +494,38 @@ def main():
     if args.workers < 1:
         raise ValueError("--workers must be >= 1")
 
+    if args.crop_workers < 0:
+        raise ValueError("--crop-workers must be >= 0")
+
     log_root = input_root if args.in_place else output_root
-    log_path = _setup_log(log_root)
+    log = _setup_log(log_root)
 
     stats = {
         "total_files": 0,
         "dicom_files": 0,
         "cropped_999": 0,
+        "decoded_999": 0,
         "failed_999": 0,
         "kept_dicom": 0,
         "copied_non_dicom": 0,
         "errors": 0,
+        "bytes_parsed": 0,
+        "bytes_copied": 0,
+        "files_copied": 0,
+        "files_hardlinked": 0,
+        "files_reflinked": 0,
     }
 
     start_time = time.time()
 
-    all_files = [Path(root) / filename for root, _, files in os.walk(input_root) for filename in files]
-    total_files = len(all_files)
     processed_files = 0
+    discovered_files = 0
+    walk_done = False
     last_progress_ts = 0.0
 
-    if total_files > 0 and not args.no_progress:
-        _print_progress(0, total_files, start_time)
-
-    with ThreadPoolExecutor(max_workers=args.workers) as executor:
-        futures = [
-            executor.submit(
-                _process_file,
-                file_path,
-                input_root,
-                output_root,
-                args.in_place,
-                args.dry_run,
-            )
-            for file_path in all_files
-        ]
-
-        for future in as_completed(futures):
+    def handle_done(done):
+        nonlocal processed_files, last_progress_ts
+        for future in done:
             file_stats, log_entry = future.result()
             processed_files += 1
 
@@ -325,7 +534,7 @@ def main():
 
             if log_entry:
                 _log_event(
-                    log_path,
+                    log,
                     log_entry["file"],
                     log_entry["series"],
                     log_entry["action"],
@@ -333,13 +542,51 @@ def main():
                     log_entry["details"],
                 )
 
-            if not args.no_progress:
-                now = time.time()
-                if processed_files == total_files or now - last_progress_ts >= 0.5:
-                    _print_progress(processed_files, total_files, start_time)
-                    last_progress_ts = now
+        if not args.no_progress:
+            now = time.time()
+            if (walk_done and processed_files == discovered_files) or now - last_progress_ts >= 0.5:
+                _print_progress(processed_files, discovered_files, start_time, walk_done)
+                last_progress_ts = now
 
-    if total_files > 0 and not args.no_progress:
+    # Traversal feeds the pool as it goes: at most max_pending files are in
+    # flight, and results are drained as they finish.
+    max_pending = args.workers * PENDING_PER_WORKER
+    crop_executor = ProcessPoolExecutor(max_workers=args.crop_workers) if args.crop_workers > 0 else None
+    try:
+        with ThreadPoolExecutor(max_workers=args.workers) as executor:
+            pending = set()
+            # The walk runs while outputs are written, so an output folder inside
+            # the input must not be walked into
+            walk_exclude = [output_root] if output_root else []
+            for entry in iter_tree(input_root, sniff=False, with_stat=False, exclude=walk_exclude):
+                discovered_files += 1
+                pending.add(
+                    executor.submit(
+                        _process_file,
+                        Path(entry.path),
+                        input_root,
+                        output_root,
+                        args.in_place,
+                        args.dry_run,
+                        args.link_mode,
+                        crop_executor,
+                        args.output_syntax,
+                    )
+                )
+                if len(pending) >= max_pending:
+                    done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                    handle_done(done)
+
+            walk_done = True
+            while pending:
+                done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                handle_done(done)
+    finally:
+        if crop_executor is not None:
+            crop_executor.shutdown()
+        log.close()
+
+    if discovered_files > 0 and not args.no_progress:
         print()
 
     elapsed = time.time() - start_time
@@ -351,15 +598,26 @@ def main():
     print(f"Mode:                 {'in-place' if args.in_place else 'copy'}")
     print(f"Dry Run:              {args.dry_run}")
     print(f"Worker Threads:       {args.workers}")
+    print(f"Crop Processes:       {args.crop_workers or 'none (threads)'}")
+    print(f"Output Syntax:        {args.output_syntax}")
     print(f"Total Files Seen:     {stats['total_files']}")
     print(f"DICOM Files Seen:     {stats['dicom_files']}")
-    print(f"Series 999 Cropped:   {stats['cropped_999']}")
+    print(f"Series 999 Cropped:   {stats['cropped_999']} ({stats['decoded_999']} needed pixel decoding)")
     print(f"Series 999 Failed:    {stats['failed_999']}")
     print(f"DICOM Files Kept:     {stats['kept_dicom']}")
     if output_root:
         print(f"Non-DICOM Files Copied: {stats['copied_non_dicom']}")
     print(f"Errors:               {stats['errors']}")
-    print(f"Log File:             {log_path}")
+    print(f"Bytes Parsed:         {stats['bytes_parsed']} ({stats['bytes_parsed'] / 1e6:.1f} MB)")
+    print(f"Bytes Copied:         {stats['bytes_copied']} ({stats['bytes_copied'] / 1e6:.1f} MB)")
+    if output_root:
+        print(f"Link Mode:            {args.link_mode}")
+        print(
+            f"Files Linked:         {stats['files_hardlinked'] + stats['files_reflinked']} "
+            f"({stats['files_hardlinked']} hardlink, {stats['files_reflinked']} reflink)"
+        )
+        print(f"Files Copied:         {stats['files_copied']}")
+    print(f"Log File:             {log.path}")
     print(f"Elapsed Time:         {elapsed:.2f} seconds")
     print("-----------------------------------")
 
@@ -0,0 +1,154 @@
+import json
+import os
+import random
+import time
+from pathlib import Path
+
+# run_metrics.py
+#
+# Purpose:
+#   Per-stage timing and throughput counters for long batch runs.
+#
+#   Each stage keeps an exact count/total/max plus a bounded random sample of
+#   latencies (reservoir sampling), so p50/p95/p99 stay cheap in memory on
+#   multi-million file runs. Results can be written as JSON, or as a
+#   Prometheus text file (use a .prom suffix) for the node exporter's
+#   textfile collector.
+
+RESERVOIR_SIZE = 20000
+QUANTILES = (0.5, 0.95, 0.99)
+
+
+def _nearest_rank(ordered, q):
+    if not ordered:
+        return 0.0
+    index = min(len(ordered) - 1, max(0, int(q * len(ordered) + 0.999999) - 1))
+    return ordered[index]
+
+
+class StageStats:
+    """Latency statistics for one pipeline stage."""
+
+    __slots__ = ("count", "total", "max", "_samples", "_rng")
+
+    def __init__(self):
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+        self._samples = []
+        self._rng = random.Random(0)
+
+    def add(self, seconds):
+        self.count += 1
+        self.total += seconds
+        if seconds > self.max:
+            self.max = seconds
+        if len(self._samples) < RESERVOIR_SIZE:
+            self._samples.append(seconds)
+        else:
+            slot = self._rng.randrange(self.count)
+            if slot < RESERVOIR_SIZE:
+                self._samples[slot] = seconds
+
+    def quantile(self, q):
+        return _nearest_rank(sorted(self._samples), q)
+
+    def to_dict(self):
+        ordered = sorted(self._samples)
+        result = {"count": self.count, "total_seconds": self.total, "max_seconds": self.max}
+        for q in QUANTILES:
+            result[f"p{int(q * 100)}_seconds"] = _nearest_rank(ordered, q)
+        return result
+
+
+class RunMetrics:
+    """Collects stage latencies, byte counters and outcome counts for one run."""
+
+    def __init__(self, prefix):
+        self.prefix = prefix
+        self.started = time.time()
+        self.stages = {}
+        self.counters = {}
+        self.gauges = {}
+
+    def record(self, stage, seconds):
+        stats = self.stages.get(stage)
+        if stats is None:
+            stats = self.stages[stage] = StageStats()
+        stats.add(seconds)
+
+    def add(self, counter, amount=1):
+        self.counters[counter] = self.counters.get(counter, 0) + amount
+
+    def set_gauge(self, name, value):
+        """Record a point-in-time value such as peak memory (last value wins)."""
+        self.gauges[name] = value
+
+    def merge(self, timings):
+        """
+        Merge a worker's per-file result: keys ending in '_seconds' are stage
+        latencies, everything else is added to the counters.
+        """
+        for key, value in timings.items():
+            if key.endswith("_seconds"):
+                self.record(key[: -len("_seconds")], value)
+            else:
+                self.add(key, value)
+
+    def to_dict(self):
+        return {
+            "started": self.started,
+            "duration_seconds": time.time() - self.started,
+            "stages": {name: stats.to_dict() for name, stats in self.stages.items()},
+            "counters": dict(self.counters),
+            "gauges": dict(self.gauges),
+        }
+
+    def summary_lines(self):
+        lines = [f"{'Stage':<16}{'Count':>10}{'Total s':>11}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}"]
+        for name, stats in self.stages.items():
+            lines.append(
+                f"{name:<16}{stats.count:>10}{stats.total:>11.2f}"
+                f"{stats.quantile(0.5) * 1000:>10.2f}{stats.quantile(0.95) * 1000:>10.2f}{stats.quantile(0.99) * 1000:>10.2f}"
+            )
+        for name, value in self.counters.items():
+            if name.startswith("bytes_"):
+                lines.append(f"{name:<16}{value:>10} ({value / 1e6:.1f} MB)")
+        return lines
+
+    def write(self, path):
+        """Write JSON, or Prometheus text format when path ends in .prom (atomic rename)."""
+        path = Path(path)
+        if path.suffix == ".prom":
+            content = self._prometheus_text()
+        else:
+            content = json.dumps(self.to_dict(), indent=2) + "\n"
+        tmp_path = path.with_name(path.name + ".tmp")
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            f.write(content)
+        os.replace(tmp_path, path)
+
+    def _prometheus_text(self):
+        p = self.prefix
+        data = self.to_dict()
+        lines = [
+            f"# HELP {p}_stage_seconds Time spent per item in each pipeline stage.",
+            f"# TYPE {p}_stage_seconds summary",
+        ]
+        for name, stats in data["stages"].items():
+            for q in QUANTILES:
+                value = stats[f"p{int(q * 100)}_seconds"]
+                lines.append(f'{p}_stage_seconds{{stage="{name}",quantile="{q}"}} {value:.6f}')
+            lines.append(f'{p}_stage_seconds_sum{{stage="{name}"}} {stats["total_seconds"]:.6f}')
+            lines.append(f'{p}_stage_seconds_count{{stage="{name}"}} {stats["count"]}')
+        for name, value in data["counters"].items():
+            lines.append(f"# TYPE {p}_{name}_total counter")
+            lines.append(f"{p}_{name}_total {value}")
+        for name, value in data["gauges"].items():
+            lines.append(f"# TYPE {p}_{name} gauge")
+            lines.append(f"{p}_{name} {value}")
+        lines.append(f"# TYPE {p}_run_duration_seconds gauge")
+        lines.append(f"{p}_run_duration_seconds {data['duration_seconds']:.3f}")
+        lines.append(f"# TYPE {p}_run_start_timestamp_seconds gauge")
+        lines.append(f"{p}_run_start_timestamp_seconds {data['started']:.0f}")
+        return "\n".join(lines) + "\n"
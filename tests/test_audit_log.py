@@ -0,0 +1,74 @@
+import csv
+import threading
+
+from audit_log import AuditLogWriter
+
+
+def read_rows(path):
+    with open(path, newline="", encoding="utf-8") as f:
+        return list(csv.reader(f))
+
+
+def test_rows_reach_disk_every_flush_rows(tmp_path):
+    path = tmp_path / "log.csv"
+    log = AuditLogWriter(path, ["File", "Status"], flush_rows=3, flush_interval=3600)
+    # The header is on disk straight away
+    assert read_rows(path) == [["Timestamp", "File", "Status"]]
+    log.write(["a.dcm", "SUCCESS"])
+    log.write(["b.dcm", "SUCCESS"])
+    assert len(read_rows(path)) == 1
+    log.write(["c.dcm", "SUCCESS"])
+    assert [row[1] for row in read_rows(path)[1:]] == ["a.dcm", "b.dcm", "c.dcm"]
+    log.write(["d.dcm", "SUCCESS"])
+    log.close()
+    assert len(read_rows(path)) == 5
+
+
+def test_rows_reach_disk_after_flush_interval(tmp_path):
+    path = tmp_path / "log.csv"
+    log = AuditLogWriter(path, ["File"], flush_rows=1000, flush_interval=0)
+    log.write(["a.dcm"])
+    assert read_rows(path)[1][1] == "a.dcm"
+    log.close()
+
+
+def test_values_with_commas_and_newlines_stay_one_field(tmp_path):
+    path = tmp_path / "log.csv"
+    status = 'ERROR: bad value "x", line 1\nline 2'
+    with AuditLogWriter(path, ["File", "Status"]) as log:
+        log.write(["dir, with comma/a.dcm", status])
+    assert read_rows(path)[1][1:] == ["dir, with comma/a.dcm", status]
+
+
+def test_append_extends_an_existing_log_without_a_second_header(tmp_path):
+    path = tmp_path / "manifest.csv"
+    with AuditLogWriter(path, ["File"], append=True) as log:
+        log.write(["a.dcm"])
+    with AuditLogWriter(path, ["File"], append=True) as log:
+        log.write(["b.dcm"])
+    rows = read_rows(path)
+    assert rows[0] == ["Timestamp", "File"]
+    assert [row[1] for row in rows[1:]] == ["a.dcm", "b.dcm"]
+
+    # Without append the log starts over
+    with AuditLogWriter(path, ["File"]) as log:
+        log.write(["c.dcm"])
+    assert [row[1] for row in read_rows(path)[1:]] == ["c.dcm"]
+
+
+def test_concurrent_writes_keep_rows_whole(tmp_path):
+    path = tmp_path / "log.csv"
+    log = AuditLogWriter(path, ["Thread", "Row"], flush_rows=7)
+
+    def write_rows(thread):
+        for i in range(200):
+            log.write([thread, i])
+
+    threads = [threading.Thread(target=write_rows, args=(thread,)) for thread in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    log.close()
+    rows = read_rows(path)[1:]
+    assert sorted((int(row[1]), int(row[2])) for row in rows) == [(t, i) for t in range(4) for i in range(200)]
@@ -0,0 +1,304 @@
+import csv
+import json
+import os
+import shutil
+
+import pydicom
+import pytest
+from pydicom.uid import generate_uid
+
+import deid_tool
+from anonymization_plan import keyed_uid
+from deid_tool import MANIFEST_NAME, NUMBERING_NAME, DeidEngine, default_state_dir
+from make_test_cohort import generate_cohort
+
+UID_KEY = "deid-engine-test"
+
+pytestmark = pytest.mark.filterwarnings("ignore")
+
+
+@pytest.fixture
+def cohort(tmp_path):
+    """(input root, mapping CSV) for two patients with two accessions each."""
+    input_root, csv_path = tmp_path / "raw_input", tmp_path / "mapping.csv"
+    generate_cohort(input_root, csv_path, 2, accessions=2, series=1, instances=2, seed=5)
+    return input_root, csv_path
+
+
+def output_files(output_root):
+    """{relative path: bytes} of the de-identified files (logs and state excluded)."""
+    return {
+        str(path.relative_to(output_root)): path.read_bytes()
+        for path in sorted(output_root.rglob("*"))
+        if path.is_file() and not path.name.startswith("deid_")
+    }
+
+
+def test_batches_never_share_an_accession_folder(cohort, tmp_path):
+    input_root, csv_path = cohort
+    output_root = tmp_path / "deid_output"
+    batches = sorted(path for path in input_root.glob("*/*") if path.is_dir())
+    assert len(batches) == 4
+
+    # One accession per run, each from a fresh engine like separate command line calls
+    written = {}
+    for batch in batches:
+        summary = DeidEngine(csv_path, uid_key=UID_KEY).run(input_root, output_root, paths=[batch])
+        assert summary["success"] > 0 and summary["fail"] == 0
+        files = output_files(output_root)
+        new_files = {name: data for name, data in files.items() if name not in written}
+        # Earlier batches are left untouched and every batch gets an accession folder of its own
+        assert {name: files[name] for name in written} == written
+        new_dirs = {name.rsplit("/", 2)[0] for name in new_files}
+        assert len(new_dirs) == 1
+        assert not any(name.startswith(tuple(new_dirs)) for name in written)
+        written.update(new_files)
+
+    accession_numbers = {}
+    for name in written:
+        if name.endswith(".dcm"):
+            accession_numbers.setdefault(name.split("/")[1], set()).add(pydicom.dcmread(output_root / name).AccessionNumber)
+    assert len(accession_numbers) == 4
+    assert len(set.union(*accession_numbers.values())) == 4
+
+    # Running a batch again reuses its numbers
+    DeidEngine(csv_path, uid_key=UID_KEY).run(input_root, output_root, paths=[batches[0]])
+    assert output_files(output_root) == written
+
+
+def test_paths_outside_input_root_are_rejected(cohort, tmp_path):
+    input_root, csv_path = cohort
+    with pytest.raises(ValueError, match="not inside the input root"):
+        DeidEngine(csv_path, uid_key=UID_KEY).run(input_root, tmp_path / "out", paths=[tmp_path])
+
+
+def test_numbering_and_uid_key_stay_out_of_the_output_tree(cohort, tmp_path):
+    input_root, csv_path = cohort
+    output_root = tmp_path / "deid_output"
+    DeidEngine(csv_path).run(input_root, output_root)
+    assert not list(output_root.rglob(NUMBERING_NAME))
+    state_path = default_state_dir(csv_path, output_root) / NUMBERING_NAME
+    assert state_path.parent.parent == tmp_path / "deid_state"
+    state = json.loads(state_path.read_text())
+    assert state["uid_key"] and len(state["accession_map"]) == 4
+
+    # An explicit state_dir is used as given
+    state_dir = tmp_path / "private"
+    DeidEngine(csv_path, state_dir=state_dir).run(input_root, tmp_path / "other_output")
+    assert (state_dir / NUMBERING_NAME).exists()
+    assert not list((tmp_path / "other_output").rglob(NUMBERING_NAME))
+
+
+def test_numbering_saved_in_the_output_root_is_moved_out(cohort, tmp_path):
+    input_root, csv_path = cohort
+    output_root = tmp_path / "deid_output"
+    DeidEngine(csv_path).run(input_root, output_root)
+    first = output_files(output_root)
+
+    # Output folder as written by earlier versions: the numbering sits in its root
+    state_path = default_state_dir(csv_path, output_root) / NUMBERING_NAME
+    shutil.move(state_path, output_root / NUMBERING_NAME)
+    DeidEngine(csv_path).run(input_root, output_root)
+    assert not (output_root / NUMBERING_NAME).exists()
+    assert state_path.exists()
+    # Same key and numbering, so the same files
+    assert output_files(output_root) == first
+
+
+def test_dataframe_mapping_needs_a_state_dir(cohort, tmp_path):
+    pandas = pytest.importorskip("pandas")
+    input_root, csv_path = cohort
+    mapping = pandas.read_csv(csv_path, dtype=str)
+    with pytest.raises(ValueError, match="state_dir"):
+        DeidEngine(mapping).run(input_root, tmp_path / "out")
+    summary = DeidEngine(mapping, state_dir=tmp_path / "state").run(input_root, tmp_path / "out")
+    assert summary["success"] > 0 and summary["fail"] == 0
+
+
+def test_series_cache_is_bounded(cohort):
+    input_root, csv_path = cohort
+    paths = sorted(input_root.rglob("*.dcm"))
+    series = {pydicom.dcmread(path).SeriesInstanceUID for path in paths}
+    assert len(series) > 2
+
+    bounded = DeidEngine(csv_path, uid_key=UID_KEY, max_cached_series=2)
+    unbounded = DeidEngine(csv_path, uid_key=UID_KEY)
+    for _ in range(2):
+        for path in paths:
+            expected = unbounded.deidentify(path.read_bytes())
+            result = bounded.deidentify(path.read_bytes())
+            assert len(bounded.series_groups) <= 2
+            # A series dropped from the cache keeps its accession and UIDs
+            assert (result.outcome, result.new_accession, result.data) == (expected.outcome, expected.new_accession, expected.data)
+    assert len(unbounded.series_groups) == len(series)
+
+
+def manifest_rows(output_root):
+    with open(output_root / MANIFEST_NAME, newline="", encoding="utf-8") as f:
+        return list(csv.DictReader(f))
+
+
+def touch(path):
+    stat = path.stat()
+    os.utime(path, ns=(stat.st_atime_ns, stat.st_mtime_ns + 10**9))
+
+
+def test_resume_skips_only_unchanged_finished_inputs(cohort, tmp_path):
+    input_root, csv_path = cohort
+    output_root = tmp_path / "deid_output"
+    first = DeidEngine(csv_path, uid_key=UID_KEY).run(input_root, output_root)
+    done = first["success"] + first["skipped_999_dose_reports"]
+    rows = manifest_rows(output_root)
+    assert len(rows) == done
+    written = output_files(output_root)
+
+    again = DeidEngine(csv_path, uid_key=UID_KEY).run(input_root, output_root, resume=True)
+    assert (again["unchanged"], again["success"], again["skipped_999_dose_reports"]) == (done, 0, 0)
+    assert output_files(output_root) == written
+
+    # A modified input and an input whose output went missing are done again
+    success_rows = [row for row in rows if row["Status"] == "SUCCESS"]
+    touch(input_root / success_rows[0]["Input_File"])
+    (output_root / success_rows[1]["Output_File"]).unlink()
+    resumed = DeidEngine(csv_path, uid_key=UID_KEY).run(input_root, output_root, resume=True)
+    assert (resumed["unchanged"], resumed["success"]) == (done - 2, 2)
+    assert output_files(output_root) == written
+    # Runs append to the manifest; unchanged inputs add no rows
+    assert len(manifest_rows(output_root)) == done + 2
+
+
+def test_resume_with_hash_recognises_touched_identical_inputs(cohort, tmp_path):
+    input_root, csv_path = cohort
+    output_root = tmp_path / "deid_output"
+    DeidEngine(csv_path, uid_key=UID_KEY, use_hash=True).run(input_root, output_root)
+    rows = manifest_rows(output_root)
+    assert all(len(row["SHA256"]) == 64 for row in rows)
+    touched = next(row for row in rows if row["Status"] == "SUCCESS")
+    touch(input_root / touched["Input_File"])
+
+    hashed = DeidEngine(csv_path, uid_key=UID_KEY, use_hash=True).run(input_root, output_root, resume=True)
+    assert (hashed["unchanged"], hashed["success"]) == (len(rows), 0)
+    touch(input_root / touched["Input_File"])
+    unhashed = DeidEngine(csv_path, uid_key=UID_KEY).run(input_root, output_root, resume=True)
+    assert (unhashed["unchanged"], unhashed["success"]) == (len(rows) - 1, 1)
+
+
+def test_resume_retries_failed_inputs(cohort, tmp_path):
+    input_root, csv_path = cohort
+    output_root = tmp_path / "deid_output"
+    unmapped = next(input_root.rglob("*.dcm"))
+    ds = pydicom.dcmread(unmapped)
+    ds.PatientID, ds.AccessionNumber = "NOPE", "NOPE2"
+    ds.save_as(unmapped)
+
+    first = DeidEngine(csv_path, uid_key=UID_KEY).run(input_root, output_root)
+    assert first["fail"] == 1
+    second = DeidEngine(csv_path, uid_key=UID_KEY).run(input_root, output_root, resume=True)
+    assert (second["fail"], second["success"]) == (1, 0)
+    statuses = [row["Status"] for row in manifest_rows(output_root) if row["Input_File"] == str(unmapped.relative_to(input_root))]
+    assert len(statuses) == 2 and all(status.startswith("ERROR") for status in statuses)
+
+
+def series_files(input_root):
+    """{SeriesInstanceUID: [paths]} of the cohort (some files have no .dcm extension)."""
+    series = {}
+    for path in sorted(path for path in input_root.rglob("*") if path.is_file()):
+        series.setdefault(pydicom.dcmread(path).SeriesInstanceUID, []).append(path)
+    return series
+
+
+def count_file_plans(monkeypatch):
+    calls = []
+    build_file_plan = deid_tool._build_file_plan
+
+    def counting(raw_path, *args):
+        calls.append(raw_path)
+        return build_file_plan(raw_path, *args)
+
+    monkeypatch.setattr(deid_tool, "_build_file_plan", counting)
+    return calls
+
+
+def test_mapping_is_decided_once_per_series(cohort, monkeypatch):
+    input_root, csv_path = cohort
+    series = series_files(input_root)
+    assert any(len(paths) > 1 for paths in series.values())
+    calls = count_file_plans(monkeypatch)
+    plans = DeidEngine(csv_path, uid_key=UID_KEY).plan([path for paths in series.values() for path in paths], input_root)
+    assert len(calls) == len(series)
+    for paths in series.values():
+        decisions = {(plan["new_id"], plan["new_accession"], plan["days_offset"], plan["skip_reason"]) for plan in plans if plan["input_path"] in paths}
+        assert len(decisions) == 1
+
+
+def test_instance_disagreeing_with_its_series_is_planned_on_its_own(cohort, tmp_path):
+    input_root, csv_path = cohort
+    patient_dir = sorted(input_root.iterdir())[0]
+    first_accession, second_accession = sorted(path for path in patient_dir.iterdir() if path.is_dir())
+    paths = sorted(path for path in (first_accession / "SER001").iterdir())
+    moved = pydicom.dcmread(paths[-1])
+    moved.AccessionNumber = pydicom.dcmread(next((second_accession / "SER001").iterdir())).AccessionNumber
+    moved.save_as(paths[-1])
+
+    engine = DeidEngine(csv_path, uid_key=UID_KEY)
+    plans = engine.plan(paths, input_root)
+    assert plans[-1]["series_mismatch"] == ["AccessionNumber"]
+    assert plans[-1]["new_accession"] != plans[0]["new_accession"]
+    assert all(plan["series_mismatch"] is None for plan in plans[:-1])
+    assert engine.series_groups[plans[-1]["series_key"]]["inconsistent"] == 1
+
+    output_root = tmp_path / "deid_output"
+    engine.run(input_root, output_root)
+    series_log = next(output_root.glob("deid_series_log_*.csv"))
+    with open(series_log, newline="", encoding="utf-8") as f:
+        statuses = {row["Series_UID"]: row["Status"] for row in csv.DictReader(f)}
+    assert statuses[moved.SeriesInstanceUID] == "INCONSISTENT"
+
+
+def test_failed_lookup_is_reused_for_the_rest_of_the_series(cohort, monkeypatch):
+    input_root, csv_path = cohort
+    paths = next(paths for paths in series_files(input_root).values() if len(paths) > 1)
+    for path in paths:
+        ds = pydicom.dcmread(path)
+        ds.PatientID, ds.AccessionNumber = "NOPE", "NOPE2"
+        ds.save_as(path)
+    calls = count_file_plans(monkeypatch)
+    plans = DeidEngine(csv_path, uid_key=UID_KEY).plan(paths, input_root)
+    assert len(calls) == 1
+    assert all(plan["skip_reason"].startswith("ERROR: No mapping found") for plan in plans)
+
+
+def test_keyed_uids_are_valid_and_depend_on_the_key():
+    old = "1.2.840.113619.2.55.3.604688119.969.1268071029.320"
+    new = keyed_uid(old, "a")
+    assert new == keyed_uid(old, "a") != keyed_uid(old, "b")
+    assert new != keyed_uid(old + "1", "a")
+    assert new.startswith("2.25.") and len(new) <= 64 and int(new[5:]) < 2**128
+
+
+def test_later_runs_give_a_study_the_same_new_uids(cohort, tmp_path):
+    input_root, csv_path = cohort
+    output_root = tmp_path / "deid_output"
+    # No uid_key: the first run draws one and saves it with the numbering
+    DeidEngine(csv_path).run(input_root, output_root)
+
+    # A late instance of an existing series arrives
+    sibling = next(path for path in sorted(input_root.rglob("*.dcm")) if pydicom.dcmread(path).SeriesNumber != 999)
+    late = sibling.with_name("late.dcm")
+    ds = pydicom.dcmread(sibling)
+    ds.SOPInstanceUID = generate_uid()
+    ds.save_as(late)
+    summary = DeidEngine(csv_path).run(input_root, output_root, resume=True)
+    assert summary["success"] == 1
+
+    written = {path.name: pydicom.dcmread(path) for path in output_root.rglob("*.dcm") if path.name in (sibling.name, late.name)}
+    assert len(written) == 2
+    first, second = written[sibling.name], written[late.name]
+    assert (second.StudyInstanceUID, second.SeriesInstanceUID) == (first.StudyInstanceUID, first.SeriesInstanceUID)
+    assert second.SOPInstanceUID != first.SOPInstanceUID
+    assert first.StudyInstanceUID != pydicom.dcmread(sibling).StudyInstanceUID
+
+    # An explicit key wins over the saved one
+    DeidEngine(csv_path, uid_key="another key").run(input_root, output_root)
+    rewritten = pydicom.dcmread(next(output_root.rglob(late.name)))
+    assert rewritten.StudyInstanceUID != second.StudyInstanceUID
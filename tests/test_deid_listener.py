@@ -0,0 +1,118 @@
+import json
+import re
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import pydicom
+import pytest
+from pydicom.uid import generate_uid
+
+from deid_listener import STATUS_CANNOT_UNDERSTAND, STATUS_OUT_OF_RESOURCES, STATUS_SUCCESS, DeidListener, start_server
+from deid_tool import NUMBERING_NAME, DeidEngine, default_state_dir
+from make_test_cohort import generate_cohort
+
+pynetdicom = pytest.importorskip("pynetdicom")
+
+UID_KEY = "deid-listener-test"
+
+pytestmark = pytest.mark.filterwarnings("ignore")
+
+
+@pytest.fixture
+def cohort(tmp_path):
+    """(DICOM files of two patients without dose reports, mapping CSV)."""
+    input_root, csv_path = tmp_path / "raw_input", tmp_path / "mapping.csv"
+    generate_cohort(input_root, csv_path, 2, accessions=1, series=2, instances=2, seed=7)
+    paths = [path for path in sorted(input_root.rglob("*.dcm")) if pydicom.dcmread(path).SeriesNumber != 999]
+    return paths, csv_path
+
+
+@pytest.fixture
+def serve(tmp_path):
+    """serve(listener) starts an SCP for it on a free local port and returns the port."""
+    started = []
+
+    def start(listener):
+        server = start_server(listener, "127.0.0.1", 0)
+        started.append((server, listener))
+        return server.server_address[1]
+
+    yield start
+    for server, listener in started:
+        server.shutdown()
+        listener.close()
+
+
+def send(port, datasets, after_each=None):
+    """C-STORE datasets over one association; returns their status codes."""
+    ae = pynetdicom.AE(ae_title="TEST_SCU")
+    for ds in datasets:
+        ae.add_requested_context(ds.SOPClassUID, ds.file_meta.TransferSyntaxUID)
+    assoc = ae.associate("127.0.0.1", port)
+    assert assoc.is_established
+    statuses = []
+    try:
+        for ds in datasets:
+            statuses.append(assoc.send_c_store(ds).Status)
+            if after_each is not None:
+                after_each(ds)
+    finally:
+        assoc.release()
+    return statuses
+
+
+def test_received_instances_are_filed_by_series(cohort, tmp_path, serve):
+    paths, csv_path = cohort
+    output_root = tmp_path / "deid_output"
+    listener = DeidListener(DeidEngine(csv_path, uid_key=UID_KEY), output_root, workers=1)
+    port = serve(listener)
+
+    unmapped = pydicom.dcmread(paths[0])
+    unmapped.PatientID = "NOPE"
+    unmapped.AccessionNumber = "NOPE2"
+    unmapped.SOPInstanceUID = generate_uid()
+    datasets = [pydicom.dcmread(path) for path in paths] + [unmapped]
+
+    state_path = default_state_dir(csv_path, output_root) / NUMBERING_NAME
+    saved_accessions = []
+
+    def record_saved_numbering(ds):
+        saved_accessions.append(len(json.loads(state_path.read_text())["accession_map"]))
+
+    statuses = send(port, datasets, after_each=record_saved_numbering)
+    assert statuses == [STATUS_SUCCESS] * len(paths) + [STATUS_CANNOT_UNDERSTAND]
+    # Each patient's accession number is on disk once its first instance is acknowledged
+    assert saved_accessions[0] == 1 and saved_accessions[-1] == 2
+
+    listener.executor.shutdown(wait=True)
+    written = sorted(path.relative_to(output_root) for path in output_root.rglob("*.dcm"))
+    assert len(written) == len(paths)
+    layout = re.compile(r"(?P<new_id>[^/]+)/(?P=new_id)_1/SER\d{3}/[0-9a-f]{32}\.dcm")
+    for path in written:
+        assert layout.fullmatch(path.as_posix()), path
+        ds = pydicom.dcmread(output_root / path)
+        assert f"SER{int(ds.SeriesNumber):03d}" == path.parts[2]
+        assert ds.AccessionNumber == path.parts[1]
+    assert not list(output_root.rglob(NUMBERING_NAME))
+    assert listener.stats["success"] == len(paths) and listener.stats["fail"] == 1
+
+
+def test_busy_listener_answers_out_of_resources(cohort, tmp_path, serve):
+    paths, csv_path = cohort
+    listener = DeidListener(DeidEngine(csv_path, uid_key=UID_KEY), tmp_path / "deid_output", workers=1, max_pending=1)
+    # Hold the worker so the first instance stays pending
+    listener.executor.shutdown()
+    listener.executor = ThreadPoolExecutor(max_workers=1)
+    gate = threading.Event()
+    listener.executor.submit(gate.wait)
+    port = serve(listener)
+
+    datasets = [pydicom.dcmread(path) for path in paths[:2]]
+    try:
+        assert send(port, datasets) == [STATUS_SUCCESS, STATUS_OUT_OF_RESOURCES]
+    finally:
+        gate.set()
+    # Runs after the queued instance, whose slot is then free again
+    listener.executor.submit(int).result()
+    assert send(port, datasets[1:]) == [STATUS_SUCCESS]
+    assert listener.stats["refused_busy"] == 1
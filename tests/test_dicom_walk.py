@@ -0,0 +1,58 @@
+import os
+
+import pydicom
+import pytest
+from pydicom.data import get_testdata_file
+
+from dicom_walk import iter_tree, scan_tree
+
+
+@pytest.fixture
+def tree(tmp_path):
+    """Raw-export-like tree with .dcm, extensionless DICOM and non-DICOM files."""
+    root = tmp_path / "raw"
+    source = pydicom.dcmread(get_testdata_file("CT_small.dcm"))
+    for rel in ("p1/A1/DICOM/1.dcm", "p1/A1/DICOM/IM000002", "p1/A1/notes.txt", "p1/A2/3.DCM",
+                "p2/B1/S1/S2/IM000004", "p2/B1/DICOMDIR", "p2/readme", "top.dcm"):
+        path = root / rel
+        path.parent.mkdir(parents=True, exist_ok=True)
+        if rel.endswith(("txt", "readme")):
+            path.write_text("not DICOM")
+        elif rel.endswith("DICOMDIR"):
+            path.write_bytes(b"\x00" * 128 + b"DICM")
+        else:
+            source.save_as(path)
+    (root / "p2" / "link").symlink_to(root / "p1", target_is_directory=True)
+    return root
+
+
+def test_files_come_in_os_walk_order_with_their_stat(tree):
+    walked = [os.path.join(dirpath, name) for dirpath, _, names in os.walk(tree) for name in names]
+    entries = list(iter_tree(tree))
+    assert [entry.path for entry in entries] == walked
+    for entry in entries:
+        st = os.stat(entry.path)
+        assert (entry.name, entry.size, entry.mtime_ns) == (os.path.basename(entry.path), st.st_size, st.st_mtime_ns)
+
+    assert all(entry.size is None and entry.mtime_ns is None for entry in iter_tree(tree, with_stat=False))
+
+
+def test_dicom_files_are_found_by_extension_or_dicm_magic(tree):
+    # The earlier os.walk + .dcm suffix check found only these
+    by_extension = {"p1/A1/DICOM/1.dcm", "p1/A2/3.DCM", "top.dcm"}
+    dicom = {os.path.relpath(entry.path, tree) for entry in iter_tree(tree) if entry.is_dicom}
+    assert dicom == by_extension | {"p1/A1/DICOM/IM000002", "p2/B1/S1/S2/IM000004"}
+
+    no_sniff = {os.path.relpath(entry.path, tree) for entry in iter_tree(tree, sniff=False) if entry.is_dicom}
+    assert no_sniff == by_extension
+
+
+def test_scan_records_two_directory_levels_and_skips_excluded(tree):
+    scan = scan_tree(tree)
+    # The symlinked directory is listed but not entered
+    assert list(scan.level2_dirs()) == [("p1", ["A1", "A2"]), ("p2", ["B1", "link"])]
+    assert not any("link" in entry.path for entry in scan.files)
+
+    scan = scan_tree(tree, exclude=[tree / "p1"])
+    assert [top_level for top_level, _ in scan.level2_dirs()] == ["p2"]
+    assert not any(entry.path.startswith(str(tree / "p1")) for entry in scan.files)
@@ -0,0 +1,116 @@
+import errno
+import os
+
+import pytest
+
+import file_transfer
+from file_transfer import transfer_file
+
+
+@pytest.fixture(autouse=True)
+def fresh_support_cache(monkeypatch):
+    monkeypatch.setattr(file_transfer, "_unsupported", set())
+
+
+@pytest.fixture
+def source(tmp_path):
+    path = tmp_path / "in.dcm"
+    path.write_bytes(os.urandom(300_000))
+    os.utime(path, ns=(1_600_000_000_000_000_000, 1_600_000_000_000_000_000))
+    return path
+
+
+def assert_copied(source, target):
+    assert target.read_bytes() == source.read_bytes()
+    assert target.stat().st_mtime_ns == source.stat().st_mtime_ns
+    assert not os.path.samefile(source, target)
+
+
+def test_copy_keeps_content_and_times(source, tmp_path):
+    target = tmp_path / "out.dcm"
+    assert transfer_file(source, target) == "copy"
+    assert_copied(source, target)
+
+
+def test_hardlink_shares_the_inode(source, tmp_path):
+    target = tmp_path / "out.dcm"
+    assert transfer_file(source, target, "hardlink") == "hardlink"
+    assert os.path.samefile(source, target)
+    # Linking again replaces the existing entry
+    assert transfer_file(source, target, "hardlink") == "hardlink"
+
+
+def test_copy_over_a_leftover_hardlink_leaves_the_input_alone(source, tmp_path):
+    target = tmp_path / "out.dcm"
+    transfer_file(source, target, "hardlink")
+    original = source.read_bytes()
+    assert transfer_file(source, target, "copy") == "copy"
+    target.write_bytes(b"changed")
+    assert source.read_bytes() == original
+
+
+@pytest.mark.parametrize("link_mode", ["reflink", "auto"])
+def test_reflink_falls_back_to_copy_once_per_device_pair(source, tmp_path, monkeypatch, link_mode):
+    attempts = []
+
+    def unsupported(src, dst):
+        attempts.append(dst)
+        raise OSError(errno.EOPNOTSUPP, "no reflink here")
+
+    monkeypatch.setattr(file_transfer, "_reflink", unsupported)
+    for name in ("a.dcm", "b.dcm"):
+        assert transfer_file(source, tmp_path / name, link_mode) == "copy"
+        assert_copied(source, tmp_path / name)
+    assert len(attempts) == 1
+
+
+def test_auto_never_hardlinks(source, tmp_path, monkeypatch):
+    def unsupported(src, dst):
+        raise OSError(errno.ENOTTY, "no reflink here")
+
+    def link(src, dst):
+        pytest.fail("auto must not hardlink")
+
+    monkeypatch.setattr(file_transfer, "_reflink", unsupported)
+    monkeypatch.setattr(os, "link", link)
+    assert transfer_file(source, tmp_path / "out.dcm", "auto") == "copy"
+
+
+def test_hardlink_across_devices_falls_back_to_copy(source, tmp_path, monkeypatch):
+    def cross_device(src, dst):
+        raise OSError(errno.EXDEV, "Invalid cross-device link")
+
+    monkeypatch.setattr(os, "link", cross_device)
+    assert transfer_file(source, tmp_path / "out.dcm", "hardlink") == "copy"
+    assert_copied(source, tmp_path / "out.dcm")
+
+
+def test_other_errors_are_not_hidden(source, tmp_path, monkeypatch):
+    def broken(src, dst):
+        raise OSError(errno.EIO, "I/O error")
+
+    monkeypatch.setattr(file_transfer, "_reflink", broken)
+    with pytest.raises(OSError) as excinfo:
+        transfer_file(source, tmp_path / "out.dcm", "reflink")
+    assert excinfo.value.errno == errno.EIO
+
+
+@pytest.mark.skipif(not hasattr(os, "copy_file_range"), reason="no copy_file_range")
+def test_kernel_copy_falls_back_to_userspace(source, tmp_path, monkeypatch):
+    copied = []
+
+    def partial_then_unsupported(fd_in, fd_out, count):
+        if not copied:
+            # Some bytes already moved before the kernel gives up
+            copied.append(os.write(fd_out, os.read(fd_in, 1000)))
+            return copied[-1]
+        raise OSError(errno.ENOSYS, "not supported")
+
+    monkeypatch.setattr(os, "copy_file_range", partial_then_unsupported)
+    assert transfer_file(source, tmp_path / "out.dcm") == "copy"
+    assert_copied(source, tmp_path / "out.dcm")
+
+
+def test_unknown_link_mode(source, tmp_path):
+    with pytest.raises(ValueError, match="Unknown link mode"):
+        transfer_file(source, tmp_path / "out.dcm", "symlink")
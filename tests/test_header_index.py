@@ -0,0 +1,74 @@
+import os
+
+import pydicom
+import pytest
+
+from deid_tool import DeidEngine
+from header_index import INDEX_NAME, INDEXED_TAGS, HeaderIndex, HeaderRecord
+from make_test_cohort import generate_cohort
+
+pytestmark = pytest.mark.filterwarnings("ignore")
+
+
+def record(**values):
+    return HeaderRecord([values.get(tag) for tag in INDEXED_TAGS])
+
+
+@pytest.fixture
+def index(tmp_path):
+    index = HeaderIndex(tmp_path / INDEX_NAME)
+    yield index
+    index.close()
+
+
+def test_entries_are_only_trusted_while_size_and_mtime_match(index):
+    index.put("/raw/a.dcm", 100, 5, record(PatientID="1", SeriesNumber="2"))
+    cached = index.get("/raw/a.dcm", 100, 5)
+    assert (cached.PatientID, cached.SeriesNumber, cached.AccessionNumber) == ("1", "2", None)
+    assert index.get("/raw/a.dcm", 101, 5) is None
+    assert index.get("/raw/a.dcm", 100, 6) is None
+    assert index.get("/raw/b.dcm", 100, 5) is None
+
+    # A re-read replaces the entry
+    index.put("/raw/a.dcm", 101, 6, record(PatientID="3"))
+    assert index.get("/raw/a.dcm", 100, 5) is None
+    assert index.get("/raw/a.dcm", 101, 6).PatientID == "3"
+
+
+def test_prune_only_drops_unseen_files_below_root(index):
+    for path in ("/raw/a/1.dcm", "/raw/a/2.dcm", "/raw/ab/3.dcm", "/raw/b/4.dcm"):
+        index.put(path, 1, 1, record(PatientID=path))
+    assert index.prune("/raw/a", ["/raw/a/1.dcm"]) == 1
+    assert index.get("/raw/a/2.dcm", 1, 1) is None
+    # /raw/ab shares the prefix but is not below /raw/a
+    for path in ("/raw/a/1.dcm", "/raw/ab/3.dcm", "/raw/b/4.dcm"):
+        assert index.get(path, 1, 1) is not None
+
+
+def test_stats(index):
+    index.put("/raw/1.dcm", 1, 1, record(PatientID="1", AccessionNumber="A", StudyInstanceUID="s1", SeriesInstanceUID="1.1", SeriesNumber="1"))
+    index.put("/raw/2.dcm", 1, 1, record(PatientID="1", AccessionNumber="A", StudyInstanceUID="s1", SeriesInstanceUID="1.2", SeriesNumber=" 999"))
+    index.put("/raw/3.dcm", 1, 1, record(PatientID="2", AccessionNumber="A", StudyInstanceUID="s2", SeriesInstanceUID="2.1", SeriesNumber="1"))
+    assert index.stats() == {"files": 3, "patients": 2, "accessions": 2, "studies": 2, "series": 3, "series_999": 1}
+
+
+def test_changed_file_is_read_again(tmp_path):
+    input_root, csv_path = tmp_path / "raw_input", tmp_path / "mapping.csv"
+    generate_cohort(input_root, csv_path, 1, accessions=1, series=2, instances=2, seed=9)
+    output_root = tmp_path / "deid_output"
+    engine = DeidEngine(csv_path, uid_key="header-index-test")
+    first = engine.run(input_root, output_root)
+    total = first["success"] + first["skipped_999_dose_reports"]
+
+    changed = next(path for path in sorted(input_root.rglob("*.dcm")) if pydicom.dcmread(path).SeriesNumber != 999)
+    ds = pydicom.dcmread(changed)
+    ds.SeriesNumber = 999
+    ds.save_as(changed)
+    stat = changed.stat()
+    # Newer mtime even on coarse-grained filesystems
+    os.utime(changed, ns=(stat.st_atime_ns, stat.st_mtime_ns + 10**9))
+
+    second = engine.run(input_root, output_root)
+    assert second["metrics"].counters["header_index_hits"] == total - 1
+    # The cached SeriesNumber is not used for the changed file
+    assert second["skipped_999_dose_reports"] == first["skipped_999_dose_reports"] + 1
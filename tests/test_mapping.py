@@ -0,0 +1,117 @@
+import logging
+
+import pytest
+
+from deid_tool import DeidEngine, _build_mapping_index, _find_mapping_row, load_mapping
+
+HEADER = "MRN,Accession,New_Patient_ID,Surgery_Date,Anchor_Date,Notes"
+
+
+def mapping_index(tmp_path, *rows):
+    path = tmp_path / "mapping.csv"
+    path.write_text("\n".join([HEADER, *rows]) + "\n", encoding="utf-8")
+    return _build_mapping_index(load_mapping(path))
+
+
+def test_lookup_order_mrn_then_accession_then_swapped(tmp_path):
+    index = mapping_index(
+        tmp_path,
+        "00123,A1,RS_01,2025-01-10,,",
+        "456,A2,RS_02,2025-01-10,,",
+    )
+    record, status = _find_mapping_row(index, "00123", "A2")
+    assert (record.new_id, status) == ("RS_01", "mrn:MRN")
+    record, status = _find_mapping_row(index, "999", "A2")
+    assert (record.new_id, status) == ("RS_02", "accession:Accession")
+    record, status = _find_mapping_row(index, "A1", None)
+    assert (record.new_id, status) == ("RS_01", "flipped_mrn_in_accession:Accession")
+    record, status = _find_mapping_row(index, None, "456")
+    assert (record.new_id, status) == ("RS_02", "flipped_accession_in_mrn:MRN")
+
+
+def test_ids_match_exactly_after_stripping(tmp_path):
+    index = mapping_index(tmp_path, " 00123 ,A1,RS_01,2025-01-10,,")
+    assert _find_mapping_row(index, "00123 ", None)[0].new_id == "RS_01"
+    # Leading zeros are part of the ID
+    with pytest.raises(ValueError, match="No mapping found for MRN 123 or Accession N/A"):
+        _find_mapping_row(index, "123", None)
+    # Five or more underscores mean "no value"
+    with pytest.raises(ValueError, match="No mapping found for MRN N/A or Accession N/A"):
+        _find_mapping_row(index, "_____", "______")
+
+
+def test_conflicting_duplicate_keys_are_reported_and_first_row_wins(tmp_path):
+    index = mapping_index(
+        tmp_path,
+        "100,A1,RS_01,2025-01-10,,",
+        "100,A2,RS_02,2025-01-10,,",
+        "200,B1,RS_03,2025-01-10,,",
+        "200,B1,RS_03,2025-01-10,,",
+        "_____,C1,RS_04,2025-01-10,,",
+        "_____,C2,RS_05,2025-01-10,,",
+    )
+    # Identical duplicate rows and placeholder values are not ambiguous
+    assert index["ambiguous"] == [("MRN", "100", 2, 3)]
+    assert _find_mapping_row(index, "100", None)[0].new_id == "RS_01"
+    assert _find_mapping_row(index, None, "A2")[0].new_id == "RS_02"
+
+
+def test_engine_warns_about_ambiguous_keys(tmp_path, caplog):
+    path = tmp_path / "mapping.csv"
+    path.write_text(f"{HEADER}\n100,A1,RS_01,2025-01-10,,\n100,A2,RS_02,2025-01-10,,\n", encoding="utf-8")
+    with caplog.at_level(logging.WARNING, logger="deid_tool"):
+        DeidEngine(path)
+    assert "Ambiguous mapping key '100' in column 'MRN' (CSV rows 2 and 3); using row 2" in caplog.messages
+
+
+def test_patient_records_are_resolved_once_per_row(tmp_path):
+    index = mapping_index(
+        tmp_path,
+        "100,A1, RS_01 ,2025-01-10,2024-01-01, left side ",
+        "200,B1,RS_02,01/31/2025,,",
+        "",
+        "300,C1,RS_03,2025/02/03,,",
+    )
+    first, second, third = index["records"]
+    assert (first.new_id, first.surgery_date.date().isoformat(), first.anchor_date.date().isoformat()) == (
+        "RS_01", "2025-01-10", "2024-01-01",
+    )
+    assert first.notes == "left side" and second.notes == ""
+    assert second.surgery_date.date().isoformat() == "2025-01-31"
+    # Anchor_Date defaults to June 15, 2024
+    assert second.anchor_date.date().isoformat() == "2024-06-15"
+    # Blank lines do not count as CSV rows
+    assert [record.csv_row for record in index["records"]] == [2, 3, 4]
+    assert third.surgery_date.date().isoformat() == "2025-02-03"
+    assert _find_mapping_row(index, "300", None)[0] is third
+
+
+@pytest.mark.parametrize(
+    "row, message",
+    [
+        ("100,A1,,2025-01-10,,", "CSV row 3: New_Patient_ID is empty"),
+        ("100,A1,RS_02,,,", "CSV row 3: Surgery_Date is empty"),
+        ("100,A1,RS_02,not a date,,", "CSV row 3: invalid Surgery_Date 'not a date'"),
+        ("100,A1,RS_02,2025-01-10,13/45/2024,", "CSV row 3: invalid Anchor_Date '13/45/2024'"),
+    ],
+)
+def test_bad_rows_fail_at_load_naming_the_row(tmp_path, row, message):
+    with pytest.raises(ValueError, match=message):
+        mapping_index(tmp_path, "50,A0,RS_01,2025-01-10,,", row)
+
+
+def test_missing_required_column_fails_at_load(tmp_path):
+    path = tmp_path / "mapping.csv"
+    path.write_text("MRN,Accession,New_Patient_ID\n100,A1,RS_01\n", encoding="utf-8")
+    with pytest.raises(ValueError, match="Column 'Surgery_Date' not found"):
+        DeidEngine(path)
+
+
+def test_dataframe_mapping_gives_the_same_records(tmp_path):
+    pandas = pytest.importorskip("pandas")
+    rows = ["00100,A1,RS_01,2025-01-10,,note", "200,B1,RS_02,01/31/2025,2024-02-01,"]
+    from_csv = mapping_index(tmp_path, *rows)
+    from_frame = _build_mapping_index(load_mapping(pandas.read_csv(tmp_path / "mapping.csv", dtype=str)))
+    for a, b in zip(from_csv["records"], from_frame["records"]):
+        assert (a.new_id, a.surgery_date, a.anchor_date, a.notes, a.csv_row) == (b.new_id, b.surgery_date, b.anchor_date, b.notes, b.csv_row)
+    assert from_csv["lookup"] == from_frame["lookup"]
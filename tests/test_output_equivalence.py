@@ -0,0 +1,234 @@
+import copy
+import shutil
+from concurrent.futures import ThreadPoolExecutor
+from io import BytesIO
+
+import pydicom
+import pytest
+from dicomanonymizer import simpledicomanonymizer
+from dicomanonymizer.simpledicomanonymizer import anonymize_dataset, keep
+from pydicom.data import get_testdata_file
+from pydicom.uid import ExplicitVRBigEndian, ExplicitVRLittleEndian
+
+from anonymization_plan import AnonymizationPlan, keyed_uid
+from deid_tool import KEEP_TAGS, DeidEngine, run_plan
+from header_index import INDEX_NAME
+from make_test_cohort import generate_cohort
+from remove_999_dose_reports import _crop_raw_pixels, _crop_top_quarter, _decode_and_crop, _write_dicom
+
+# Several code paths promise output byte-identical to the plain one. These
+# tests de-identify the same small cohort both ways, with replacement UIDs
+# pinned by a fixed key, and compare every output file.
+
+UID_KEY = "output-equivalence-test"
+
+# pydicom's bundled files in syntaxes the synthetic cohort does not cover
+# (implicit VR, big endian, deflated, encapsulated, overlays, private sequences)
+BUNDLED_FILES = [
+    "MR_small_implicit.dcm",
+    "MR_small_expb.dcm",
+    "MR_small_RLE.dcm",
+    "JPEG2000.dcm",
+    "SC_rgb_rle_2frame.dcm",
+    "image_dfl.dcm",
+    "examples_overlay.dcm",
+    "nested_priv_SQ.dcm",
+]
+
+# First patient and accession of generate_cohort(seed=...) below
+FIRST_MRN = "100000"
+FIRST_ACCESSION = "A00000000"
+
+# The bundled files carry a few deliberately invalid values
+pytestmark = pytest.mark.filterwarnings("ignore")
+
+
+@pytest.fixture(scope="module")
+def cohort(tmp_path_factory):
+    """(input root, mapping CSV): a synthetic cohort plus bundled files filed under its first accession."""
+    root = tmp_path_factory.mktemp("cohort")
+    input_root, csv_path = root / "raw_input", root / "mapping.csv"
+    generate_cohort(input_root, csv_path, 3, accessions=1, series=3, instances=2, frames=3, seed=1)
+    target = input_root / f"patient_{FIRST_MRN}" / FIRST_ACCESSION / "BUNDLED"
+    target.mkdir()
+    for name in BUNDLED_FILES:
+        ds = pydicom.dcmread(get_testdata_file(name))
+        ds.PatientID = FIRST_MRN
+        ds.AccessionNumber = FIRST_ACCESSION
+        ds.StudyDate = "20231220"
+        ds.save_as(target / name)
+    return input_root, csv_path
+
+
+def deidentify(cohort, output_root, **engine_options):
+    """Run the engine like the command line. Returns (summary, {relative path: bytes})."""
+    input_root, csv_path = cohort
+    engine = DeidEngine(csv_path, uid_key=UID_KEY, **engine_options)
+    summary = engine.run(input_root, output_root)
+    files = {
+        str(path.relative_to(output_root)): path.read_bytes()
+        for path in sorted(output_root.rglob("*"))
+        if path.is_file() and not path.name.startswith("deid_")
+    }
+    return summary, files
+
+
+def outcomes(summary):
+    return {key: summary[key] for key in ("success", "fail", "skipped_999_dose_reports")}
+
+
+@pytest.fixture(scope="module")
+def plain_output(cohort, tmp_path_factory):
+    summary, files = deidentify(cohort, tmp_path_factory.mktemp("plain"), use_header_index=False)
+    assert summary["success"] > 0 and summary["fail"] == 0
+    return summary, files
+
+
+def test_stream_pixels_matches_full_read(cohort, plain_output, tmp_path):
+    summary, files = deidentify(cohort, tmp_path, use_header_index=False, stream_pixels=True)
+    assert outcomes(summary) == outcomes(plain_output[0])
+    assert files == plain_output[1]
+
+
+def test_worker_processes_match_serial(cohort, plain_output, tmp_path):
+    # Replacement UIDs are keyed, so workers agree on the new study and series UIDs
+    summary, files = deidentify(cohort, tmp_path, use_header_index=False, workers=2)
+    assert outcomes(summary) == outcomes(plain_output[0])
+    assert files == plain_output[1]
+
+
+@pytest.mark.parametrize("workers", [1, 2])
+def test_io_threads_match_plain(cohort, plain_output, tmp_path, workers):
+    summary, files = deidentify(cohort, tmp_path, use_header_index=False, workers=workers, io_threads=4, read_ahead=4)
+    assert outcomes(summary) == outcomes(plain_output[0])
+    assert files == plain_output[1]
+
+
+def test_header_index_matches_full_prescan(cohort, plain_output, tmp_path):
+    # The first run fills the index, the second plans from it without header reads
+    output_root = tmp_path / "indexed"
+    first, _ = deidentify(cohort, output_root)
+    for path in output_root.iterdir():
+        if path.is_dir():
+            shutil.rmtree(path)
+        elif path.name != INDEX_NAME:
+            path.unlink()
+    summary, files = deidentify(cohort, output_root)
+    hits = summary["metrics"].counters["header_index_hits"]
+    assert hits == first["success"] + first["skipped_999_dose_reports"]
+    assert outcomes(summary) == outcomes(plain_output[0])
+    assert files == plain_output[1]
+
+
+def _encoded(ds):
+    buffer = BytesIO()
+    ds.save_as(buffer)
+    return buffer.getvalue()
+
+
+@pytest.mark.parametrize("uid_key", [UID_KEY, None])
+def test_anonymization_plan_matches_anonymize_dataset(cohort, monkeypatch, uid_key):
+    # Pin dicomanonymizer's random UIDs, which the plan falls back to without a key
+    monkeypatch.setattr(simpledicomanonymizer, "get_UID", lambda uid: keyed_uid(uid, UID_KEY))
+    plan = AnonymizationPlan(KEEP_TAGS, delete_private_tags=True)
+    rules = {tag: keep for tag in KEEP_TAGS}
+    input_root, _ = cohort
+    paths = [path for path in sorted(input_root.rglob("*")) if path.is_file()]
+    assert paths
+    for path in paths:
+        expected = pydicom.dcmread(path)
+        anonymize_dataset(expected, rules, delete_private_tags=True)
+        actual = pydicom.dcmread(path)
+        plan.apply(actual, uid_key)
+        assert _encoded(actual) == _encoded(expected), path
+
+
+def test_anonymization_plan_threads_keep_their_own_keys(cohort):
+    plan = AnonymizationPlan(KEEP_TAGS, delete_private_tags=True)
+    input_root, _ = cohort
+    paths = [path for path in sorted(input_root.rglob("*")) if path.is_file()]
+    keys = [f"{UID_KEY}-{i}" for i in range(4)]
+
+    def apply_all(key):
+        encoded = []
+        for path in paths:
+            ds = pydicom.dcmread(path)
+            plan.apply(ds, key)
+            encoded.append(_encoded(ds))
+        return encoded
+
+    serial = [apply_all(key) for key in keys]
+    with ThreadPoolExecutor(max_workers=len(keys)) as executor:
+        assert list(executor.map(apply_all, keys)) == serial
+    assert serial[0] != serial[1]
+    # dicomanonymizer itself is left unpatched
+    assert simpledicomanonymizer.get_UID.__module__ == simpledicomanonymizer.__name__
+
+
+def test_run_plan_with_parsed_dataset_matches_read_from_path(cohort, tmp_path):
+    input_root, csv_path = cohort
+    engine = DeidEngine(csv_path, uid_key=UID_KEY)
+    written = 0
+    for path in sorted(input_root.rglob("*")):
+        if not path.is_file():
+            continue
+        plan = engine.plan_dataset(path, pydicom.dcmread(path))
+        from_path = run_plan(dict(plan, target_path=tmp_path / "from_path.dcm"))
+        from_dataset = run_plan(dict(plan, target_path=tmp_path / "from_dataset.dcm"), pydicom.dcmread(path))
+        assert from_dataset["outcome"] == from_path["outcome"], path
+        if from_path["outcome"] == "success":
+            assert (tmp_path / "from_dataset.dcm").read_bytes() == (tmp_path / "from_path.dcm").read_bytes(), path
+            written += 1
+    assert written > 0
+
+
+def _planar(ds):
+    """Copy of an interleaved RGB dataset with PlanarConfiguration 1."""
+    planar = copy.deepcopy(ds)
+    planar.PlanarConfiguration = 1
+    planar.PixelData = ds.pixel_array.transpose(2, 0, 1).tobytes()
+    # 8-bit samples; OW would be byte-swapped in big endian
+    planar["PixelData"].VR = "OB"
+    return planar
+
+
+@pytest.mark.parametrize(
+    "name", ["CT_small.dcm", "MR_small.dcm", "SC_rgb_small_odd.dcm", "examples_rgb_color.dcm", "rtdose_1frame.dcm"]
+)
+def test_raw_crop_matches_decoded_crop(name):
+    ds = pydicom.dcmread(get_testdata_file(name))
+    crop_rows = int(ds.Rows) // 4
+    raw = _crop_raw_pixels(ds, crop_rows)
+    assert raw is not None
+    assert raw == _decode_and_crop(ds, crop_rows)
+
+
+@pytest.mark.parametrize("syntax", [ExplicitVRLittleEndian, ExplicitVRBigEndian])
+def test_crop_keeps_planar_pixels(syntax, tmp_path):
+    # Little endian is sliced raw, big endian is decoded and rewritten colour-by-pixel
+    source = _planar(pydicom.dcmread(get_testdata_file("SC_rgb_small_odd.dcm")))
+    expected = source.pixel_array
+    source.file_meta.TransferSyntaxUID = syntax
+    pydicom.dcmwrite(tmp_path / "planar.dcm", source, little_endian=syntax.is_little_endian, implicit_vr=False)
+
+    ds = pydicom.dcmread(tmp_path / "planar.dcm")
+    crop_rows, decoded = _crop_top_quarter(ds)
+    assert decoded == (not syntax.is_little_endian)
+    _write_dicom(ds, tmp_path / "cropped.dcm")
+    cropped = pydicom.dcmread(tmp_path / "cropped.dcm").pixel_array
+    assert (cropped == expected[crop_rows:]).all()
+
+
+def test_raw_crop_matches_decoded_crop_for_cohort_dose_reports(cohort):
+    input_root, _ = cohort
+    cropped = 0
+    for path in sorted(input_root.rglob("*")):
+        if not path.is_file():
+            continue
+        ds = pydicom.dcmread(path)
+        if ds.get("SeriesNumber") != 999:
+            continue
+        crop_rows = int(ds.Rows) // 4
+        assert _crop_raw_pixels(ds, crop_rows) == _decode_and_crop(ds, crop_rows), path
+        cropped += 1
+    assert cropped > 0
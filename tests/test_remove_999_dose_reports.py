@@ -0,0 +1,165 @@
+import sys
+
+import pydicom
+import pytest
+from pydicom.data import get_testdata_file
+from pydicom.dataset import Dataset
+from pydicom.pixels import get_encoder
+from pydicom.sequence import Sequence
+from pydicom.uid import (
+    DeflatedExplicitVRLittleEndian,
+    ExplicitVRBigEndian,
+    ExplicitVRLittleEndian,
+    ImplicitVRLittleEndian,
+    JPEG2000Lossless,
+    JPEGBaseline8Bit,
+    JPEGLSLossless,
+    RLELossless,
+)
+
+import remove_999_dose_reports
+from make_test_cohort import generate_cohort
+
+pytestmark = pytest.mark.filterwarnings("ignore")
+
+
+@pytest.fixture
+def deid_output(tmp_path):
+    """A small de-identified-looking tree with Series 999 dose reports and non-DICOM files."""
+    root = tmp_path / "deid_output"
+    generate_cohort(root, tmp_path / "mapping.csv", 2, accessions=1, series=2, instances=2, frames=2, seed=3)
+    return root
+
+
+def run_cleanup(monkeypatch, *args):
+    monkeypatch.setattr(sys, "argv", ["remove_999_dose_reports.py", "--no-progress", "--workers", "2", *args])
+    return remove_999_dose_reports.main()
+
+
+def tree_files(root):
+    """{relative path: bytes} of every file under root except the cleanup logs."""
+    return {
+        str(path.relative_to(root)): path.read_bytes()
+        for path in sorted(root.rglob("*"))
+        if path.is_file() and not path.name.startswith("dose_report_cleanup_")
+    }
+
+
+def test_output_inside_input_is_not_walked(deid_output, tmp_path, monkeypatch):
+    separate = tmp_path / "separate"
+    assert run_cleanup(monkeypatch, "--input", str(deid_output), "--output", str(separate)) == 0
+    expected = tree_files(separate)
+    assert any(name.endswith(".dcm") for name in expected)
+
+    nested = deid_output / "cleaned"
+    assert run_cleanup(monkeypatch, "--input", str(deid_output), "--output", str(nested)) == 0
+    assert tree_files(nested) == expected
+
+
+def _with_undefined_length_sequence(source, target, series_number, implicit_vr):
+    """Copy of source with an undefined-length SQ (with nested items) before SeriesNumber."""
+    ds = pydicom.dcmread(source)
+    item = Dataset()
+    item.ReferencedSOPClassUID = "1.2.840.10008.3.1.2.3.1"
+    item.ReferencedSOPInstanceUID = "1.2.3.4.5"
+    inner = Dataset()
+    inner.CodeValue = "0020"
+    inner.CodeMeaning = "SeriesNumber 0020,0011 look-alike"
+    item.PurposeOfReferenceCodeSequence = Sequence([inner])
+    item["PurposeOfReferenceCodeSequence"].is_undefined_length = True
+    item.is_undefined_length_sequence_item = True
+    ds.ReferencedStudySequence = Sequence([item, item])
+    ds["ReferencedStudySequence"].is_undefined_length = True
+    ds.SeriesNumber = series_number
+    syntax = ImplicitVRLittleEndian if implicit_vr else ExplicitVRLittleEndian
+    ds.file_meta.TransferSyntaxUID = syntax
+    pydicom.dcmwrite(target, ds, implicit_vr=implicit_vr, little_endian=True)
+
+
+@pytest.mark.parametrize("implicit_vr", [False, True])
+def test_series_header_read_past_undefined_length_sequence(deid_output, tmp_path, monkeypatch, implicit_vr):
+    dose_report = next(path for path in sorted(deid_output.rglob("*.dcm")) if pydicom.dcmread(path).SeriesNumber == 999)
+    input_root = tmp_path / "input"
+    input_root.mkdir()
+    _with_undefined_length_sequence(dose_report, input_root / "dose.dcm", 999, implicit_vr)
+    _with_undefined_length_sequence(dose_report, input_root / "image.dcm", 2, implicit_vr)
+
+    header, bytes_parsed = remove_999_dose_reports._read_series_header(input_root / "dose.dcm")
+    assert header.SeriesNumber == 999
+    assert bytes_parsed < (input_root / "dose.dcm").stat().st_size
+
+    output_root = tmp_path / "output"
+    assert run_cleanup(monkeypatch, "--input", str(input_root), "--output", str(output_root)) == 0
+    source = pydicom.dcmread(input_root / "dose.dcm")
+    cropped = pydicom.dcmread(output_root / "dose.dcm")
+    crop_rows = source.Rows // 4
+    assert cropped.Rows == source.Rows - crop_rows
+    assert (cropped.pixel_array == source.pixel_array[..., crop_rows:, :]).all()
+    assert cropped.ReferencedStudySequence == source.ReferencedStudySequence
+    # Other series are copied byte for byte
+    assert (output_root / "image.dcm").read_bytes() == (input_root / "image.dcm").read_bytes()
+
+
+@pytest.mark.parametrize(
+    "source, output_syntax, expected",
+    [
+        (ImplicitVRLittleEndian, "explicit", ExplicitVRLittleEndian),
+        (RLELossless, "explicit", ExplicitVRLittleEndian),
+        (ExplicitVRLittleEndian, "rle", RLELossless),
+        (ImplicitVRLittleEndian, "original", ImplicitVRLittleEndian),
+        (DeflatedExplicitVRLittleEndian, "original", DeflatedExplicitVRLittleEndian),
+        (ExplicitVRBigEndian, "original", ExplicitVRLittleEndian),
+        (None, "original", ExplicitVRLittleEndian),
+        (RLELossless, "original", RLELossless),
+        # Lossy sources are never re-encoded lossy
+        (JPEGBaseline8Bit, "original", RLELossless),
+    ],
+)
+def test_output_syntax_choice(source, output_syntax, expected):
+    assert remove_999_dose_reports._choose_output_syntax(source, output_syntax) == expected
+
+
+@pytest.mark.parametrize("syntax", [JPEGLSLossless, JPEG2000Lossless])
+def test_original_lossless_syntax_needs_its_encoder(syntax):
+    expected = syntax if get_encoder(syntax).is_available else RLELossless
+    assert remove_999_dose_reports._choose_output_syntax(syntax, "original") == expected
+
+
+BUNDLED_DOSE_REPORTS = ["MR_small_implicit.dcm", "MR_small_expb.dcm", "image_dfl.dcm", "MR_small_RLE.dcm"]
+
+
+@pytest.mark.parametrize("output_syntax", ["explicit", "rle", "original"])
+def test_cropped_files_are_written_in_the_chosen_syntax(tmp_path, monkeypatch, output_syntax):
+    input_root = tmp_path / "input"
+    input_root.mkdir()
+    sources = {}
+    for name in BUNDLED_DOSE_REPORTS:
+        ds = pydicom.dcmread(get_testdata_file(name))
+        ds.SeriesNumber = 999
+        ds.save_as(input_root / name)
+        sources[name] = pydicom.dcmread(input_root / name)
+
+    output_root = tmp_path / "output"
+    assert run_cleanup(monkeypatch, "--input", str(input_root), "--output", str(output_root), "--output-syntax", output_syntax) == 0
+    for name, source in sources.items():
+        cropped = pydicom.dcmread(output_root / name)
+        expected = remove_999_dose_reports._choose_output_syntax(source.file_meta.TransferSyntaxUID, output_syntax)
+        assert cropped.file_meta.TransferSyntaxUID == expected, name
+        crop_rows = source.Rows // 4
+        assert (cropped.pixel_array == source.pixel_array[..., crop_rows:, :]).all(), name
+        assert cropped.SOPInstanceUID == source.SOPInstanceUID
+
+
+def test_failed_encoding_falls_back_to_explicit_little_endian(tmp_path, monkeypatch):
+    ds = pydicom.dcmread(get_testdata_file("MR_small_implicit.dcm"))
+    expected = ds.pixel_array
+
+    def fail(*args, **kwargs):
+        raise RuntimeError("no encoder")
+
+    monkeypatch.setattr(Dataset, "compress", fail)
+    syntax = remove_999_dose_reports._write_dicom(ds, tmp_path / "out.dcm", RLELossless)
+    assert syntax == ExplicitVRLittleEndian
+    written = pydicom.dcmread(tmp_path / "out.dcm")
+    assert written.file_meta.TransferSyntaxUID == ExplicitVRLittleEndian
+    assert (written.pixel_array == expected).all()
@@ -0,0 +1,73 @@
+import json
+import random
+
+import run_metrics
+from run_metrics import RunMetrics, StageStats
+
+
+def test_quantiles_use_nearest_rank():
+    stats = StageStats()
+    values = list(range(1, 101))
+    random.Random(1).shuffle(values)
+    for value in values:
+        stats.add(value)
+    assert (stats.quantile(0.5), stats.quantile(0.95), stats.quantile(0.99)) == (50, 95, 99)
+    assert stats.quantile(1.0) == 100 and stats.quantile(0.0) == 1
+    assert StageStats().quantile(0.5) == 0.0
+
+
+def test_reservoir_bounds_memory_but_keeps_exact_totals(monkeypatch):
+    monkeypatch.setattr(run_metrics, "RESERVOIR_SIZE", 1000)
+    stats = StageStats()
+    for value in range(20000):
+        stats.add(value)
+    assert len(stats._samples) == 1000
+    assert (stats.count, stats.total, stats.max) == (20000, sum(range(20000)), 19999)
+    # A uniform sample keeps the quantiles close
+    assert abs(stats.quantile(0.5) - 10000) < 1500
+    assert abs(stats.quantile(0.95) - 19000) < 1000
+
+
+def test_merge_splits_worker_timings_from_counters():
+    metrics = RunMetrics("deid")
+    metrics.merge({"read_seconds": 0.5, "bytes_read": 100})
+    metrics.merge({"read_seconds": 1.5, "bytes_read": 50})
+    assert metrics.stages["read"].count == 2 and metrics.stages["read"].total == 2.0
+    assert metrics.counters == {"bytes_read": 150}
+
+
+def test_json_output(tmp_path):
+    metrics = RunMetrics("deid")
+    metrics.record("write", 0.25)
+    metrics.add("files_success", 3)
+    metrics.set_gauge("peak_rss_bytes", 1024)
+    metrics.write(tmp_path / "metrics.json")
+    data = json.loads((tmp_path / "metrics.json").read_text())
+    assert data["stages"]["write"]["count"] == 1
+    assert data["stages"]["write"]["p99_seconds"] == 0.25
+    assert data["counters"] == {"files_success": 3}
+    assert data["gauges"] == {"peak_rss_bytes": 1024}
+    assert not list(tmp_path.glob("*.tmp"))
+
+
+def test_prometheus_text_output(tmp_path):
+    metrics = RunMetrics("deid")
+    for seconds in (0.1, 0.2, 0.3, 0.4):
+        metrics.record("anonymize", seconds)
+    metrics.add("files_success", 4)
+    metrics.set_gauge("peak_rss_bytes", 2048)
+    metrics.write(tmp_path / "deid.prom")
+    lines = (tmp_path / "deid.prom").read_text().splitlines()
+
+    assert "# TYPE deid_stage_seconds summary" in lines
+    assert 'deid_stage_seconds{stage="anonymize",quantile="0.5"} 0.200000' in lines
+    assert 'deid_stage_seconds{stage="anonymize",quantile="0.99"} 0.400000' in lines
+    assert 'deid_stage_seconds_sum{stage="anonymize"} 1.000000' in lines
+    assert 'deid_stage_seconds_count{stage="anonymize"} 4' in lines
+    assert "# TYPE deid_files_success_total counter" in lines
+    assert "deid_files_success_total 4" in lines
+    assert "deid_peak_rss_bytes 2048" in lines
+    # Every sample line is "name{labels} value" with a numeric value
+    for line in lines:
+        if not line.startswith("#"):
+            float(line.rsplit(" ", 1)[1])